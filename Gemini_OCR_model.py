@@ -12,12 +12,17 @@ get_ipython().system('pip install --upgrade vertexai')
 
 
 import os
-import csv
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
 import time
 import re
 import shutil
+import asyncio
+from response_cache import ResponseCache
+from result_writer import ResultWriter
+from benchmark_utils import encode_image_to_binary, load_jobs
+from image_preprocess import PreprocessCache, detect_mime_type
+from scheduler import Scheduler, STATS_FIELDS, stats_columns
 
 
 # In[8]:
@@ -28,6 +33,28 @@ MODELS_TO_TEST = [
 #    "gemini-2.0-flash",
 ]
 
+# 비동기 실행 설정 (USE_ASYNC가 True면 이미지/질문 작업을 병렬로 요청)
+USE_ASYNC = True
+MAX_CONCURRENCY = 8  # 동시에 보낼 최대 요청 수
+
+# 이미지 전처리 (True면 실제 형식 확인, 방향 보정, 모델별 픽셀 예산으로 축소/재인코딩한 이미지를 전송)
+PREPROCESS = True
+
+# Generation config 파라미터 (응답 캐시 키에도 사용)
+GENERATION_PARAMS = {"temperature": 0.2, "top_p": 1, "top_k": 32}
+
+# 모델별 분당 요청/토큰 한도 (프로젝트 할당량에 맞게 설정, 토큰은 응답의 usage_metadata로 사후 차감)
+RATE_LIMITS = {
+    # "gemini-2.0-flash": {"rpm": 200, "tpm": 1000000},
+}
+# 일시적 오류(429/503/시간 초과) 재시도 횟수, 이 시간(초)보다 오래 걸리는 요청은 한 번 더 보냄 (None이면 헤징 안 함)
+MAX_RETRIES = 5
+HEDGE_AFTER = None
+
+# 결과 파일 (.csv 또는 .jsonl, 행이 끝나는 대로 추가되며 같은 실행 ID로 재실행하면 완료된 작업은 건너뜀)
+RESULTS_FILE = "gemini_results.csv"
+RESULT_FIELDS = ["model", "image", "question", "response", "inference_time", "cached"] + STATS_FIELDS + ["error"]
+
 
 # In[9]:
 
@@ -62,108 +89,210 @@ else:
 # In[19]:
 
 
-def encode_image_to_binary(image_path):
-    """이미지를 바이너리 형태로 읽어서 반환하는 함수"""
-    with open(image_path, 'rb') as f:
-        return f.read()
-
-def load_questions(filepath):
-    """질문 텍스트 파일을 읽어 리스트로 반환하는 함수 (각 줄 하나의 질문)"""
-    questions = []
-    with open(filepath, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                questions.append(line)
-    return questions
+def build_contents(image_data, question):
+    """시스템 지침, 이미지, 질문으로 generate_content 입력을 구성하는 함수"""
+    # 이미지를 Gemini 모델에 전달할 수 있는 형태로 변환
+    img_part = Part.from_data(data=image_data, mime_type=detect_mime_type(image_data))
+
+    contents = []
+
+    if system_instruction:
+        contents.append(system_instruction)
+
+    contents.append(img_part)
+    contents.append(question)
+    return contents
+
+def load_image(preprocessor, image_path, model_name):
+    """전송할 이미지 바이트 (preprocessor가 있으면 모델 프로필로 전처리한 결과)"""
+    if preprocessor is None:
+        return encode_image_to_binary(os.path.join("data", "images", image_path))
+    return preprocessor.prepare(os.path.join("data", "images", image_path), model_name)["data"]
+
+def response_tokens(result):
+    """(응답, 소요 시간) 결과에서 입력+출력 토큰 수 계산 (TPM 한도 차감용)"""
+    return result[0].usage_metadata.total_token_count
+
+def error_row(model_name, image_path, question, error):
+    """실패한 작업의 결과 행 (평균이 왜곡되지 않도록 inference_time은 비움)"""
+    return {
+        "model": model_name,
+        "image": os.path.basename(image_path),
+        "question": question,
+        "response": f"Error: {str(error)}",
+        "cached": False,
+        "error": str(error) or type(error).__name__,
+    }
+
+def print_throughput(latencies, elapsed):
+    """전체 소요 시간 대비 처리량(jobs/sec)과 호출별 지연 시간을 출력하는 함수"""
+    if not latencies:
+        return
+    print(f"작업 수: {len(latencies)} / 전체 소요 시간: {elapsed:.2f}초 / 처리량: {len(latencies) / elapsed:.2f} jobs/sec")
+    print(f"호출별 지연 시간 - 평균: {sum(latencies) / len(latencies):.2f}초 / 최소: {min(latencies):.2f}초 / 최대: {max(latencies):.2f}초 / 합계: {sum(latencies):.2f}초")
 
 def run_tests():
-    # Vertex AI 초기화
+    # Vertex AI 초기화 (실행당 한 번)
     vertexai.init(project=project_id, location=location)
 
-    # Gemini Pro Vision 모델 로드
-    model = GenerativeModel("gemini-pro-vision")
-    
-    image_files = sorted(os.listdir(os.path.join("data", "images")), 
-                key=lambda x: int(''.join(filter(str.isdigit, x))))
-    print(image_files)
-    if not image_files:
-        print("이미지 파일을 찾을 수 없습니다. data/images/ 폴더를 확인하세요.")
+    jobs = load_jobs()
+    if not jobs:
         return
 
-    questions = load_questions(os.path.join("data", "questions.txt"))
-    
-    if not questions:
-        print("질문 파일에 내용이 없습니다. data/questions.txt 파일을 확인하세요.")
-        return
+    # Generation config 설정
+    generation_config = GenerationConfig(**GENERATION_PARAMS)
+    cache = ResponseCache()
+    writer = ResultWriter(RESULTS_FILE, RESULT_FIELDS, key_fields=["model", "image"])
+    scheduler = Scheduler(RATE_LIMITS, max_retries=MAX_RETRIES, hedge_after=HEDGE_AFTER)
+    preprocessor = PreprocessCache() if PREPROCESS else None
 
-    results = []
+    latencies = []
+    sweep_start = time.perf_counter()
 
     # 모델, 이미지, 질문별로 테스트 실행
-    for model in MODELS_TO_TEST:
-        for image_path, question in zip(image_files, questions):
-            image_data = encode_image_to_binary(os.path.join("data", "images", image_path))
-            print(f"모델: {model} / 이미지: {os.path.basename(image_path)} / 질문: {question}")        
-        
-            try:
-                # Vertex AI 초기화
-                vertexai.init(project=project_id, location=location)
-
-                # Gemini Pro Vision 모델 로드
-                model = GenerativeModel("gemini-pro-vision")
-
-                # 이미지 파일 읽기
-                # with open(image_path, "rb") as image_file:
-                #     img_data = image_file.read()
+    for model_name in MODELS_TO_TEST:
+        # Gemini 모델 로드 (모델당 한 번)
+        model = GenerativeModel(model_name)
 
-                # 이미지를 Gemini 모델에 전달할 수 있는 형태로 변환
-                img_part = Part.from_data(data=image_data, mime_type="image/jpeg")  # 이미지 형식에 맞게 변경
+        for image_path, question in jobs:
+            if writer.is_done(model=model_name, image=os.path.basename(image_path)):
+                continue
 
-#                 # 프롬프트 설정
-#                 prompt = "이 명함 이미지에서 이름, 전화번호, 주소, 회사명을 추출하여 JSON 형식으로 알려주세요."
-
-                # Generation config 설정
-                generation_config = GenerationConfig(temperature=0.2, top_p=1, top_k=32)
-
-                contents = []
+            image_data = load_image(preprocessor, image_path, model_name)
+            print(f"모델: {model_name} / 이미지: {os.path.basename(image_path)} / 질문: {question}")        
+        
+            cache_key = cache.make_key(model_name, image_data, question, system_instruction, GENERATION_PARAMS)
+            cached = cache.get(cache_key)
+            stats = None
+            if cached is not None:
+                text, inference_time = cached
+            else:
+                try:
+                    contents = build_contents(image_data, question)
+
+                    def generate():
+                        start_time = time.perf_counter()
+                        response = model.generate_content(
+                            contents,
+                            generation_config=generation_config,
+                        )
+                        return response, time.perf_counter() - start_time
+
+                    # 한도 대기와 일시적 오류 재시도는 scheduler가 처리 (inference_time은 성공한 호출의 시간)
+                    (response, elapsed), stats = scheduler.call(model_name, generate, count_tokens=response_tokens)
+                    inference_time = round(elapsed, 2)
+                    text = response.text
+                    cache.put(cache_key, model_name, text, inference_time)
+                    # print(text)
+
+                except Exception as e:
+                    # 실패한 작업은 error를 채워 기록하고 다음 작업으로 진행 (재실행 시 이 실행을 이어서 다시 시도)
+                    print(f"Error: {str(e)}")
+                    writer.write(error_row(model_name, image_path, question, e))
+                    continue
+            
+            latencies.append(inference_time)
+            writer.write({
+                "model": model_name,
+                "image": os.path.basename(image_path),
+                "question": question,
+                "response": text,
+                "inference_time": inference_time,
+                "cached": cached is not None,
+                **stats_columns(stats)
+            })
 
-                if system_instruction:
-                    contents.append(system_instruction)
+    print_throughput(latencies, time.perf_counter() - sweep_start)
+    scheduler.close()
+    if preprocessor is not None:
+        preprocessor.report()
+    cache.report()
+    cache.close()
+    writer.close()
+
+async def run_tests_async(max_concurrency=MAX_CONCURRENCY):
+    """이미지/질문 작업을 asyncio로 동시에 요청하는 실행 모드 (최대 max_concurrency개 동시 요청)"""
+    # Vertex AI 초기화 (실행당 한 번)
+    vertexai.init(project=project_id, location=location)
 
-                contents.append(img_part)
-                contents.append(question)
-    
+    jobs = load_jobs()
+    if not jobs:
+        return
 
-                start_time = time.time()
-                response = model.generate_content(
+    generation_config = GenerationConfig(**GENERATION_PARAMS)
+    cache = ResponseCache()
+    writer = ResultWriter(RESULTS_FILE, RESULT_FIELDS, key_fields=["model", "image"])
+    semaphore = asyncio.Semaphore(max_concurrency)
+    scheduler = Scheduler(RATE_LIMITS, max_retries=MAX_RETRIES, hedge_after=HEDGE_AFTER)
+    preprocessor = PreprocessCache() if PREPROCESS else None
+    latencies = []
+
+    async def run_job(model_name, model, image_path, question):
+        image_data = load_image(preprocessor, image_path, model_name)
+        cache_key = cache.make_key(model_name, image_data, question, system_instruction, GENERATION_PARAMS)
+        cached = cache.get(cache_key)
+        stats = None
+        if cached is not None:
+            text, inference_time = cached
+        else:
+            contents = build_contents(image_data, question)
+
+            async def generate():
+                start_time = time.perf_counter()
+                response = await model.generate_content_async(
                     contents,
                     generation_config=generation_config,
                 )
+                return response, time.perf_counter() - start_time
 
-                inference_time = round(time.time() - start_time, 2)
+            try:
+                async with semaphore:
+                    print(f"모델: {model_name} / 이미지: {os.path.basename(image_path)} / 질문: {question}")
+                    (response, elapsed), stats = await scheduler.call_async(model_name, generate, count_tokens=response_tokens)
+                    inference_time = round(elapsed, 2)
                 text = response.text
-                # print(text)
-
             except Exception as e:
                 print(f"Error: {str(e)}")
-                return None
-            
-            results.append({
-                "model": model,
-                "image": os.path.basename(image_path),
-                "question": question,
-                "response": text,
-                "inference_time": inference_time
-            })
-
-    # 결과를 CSV 파일로 저장 (한 파일에 모든 결과가 기록됨)
-    csv_file = "test_results.csv"
-    with open(csv_file, mode='w', newline='', encoding='utf-8-sig') as f:
-        writer = csv.DictWriter(f, fieldnames=["model", "image", "question", "response","inference_time"])
-        writer.writeheader()
-        writer.writerows(results)
-
-    print(f"테스트 결과가 {csv_file} 파일에 저장되었습니다.")
+                writer.write(error_row(model_name, image_path, question, e))
+                return
+            cache.put(cache_key, model_name, text, inference_time)
+
+        # 작업이 끝나는 즉시 결과 기록
+        latencies.append(inference_time)
+        writer.write({
+            "model": model_name,
+            "image": os.path.basename(image_path),
+            "question": question,
+            "response": text,
+            "inference_time": inference_time,
+            "cached": cached is not None,
+            **stats_columns(stats)
+        })
+
+    tasks = []
+    for model_name in MODELS_TO_TEST:
+        # Gemini 모델 로드 (모델당 한 번, 모든 작업이 공유)
+        model = GenerativeModel(model_name)
+        for image_path, question in jobs:
+            if writer.is_done(model=model_name, image=os.path.basename(image_path)):
+                continue
+            tasks.append(run_job(model_name, model, image_path, question))
+
+    sweep_start = time.perf_counter()
+    outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - sweep_start
+
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            print(f"Error: {str(outcome)}")
+
+    print_throughput(latencies, elapsed)
+    scheduler.close()
+    if preprocessor is not None:
+        preprocessor.report()
+    cache.report()
+    cache.close()
+    writer.close()
 
 
 # In[20]:
@@ -223,7 +352,10 @@ system_instruction = """당신은 스마트 명함 관리 서비스를 위한 AI
 
 
 if __name__ == '__main__':
-    run_tests()
+    if USE_ASYNC:
+        asyncio.run(run_tests_async())
+    else:
+        run_tests()
 
 
 # In[ ]:
@@ -12,12 +12,20 @@ get_ipython().system('pip install --upgrade vertexai')
 
 
 import os
-import csv
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
+from vertexai.generative_models import GenerativeModel, Part, GenerationConfig, Content
+from vertexai.preview import caching
 import time
 import re
 import shutil
+import asyncio
+import datetime
+from response_cache import ResponseCache
+from result_writer import ResultWriter
+import benchmark_utils
+from benchmark_utils import encode_image_to_binary
+from image_preprocess import PreprocessCache, detect_mime_type
+from scheduler import Scheduler, STATS_FIELDS, stats_columns
 
 
 # In[24]:
@@ -64,6 +72,39 @@ MODELS_TO_TEST = [
 #    "gemini-2.0-flash",
 ]
 
+# 비동기 실행 설정 (USE_ASYNC가 True면 이미지별 대화를 병렬로 진행, 대화 안의 턴은 순서대로 진행)
+USE_ASYNC = True
+MAX_CONCURRENCY = 8  # 동시에 진행할 최대 대화 수
+
+# 이미지 전처리 (True면 실제 형식 확인, 방향 보정, 모델별 픽셀 예산으로 축소/재인코딩한 이미지를 전송)
+PREPROCESS = True
+
+# Generation config 파라미터 (응답 캐시 키에도 사용)
+GENERATION_PARAMS = {"temperature": 0.2, "top_p": 1, "top_k": 32}
+
+# 대화 방식
+#   "resend": 매 턴 시스템 지침, 이미지, 이전 질문 전체를 다시 전송 (기존 방식, 모델 답변은 기록에 없음)
+#   "chat":   ChatSession으로 진행, 시스템 지침은 모델 설정으로 전달하고 모델 답변도 대화 기록에 포함
+#   "cached": 시스템 지침과 이미지를 CachedContent로 한 번만 올리고 턴마다 새 질문만 추가
+#             (접두사가 CONTEXT_CACHE_MIN_TOKENS보다 작거나 생성에 실패하면 chat으로 진행하고, 결과 행에는 실제로 쓴 방식을 기록)
+# 명함 한 장과 시스템 지침은 보통 1000 토큰 안팎이라 캐시 최소 크기에 못 미치므로 기본값은 chat
+CONVERSATION_MODE = "chat"
+CONTEXT_CACHE_TTL = datetime.timedelta(minutes=10)
+# 컨텍스트 캐시의 최소 토큰 수 (모델마다 다르며, 이보다 작으면 생성 요청을 보내지 않음)
+CONTEXT_CACHE_MIN_TOKENS = 4096
+
+# 모델별 분당 요청/토큰 한도 (프로젝트 할당량에 맞게 설정, 토큰은 응답의 usage_metadata로 사후 차감)
+RATE_LIMITS = {
+    # "gemini-2.0-flash": {"rpm": 200, "tpm": 1000000},
+}
+# 일시적 오류(429/503/시간 초과) 재시도 횟수 (대화 턴은 기록이 두 번 쌓이지 않도록 헤징하지 않음)
+MAX_RETRIES = 5
+
+# 결과 파일 (.csv 또는 .jsonl, 턴이 끝나는 대로 추가되며 같은 실행 ID로 재실행하면 모든 턴이 기록된 대화는 건너뜀)
+RESULTS_FILE = "gemini_multiturn_results.csv"
+RESULT_FIELDS = ["model", "image", "turn", "question", "response", "inference_time", "cached",
+                 "conversation_mode", "prompt_tokens", "cached_tokens", "output_tokens"] + STATS_FIELDS + ["error"]
+
 
 # In[26]:
 
@@ -98,119 +139,377 @@ else:
 # In[27]:
 
 
-def encode_image_to_binary(image_path):
-    """이미지를 바이너리 형태로 읽어서 반환하는 함수"""
-    with open(image_path, 'rb') as f:
-        return f.read()
+def load_jobs():
+    """이미지 파일과 3턴 질문을 짝지어 (이미지 파일명, 질문, 턴 리스트) 리스트로 반환하는 함수"""
+    jobs = []
+    for image_path, question in benchmark_utils.load_jobs():
+        turns = question.split('|')
+        if len(turns) != 3:
+            print(f"잘못된 질문 형식: {question}")
+            continue
+        jobs.append((image_path, question, turns))
+    return jobs
+
+def build_contents(image_data):
+    """시스템 지침과 이미지로 대화의 첫 입력을 구성하는 함수"""
+    # 이미지를 Gemini 모델에 전달할 수 있는 형태로 변환
+    img_part = Part.from_data(data=image_data, mime_type=detect_mime_type(image_data))
+
+    contents = []
+
+    if system_instruction:
+        contents.append(system_instruction)
+
+    contents.append(img_part)
+    return contents
+
+def load_image(preprocessor, image_path, model_name):
+    """전송할 이미지 바이트 (preprocessor가 있으면 모델 프로필로 전처리한 결과)"""
+    if preprocessor is None:
+        return encode_image_to_binary(os.path.join("data", "images", image_path))
+    return preprocessor.prepare(os.path.join("data", "images", image_path), model_name)["data"]
+
+def usage_counts(response):
+    """응답의 입력/캐시/출력 토큰 수 반환"""
+    usage = response.usage_metadata
+    return {
+        "prompt_tokens": getattr(usage, "prompt_token_count", 0),
+        "cached_tokens": getattr(usage, "cached_content_token_count", 0),
+        "output_tokens": getattr(usage, "candidates_token_count", 0),
+    }
+
+class Conversation:
+    """이미지 한 장에 대한 대화 (CONVERSATION_MODE에 따라 매 턴 보내는 내용이 달라짐)"""
+    def __init__(self, model_name, image_data, mode=CONVERSATION_MODE):
+        self.model_name = model_name
+        self.mode = mode
+        self.img_part = Part.from_data(data=image_data, mime_type=detect_mime_type(image_data))
+        self.generation_config = GenerationConfig(**GENERATION_PARAMS)
+        self.cached_content = None
+        self.first_turn = True
+
+        if self.mode == "cached":
+            prefix_tokens = self.prefix_tokens()
+            if prefix_tokens is not None and prefix_tokens < CONTEXT_CACHE_MIN_TOKENS:
+                print(f"캐시할 접두사가 {prefix_tokens} 토큰으로 최소 {CONTEXT_CACHE_MIN_TOKENS} 토큰보다 작아 chat 모드로 진행합니다.")
+                self.mode = "chat"
+        if self.mode == "cached":
+            try:
+                # 시스템 지침과 이미지를 서버에 한 번만 올려 두고 이후 턴은 캐시를 참조
+                self.cached_content = caching.CachedContent.create(
+                    model_name=model_name,
+                    system_instruction=system_instruction,
+                    contents=[Content(role="user", parts=[self.img_part])],
+                    ttl=CONTEXT_CACHE_TTL,
+                )
+                self.chat = GenerativeModel.from_cached_content(cached_content=self.cached_content).start_chat()
+            except Exception as e:
+                print(f"컨텍스트 캐시 생성 실패, chat 모드로 진행합니다: {str(e)}")
+                self.mode = "chat"
+        if self.mode == "chat":
+            self.chat = GenerativeModel(model_name, system_instruction=system_instruction).start_chat()
+        elif self.mode == "resend":
+            self.model = GenerativeModel(model_name)
+            self.contents = build_contents(image_data)
+
+    def prefix_tokens(self):
+        """컨텍스트 캐시에 올릴 시스템 지침 + 이미지의 토큰 수 (세지 못하면 None)"""
+        try:
+            model = GenerativeModel(self.model_name, system_instruction=system_instruction)
+            return model.count_tokens([self.img_part]).total_tokens
+        except Exception as e:
+            print(f"토큰 수 확인 실패: {str(e)}")
+            return None
+
+    def cache_params(self):
+        """응답 캐시 키에 넣을 파라미터 (chat/cached는 모델이 받는 대화가 같으므로 같은 키 사용)"""
+        return dict(GENERATION_PARAMS, conversation_mode="resend" if self.mode == "resend" else "chat")
+
+    def message(self, question_part):
+        """이번 턴에 보낼 메시지 (chat 모드의 첫 턴에만 이미지 포함)"""
+        if self.mode == "chat" and self.first_turn:
+            return [self.img_part, question_part]
+        return question_part
+
+    def send(self, question_part):
+        """새 질문을 보내고 응답 반환 (실패하면 대화 기록이 바뀌지 않으므로 그대로 다시 보낼 수 있음)"""
+        if self.mode == "resend":
+            response = self.model.generate_content(self.contents + [question_part], generation_config=self.generation_config)
+            self.contents.append(question_part)
+        else:
+            response = self.chat.send_message(self.message(question_part), generation_config=self.generation_config)
+        self.first_turn = False
+        return response
+
+    async def send_async(self, question_part):
+        """send의 비동기 버전"""
+        if self.mode == "resend":
+            response = await self.model.generate_content_async(self.contents + [question_part], generation_config=self.generation_config)
+            self.contents.append(question_part)
+        else:
+            response = await self.chat.send_message_async(self.message(question_part), generation_config=self.generation_config)
+        self.first_turn = False
+        return response
+
+    def record(self, question_part, text):
+        """응답 캐시에서 가져온 턴을 모델 호출 없이 대화 기록에 추가"""
+        if self.mode == "resend":
+            self.contents.append(question_part)
+        else:
+            message = self.message(question_part)
+            parts = [part if isinstance(part, Part) else Part.from_text(part)
+                     for part in (message if isinstance(message, list) else [message])]
+            self.chat.history.extend([
+                Content(role="user", parts=parts),
+                Content(role="model", parts=[Part.from_text(text)]),
+            ])
+        self.first_turn = False
+
+    def close(self):
+        """컨텍스트 캐시 삭제"""
+        if self.cached_content is not None:
+            try:
+                self.cached_content.delete()
+            except Exception as e:
+                print(f"컨텍스트 캐시 삭제 실패: {str(e)}")
 
-def load_questions(filepath):
-    """질문 텍스트 파일을 읽어 리스트로 반환하는 함수 (각 줄 하나의 질문)"""
-    questions = []
-    with open(filepath, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                questions.append(line)
-    return questions
+def print_throughput(latencies, elapsed, num_jobs):
+    """전체 소요 시간 대비 처리량(jobs/sec)과 턴별 지연 시간을 출력하는 함수"""
+    if not latencies:
+        return
+    print(f"대화 수: {num_jobs} / 턴 수: {len(latencies)} / 전체 소요 시간: {elapsed:.2f}초 / 처리량: {num_jobs / elapsed:.2f} jobs/sec")
+    print(f"턴별 지연 시간 - 평균: {sum(latencies) / len(latencies):.2f}초 / 최소: {min(latencies):.2f}초 / 최대: {max(latencies):.2f}초 / 합계: {sum(latencies):.2f}초")
+
+def print_turn_usage(rows):
+    """턴 번호별 평균 입력/캐시/출력 토큰 수와 지연 시간을 출력하는 함수 (응답 캐시에서 가져온 턴 제외)"""
+    by_turn = {}
+    for row in rows:
+        if not row["cached"]:
+            by_turn.setdefault(row["turn"], []).append(row)
+    for turn, turn_rows in sorted(by_turn.items()):
+        n = len(turn_rows)
+        print(f"턴 {turn} - 입력 토큰: {sum(r['prompt_tokens'] for r in turn_rows) / n:.0f} / "
+              f"캐시 토큰: {sum(r['cached_tokens'] for r in turn_rows) / n:.0f} / "
+              f"출력 토큰: {sum(r['output_tokens'] for r in turn_rows) / n:.0f} / "
+              f"지연 시간: {sum(r['inference_time'] for r in turn_rows) / n:.2f}초")
+
+def is_conversation_done(writer, model_name, image_path, turns):
+    """대화의 모든 턴이 이미 기록되었는지 확인"""
+    return all(writer.is_done(model=model_name, image=os.path.basename(image_path), turn=turn_idx)
+               for turn_idx in range(1, len(turns) + 1))
+
+def timed_send(conversation, question_part):
+    """턴 하나를 보내고 (응답, 소요 시간) 반환"""
+    start_time = time.perf_counter()
+    response = conversation.send(question_part)
+    return response, time.perf_counter() - start_time
+
+async def timed_send_async(conversation, question_part):
+    """timed_send의 비동기 버전"""
+    start_time = time.perf_counter()
+    response = await conversation.send_async(question_part)
+    return response, time.perf_counter() - start_time
+
+def response_tokens(result):
+    """(응답, 소요 시간) 결과에서 입력+출력 토큰 수 계산 (TPM 한도 차감용)"""
+    return result[0].usage_metadata.total_token_count
+
+def turn_row(conversation, image_path, turn_idx, question, text, inference_time, usage, stats=None):
+    """결과 파일에 기록할 턴 행 구성 (usage가 None이면 응답 캐시에서 가져온 턴)"""
+    return dict({
+        "model": conversation.model_name,
+        "image": os.path.basename(image_path),
+        "turn": turn_idx,
+        "question": question,
+        "response": text,
+        "inference_time": inference_time,
+        "cached": usage is None,
+        "conversation_mode": conversation.mode,
+    }, **(usage or {"prompt_tokens": None, "cached_tokens": None, "output_tokens": None}), **stats_columns(stats))
+
+def error_row(model_name, image_path, turn_idx, question, error):
+    """실패한 턴의 결과 행 (평균이 왜곡되지 않도록 inference_time은 비움)"""
+    return {
+        "model": model_name,
+        "image": os.path.basename(image_path),
+        "turn": turn_idx,
+        "question": question,
+        "response": f"Error: {str(error)}",
+        "cached": False,
+        "error": str(error) or type(error).__name__,
+    }
 
 def run_tests():
-    
-    image_files = sorted(os.listdir(os.path.join("data", "images")), 
-                key=lambda x: int(''.join(filter(str.isdigit, x))))
-    # print(image_files)
-    if not image_files:
-        print("이미지 파일을 찾을 수 없습니다. data/images/ 폴더를 확인하세요.")
-        return
+    # Vertex AI 초기화 (실행당 한 번)
+    vertexai.init(project=project_id, location=location)
 
-    questions = load_questions(os.path.join("data", "questions.txt"))
-    
-    if not questions:
-        print("질문 파일에 내용이 없습니다. data/questions.txt 파일을 확인하세요.")
+    jobs = load_jobs()
+    if not jobs:
         return
 
-    results = []
+    cache = ResponseCache()
+    writer = ResultWriter(RESULTS_FILE, RESULT_FIELDS, key_fields=["model", "image", "turn"])
+    scheduler = Scheduler(RATE_LIMITS, max_retries=MAX_RETRIES)
+    preprocessor = PreprocessCache() if PREPROCESS else None
 
-    # 모델, 이미지, 질문별로 테스트 실행
-    for model in MODELS_TO_TEST:
-        
-        for image_path, question in zip(image_files, questions):
-            
-            # Vertex AI 초기화
-            vertexai.init(project=project_id, location=location)
+    latencies = []
+    turn_rows = []
+    num_jobs = 0
+    sweep_start = time.perf_counter()
 
-            # Gemini Pro Vision 모델 로드
-            model = GenerativeModel("gemini-pro-vision")
-            
-            turns = question.split('|')
-            if len(turns) != 3:
-                print(f"잘못된 질문 형식: {question_line}")
+    # 모델, 이미지, 질문별로 테스트 실행
+    for model_name in MODELS_TO_TEST:
+        for image_path, question, turns in jobs:
+            if is_conversation_done(writer, model_name, image_path, turns):
                 continue
-            
-            image_data = encode_image_to_binary(os.path.join("data", "images", image_path))
-            print(f"모델: {model} / 이미지: {os.path.basename(image_path)} / 질문: {question}")        
+            num_jobs += 1
+
+            image_data = load_image(preprocessor, image_path, model_name)
+            print(f"모델: {model_name} / 이미지: {os.path.basename(image_path)} / 질문: {question}")        
         
+            conversation = None
+            turn_idx = 1
             try:
-                # 이미지를 Gemini 모델에 전달할 수 있는 형태로 변환
-                img_part = Part.from_data(data=image_data, mime_type="image/jpeg")  # 이미지 형식에 맞게 변경
-
-                # Generation config 설정
-                generation_config = GenerationConfig(temperature=0.2, top_p=1, top_k=32)
-
-                contents = []
-
-                if system_instruction:
-                    contents.append(system_instruction)
-
-                contents.append(img_part)
-    
-                print(f"이미지: {os.path.basename(image_path)} 와의 대화를 시작합니다.")
+                conversation = Conversation(model_name, image_data)
+                print(f"이미지: {os.path.basename(image_path)} 와의 대화를 시작합니다. (방식: {conversation.mode})")
                 
-                question_parts = turns
-                print(question_parts)
-                turn_idx = 1
-                for question_part in question_parts:
+                history = []
+                for question_part in turns:
                     question_part = question_part.strip()
-                    if question_part:
-                        contents.append(question_part)
-
-                        start_time = time.time()
-                    print(question_part)
-                    response = model.generate_content(
-                        contents,
-                        generation_config=generation_config,
-                    )
-
-                    inference_time = round(time.time() - start_time, 2)
-                    text = response.text
+                    history.append(question_part)
+
+                    # 턴별 캐시 키는 지금까지의 대화 전체를 포함
+                    cache_key = cache.make_key(model_name, image_data, history, system_instruction, conversation.cache_params())
+                    cached = cache.get(cache_key)
+                    usage = None
+                    stats = None
+                    if cached is not None:
+                        text, inference_time = cached
+                        conversation.record(question_part, text)
+                    else:
+                        # 한도 대기와 일시적 오류 재시도는 scheduler가 처리 (inference_time은 성공한 호출의 시간)
+                        (response, elapsed), stats = scheduler.call(
+                            model_name, lambda: timed_send(conversation, question_part),
+                            count_tokens=response_tokens, hedge=False)
+                        inference_time = round(elapsed, 2)
+                        text = response.text
+                        usage = usage_counts(response)
+                        cache.put(cache_key, model_name, text, inference_time)
                     print(f"질문: {question_part}")
                     print(f"답변: {text} (응답 시간: {inference_time}초)")
-                    # print(text)
                     
-                    results.append({
-                        "model": model,
-                        "image": os.path.basename(image_path),
-                        "turn": turn_idx,
-                        "question": question,
-                        "response": text,
-                        "inference_time": inference_time
-                    })
+                    latencies.append(inference_time)
+                    row = turn_row(conversation, image_path, turn_idx, question, text, inference_time, usage, stats)
+                    turn_rows.append(row)
+                    # 이어서 실행하는 대화는 이미 기록된 턴을 다시 쓰지 않음
+                    if not writer.is_done(model=model_name, image=os.path.basename(image_path), turn=turn_idx):
+                        writer.write(row)
                     
                     turn_idx += 1
 
             except Exception as e:
+                # 실패한 턴은 error를 채워 기록하고 남은 턴을 건너뛰어 다음 대화로 진행 (재실행 시 이 실행을 이어서 다시 시도)
                 print(f"Error: {str(e)}")
-                return None
-            
+                writer.write(error_row(model_name, image_path, turn_idx, question, e))
+                continue
+            finally:
+                if conversation is not None:
+                    conversation.close()
             
+    print_throughput(latencies, time.perf_counter() - sweep_start, num_jobs)
+    print_turn_usage(turn_rows)
+    if preprocessor is not None:
+        preprocessor.report()
+    cache.report()
+    cache.close()
+    writer.close()
+
+async def run_tests_async(max_concurrency=MAX_CONCURRENCY):
+    """이미지별 대화를 asyncio로 동시에 진행하는 실행 모드 (대화 안의 턴은 순서대로 요청)"""
+    # Vertex AI 초기화 (실행당 한 번)
+    vertexai.init(project=project_id, location=location)
+
+    jobs = load_jobs()
+    if not jobs:
+        return
 
-    # 결과를 CSV 파일로 저장 (한 파일에 모든 결과가 기록됨)
-    csv_file = "test_results.csv"
-    with open(csv_file, mode='w', newline='', encoding='utf-8-sig') as f:
-        writer = csv.DictWriter(f, fieldnames=["model", "image", "turn", "question", "response","inference_time"])
-        writer.writeheader()
-        writer.writerows(results)
+    cache = ResponseCache()
+    writer = ResultWriter(RESULTS_FILE, RESULT_FIELDS, key_fields=["model", "image", "turn"])
+    semaphore = asyncio.Semaphore(max_concurrency)
+    scheduler = Scheduler(RATE_LIMITS, max_retries=MAX_RETRIES)
+    preprocessor = PreprocessCache() if PREPROCESS else None
+    latencies = []
+    turn_rows = []
+
+    async def run_conversation(model_name, image_path, question, turns):
+        image_data = load_image(preprocessor, image_path, model_name)
+
+        # 대화 하나가 세마포어 슬롯 하나를 차지하고, 턴은 이전 턴이 끝난 뒤에 요청
+        async with semaphore:
+            conversation = None
+            turn_idx = 1
+            try:
+                # 컨텍스트 캐시 생성은 동기 API이므로 스레드에서 실행
+                conversation = await asyncio.to_thread(Conversation, model_name, image_data)
+                print(f"모델: {model_name} / 이미지: {os.path.basename(image_path)} 와의 대화를 시작합니다. (방식: {conversation.mode})")
+                history = []
+                for question_part in turns:
+                    question_part = question_part.strip()
+                    history.append(question_part)
+
+                    # 턴별 캐시 키는 지금까지의 대화 전체를 포함
+                    cache_key = cache.make_key(model_name, image_data, history, system_instruction, conversation.cache_params())
+                    cached = cache.get(cache_key)
+                    usage = None
+                    stats = None
+                    if cached is not None:
+                        text, inference_time = cached
+                        conversation.record(question_part, text)
+                    else:
+                        (response, elapsed), stats = await scheduler.call_async(
+                            model_name, lambda: timed_send_async(conversation, question_part),
+                            count_tokens=response_tokens, hedge=False)
+                        inference_time = round(elapsed, 2)
+                        text = response.text
+                        usage = usage_counts(response)
+                        cache.put(cache_key, model_name, text, inference_time)
+
+                    latencies.append(inference_time)
+                    row = turn_row(conversation, image_path, turn_idx, question, text, inference_time, usage, stats)
+                    turn_rows.append(row)
+                    if not writer.is_done(model=model_name, image=os.path.basename(image_path), turn=turn_idx):
+                        writer.write(row)
+                    turn_idx += 1
+            except Exception as e:
+                # 실패한 턴은 error를 채워 기록하고 남은 턴은 건너뜀 (재실행 시 이 실행을 이어서 다시 시도)
+                print(f"Error: {str(e)}")
+                writer.write(error_row(model_name, image_path, turn_idx, question, e))
+            finally:
+                if conversation is not None:
+                    await asyncio.to_thread(conversation.close)
+
+    tasks = []
+    for model_name in MODELS_TO_TEST:
+        for image_path, question, turns in jobs:
+            if is_conversation_done(writer, model_name, image_path, turns):
+                continue
+            tasks.append(run_conversation(model_name, image_path, question, turns))
+
+    sweep_start = time.perf_counter()
+    outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - sweep_start
 
-    print(f"테스트 결과가 {csv_file} 파일에 저장되었습니다.")
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            print(f"Error: {str(outcome)}")
+
+    print_throughput(latencies, elapsed, len(tasks))
+    print_turn_usage(turn_rows)
+    if preprocessor is not None:
+        preprocessor.report()
+    cache.report()
+    cache.close()
+    writer.close()
 
 
 # In[ ]:
@@ -221,7 +520,10 @@ if __name__ == '__main__':
         delete_folder(folder_to_delete)
     else:
         print(f"폴더 '{folder_to_delete}'가 존재하지 않습니다.")
-    run_tests()
+    if USE_ASYNC:
+        asyncio.run(run_tests_async())
+    else:
+        run_tests()
 
 
 # In[ ]:
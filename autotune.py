@@ -0,0 +1,263 @@
+import os
+import re
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from dotenv import load_dotenv
+from backends import create_backend
+from benchmark import TASKS, run_job
+from benchmark_utils import IMAGES_DIR, list_image_files
+from image_preprocess import PreprocessCache, profile_for, profile_path
+from result_writer import ResultWriter
+
+
+REFERENCE_FILE = os.path.join("results", "Correct_Answer.csv")
+RESULTS_FILE = os.path.join("results", "autotune_results.jsonl")
+SUMMARY_FILE = os.path.join("results", "autotune_summary.csv")
+PLOTS_DIR = os.path.join("results", "autotune")
+
+# 탐색할 픽셀 예산(가로x세로)과 JPEG 품질
+MAX_PIXELS_GRID = [320 * 320, 448 * 448, 640 * 640, 768 * 768, 1024 * 1024]
+QUALITY_GRID = [50, 70, 85, 95]
+# 원본 이미지 대비 허용할 정확도 손실 (0.02면 2%p)
+MAX_ACCURACY_LOSS = 0.02
+# 가장 싼 설정을 고를 기준 (vision_tokens: 추정 비전 토큰 / image_bytes: 전송 크기 / latency: 지연 시간)
+COST_FIELD = "vision_tokens"
+
+RESULT_FIELDS = ["target", "model", "setting", "max_pixels", "quality", "image", "response", "accuracy",
+                 "latency", "image_bytes", "vision_tokens", "prompt_tokens", "output_tokens", "error"]
+
+EMAIL_PATTERN = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+PHONE_PATTERN = re.compile(r'\+?\d[\d\s().-]{5,}\d')
+
+def key_values(text):
+    """텍스트에 나오는 이메일(소문자)과 전화번호(숫자만, +82는 0으로) 집합 (잘못 읽기 쉬운 값만 비교)"""
+    text = text or ''
+    values = {email.lower() for email in EMAIL_PATTERN.findall(text)}
+    for phone in PHONE_PATTERN.findall(text):
+        digits = re.sub(r'\D', '', phone)
+        if digits.startswith('82') and len(digits) >= 11:
+            digits = '0' + digits[2:]
+        if len(digits) >= 7:
+            values.add(digits)
+    return values
+
+def field_accuracy(reference, response):
+    """정답에 나오는 전화번호/이메일 중 응답에도 그대로 나오는 비율 (정답에 값이 없으면 None)"""
+    expected = key_values(reference)
+    if not expected:
+        return None
+    return len(expected & key_values(response)) / len(expected)
+
+def load_references(reference_file, image_files):
+    """{이미지 이름: 정답 텍스트} (image 컬럼이 없으면 이미지 번호 순서와 행 순서로 맞춤)"""
+    if not os.path.exists(reference_file):
+        raise FileNotFoundError(
+            f"정답 파일 {reference_file}이 없습니다. 명함마다 전화번호/이메일이 들어 있는 정답 텍스트를 response 컬럼에 "
+            f"(이미지 번호 순서대로, 또는 image 컬럼에 파일명과 함께) 적은 CSV를 만들거나 --reference로 다른 파일을 지정하세요.")
+    df_ans = pd.read_csv(reference_file)
+    texts = ["" if pd.isna(text) else str(text) for text in df_ans.response]
+    if "image" in df_ans.columns:
+        return dict(zip(df_ans.image, texts))
+    return dict(zip(image_files, texts))
+
+def settings_grid(max_pixels_grid, quality_grid):
+    """탐색할 설정 목록 (첫 번째는 전처리하지 않은 원본)"""
+    settings = [{"setting": "original", "max_pixels": None, "quality": None}]
+    for max_pixels in max_pixels_grid:
+        for quality in quality_grid:
+            settings.append({"setting": f"{max_pixels}px@q{quality}", "max_pixels": max_pixels, "quality": quality})
+    return settings
+
+def run_setting(backend, target, setting, images, references, concurrency, writer, preprocessor, images_dir, task):
+    """설정 하나로 모든 이미지를 추출하고 결과 행 기록 (원본 설정은 전처리 없이 전송)"""
+    profile = None
+    if setting["max_pixels"] is not None:
+        profile = dict(profile_for(backend.model), max_pixels=setting["max_pixels"], quality=setting["quality"])
+    pending = [image for image in images if not writer.is_done(target=target, setting=setting["setting"], image=image)]
+    if not pending:
+        return
+    print(f"{target} - {setting['setting']}: 이미지 {len(pending)}장")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_job, backend, image, TASKS[task]["prompt"], images_dir, False, task,
+                                   preprocessor if profile else None, profile) for image in pending]
+        for image, future in zip(pending, futures):
+            row = future.result()
+            writer.write(dict(
+                {field: row.get(field) for field in RESULT_FIELDS if field in row},
+                target=target, setting=setting["setting"], max_pixels=setting["max_pixels"], quality=setting["quality"],
+                accuracy=None if row.get("error") else field_accuracy(references[image], row.get("response")),
+            ))
+
+def summarize_sweep(rows):
+    """설정별 평균 정확도, 지연 시간, 전송 크기, 비전/입력 토큰 수와 오류율"""
+    df = pd.DataFrame(rows).reindex(columns=RESULT_FIELDS)
+    df["failed"] = df["error"].fillna('').astype(str) != ''
+    ok = df[~df.failed]
+    summary = ok.groupby("setting", sort=False).agg(
+        max_pixels=("max_pixels", "first"),
+        quality=("quality", "first"),
+        accuracy=("accuracy", "mean"),
+        latency=("latency", "mean"),
+        image_bytes=("image_bytes", "mean"),
+        vision_tokens=("vision_tokens", "mean"),
+        prompt_tokens=("prompt_tokens", "mean"),
+    )
+    summary["error_rate"] = df.groupby("setting", sort=False).failed.mean()
+    return summary
+
+def choose_setting(summary, max_loss=MAX_ACCURACY_LOSS, cost_field=COST_FIELD):
+    """원본 대비 정확도 손실이 max_loss 이하인 설정 중 cost_field가 가장 작은 설정 이름 (없으면 None)"""
+    if "original" not in summary.index or pd.isna(summary.loc["original", "accuracy"]):
+        return None
+    baseline = summary.loc["original", "accuracy"]
+    candidates = summary.drop(index="original")
+    candidates = candidates[(candidates.accuracy >= baseline - max_loss) & (candidates.error_rate == 0)]
+    if candidates.empty:
+        return None
+    return candidates.sort_values([cost_field, "accuracy"], ascending=[True, False]).index[0]
+
+def save_profile(model, summary, chosen, max_loss, cost_field):
+    """고른 설정을 profiles/<모델>.json에 저장 (전처리 캐시/실행 스크립트가 profile_for로 읽음)"""
+    row = summary.loc[chosen]
+    path = profile_path(model)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({
+            "model": model,
+            "profile": {"max_pixels": int(row.max_pixels), "quality": int(row.quality)},
+            "accuracy": float(row.accuracy),
+            "baseline_accuracy": float(summary.loc["original", "accuracy"]),
+            "max_accuracy_loss": max_loss,
+            "cost_field": cost_field,
+            "latency": float(row.latency),
+            "image_bytes": float(row.image_bytes),
+            "vision_tokens": float(row.vision_tokens),
+            "created_at": time.strftime('%Y-%m-%d %H:%M:%S'),
+        }, f, ensure_ascii=False, indent=2)
+    return path
+
+def plot_sweep(summary, target, chosen, path):
+    """설정별 정확도를 지연 시간/전송 크기에 대해 그린 그래프 저장 (품질별 선, 원본은 별, 고른 설정은 빨간 원)"""
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib이 없어 그래프를 건너뜁니다: pip install matplotlib")
+        return None
+
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+    for ax, x_field, x_label, scale in ((axes[0], "latency", "latency (s)", 1),
+                                         (axes[1], "image_bytes", "payload (KB)", 1 / 1024)):
+        grid = summary.drop(index="original", errors="ignore")
+        for quality, group in grid.groupby("quality"):
+            group = group.sort_values("max_pixels")
+            ax.plot(group[x_field] * scale, group.accuracy, marker='o', label=f"q{int(quality)}")
+        if "original" in summary.index:
+            ax.scatter(summary.loc["original", x_field] * scale, summary.loc["original", "accuracy"],
+                       marker='*', s=200, color='black', label="original")
+        if chosen is not None:
+            ax.scatter(summary.loc[chosen, x_field] * scale, summary.loc[chosen, "accuracy"],
+                       s=200, facecolors='none', edgecolors='red', linewidths=2, label=f"chosen ({chosen})")
+        ax.set_xlabel(x_label)
+        ax.set_ylabel("phone/email accuracy")
+        ax.grid(True, alpha=0.3)
+        ax.legend(fontsize=8)
+    fig.suptitle(target)
+    fig.tight_layout()
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    fig.savefig(path, dpi=120)
+    plt.close(fig)
+    return path
+
+def autotune(targets, max_pixels_grid=MAX_PIXELS_GRID, quality_grid=QUALITY_GRID, max_loss=MAX_ACCURACY_LOSS,
+             cost_field=COST_FIELD, task="extract-json", concurrency=4, limit=None, images_dir=IMAGES_DIR,
+             reference_file=REFERENCE_FILE, results_file=RESULTS_FILE, summary_file=SUMMARY_FILE, save=True):
+    """대상(백엔드:모델)마다 설정 격자를 탐색하고, 허용 손실 안에서 가장 싼 설정을 모델 프로필로 저장"""
+    image_files = list_image_files(images_dir)
+    try:
+        references = load_references(reference_file, image_files)
+    except FileNotFoundError as e:
+        print(str(e))
+        return None
+    # 정답에 전화번호/이메일이 있는 이미지만 사용
+    images = [image for image in image_files if key_values(references.get(image))]
+    if limit:
+        images = images[:limit]
+    if not images:
+        print(f"{reference_file}에서 전화번호/이메일이 있는 정답을 찾을 수 없습니다.")
+        return None
+
+    settings = settings_grid(max_pixels_grid, quality_grid)
+    writer = ResultWriter(results_file, RESULT_FIELDS, key_fields=["target", "setting", "image"])
+    preprocessor = PreprocessCache()
+    summaries = []
+    for target in targets:
+        backend = create_backend(target)
+        try:
+            backend.setup()
+        except Exception as e:
+            print(f"{target} 준비 실패, 건너뜀: {str(e)}")
+            continue
+        workers = min(concurrency, backend.max_concurrency) if backend.max_concurrency is not None else concurrency
+        try:
+            for setting in settings:
+                run_setting(backend, target, setting, images, references, workers, writer, preprocessor, images_dir, task)
+        finally:
+            backend.close()
+
+        # 이어서 실행한 경우에도 이번 실행 ID의 전체 결과로 요약
+        rows = [row for row in writer.read_rows() if row.get("run_id") == writer.run_id and row.get("target") == target]
+        summary = summarize_sweep(rows)
+        chosen = choose_setting(summary, max_loss, cost_field)
+        print(f"\n{target}\n{summary.round(3).to_string()}")
+        if chosen is None:
+            print(f"원본 대비 정확도 손실 {max_loss:.0%}p 이내인 설정이 없습니다. 프로필을 저장하지 않습니다.")
+        else:
+            print(f"선택: {chosen} (정확도 {summary.loc[chosen, 'accuracy']:.3f} / 원본 {summary.loc['original', 'accuracy']:.3f})")
+            if save:
+                print(f"프로필 저장: {save_profile(backend.model, summary, chosen, max_loss, cost_field)}")
+        plot_path = plot_sweep(summary, target, chosen, os.path.join(PLOTS_DIR, re.sub(r'[^\w.-]', '_', target) + ".png"))
+        if plot_path:
+            print(f"그래프 저장: {plot_path}")
+        summaries.append(summary.assign(target=target, chosen=summary.index == chosen))
+    writer.close()
+    preprocessor.report()
+
+    if not summaries:
+        return None
+    df_summary = pd.concat(summaries).reset_index().set_index(["target", "setting"])
+    if os.path.dirname(summary_file):
+        os.makedirs(os.path.dirname(summary_file), exist_ok=True)
+    df_summary.to_csv(summary_file, encoding='utf-8-sig')
+    print(f"\n요약 표가 {summary_file} 파일에 저장되었습니다.")
+    return df_summary
+
+if __name__ == '__main__':
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="픽셀 예산 x JPEG 품질 격자로 추출 정확도/지연 시간/전송 크기를 비교하고 모델별 전처리 프로필 저장")
+    parser.add_argument('--targets', nargs='+', required=True,
+                        help="백엔드:모델 목록 (예: gemini:gemini-2.0-flash ollama:llama3.2-vision qwen:Qwen/Qwen2.5-VL-3B-Instruct)")
+    parser.add_argument('--max-pixels', type=int, nargs='+', default=MAX_PIXELS_GRID, help="탐색할 픽셀 예산 (가로x세로)")
+    parser.add_argument('--qualities', type=int, nargs='+', default=QUALITY_GRID, help="탐색할 JPEG 품질")
+    parser.add_argument('--max-loss', type=float, default=MAX_ACCURACY_LOSS, help="원본 대비 허용할 정확도 손실 (0.02 = 2%%p)")
+    parser.add_argument('--cost', choices=["vision_tokens", "image_bytes", "latency"], default=COST_FIELD,
+                        help="가장 싼 설정을 고를 기준")
+    parser.add_argument('--task', choices=["extract-json", "extract-free"], default="extract-json", help="추출 방식")
+    parser.add_argument('--concurrency', type=int, default=4, help="동시에 보낼 최대 요청 수 (백엔드 한도를 넘지 않음)")
+    parser.add_argument('--limit', type=int, default=None, help="사용할 이미지 수")
+    parser.add_argument('--images', default=IMAGES_DIR, help="이미지 폴더")
+    parser.add_argument('--reference', default=REFERENCE_FILE, help="정답 CSV 파일 (response 컬럼, 선택적으로 image 컬럼)")
+    parser.add_argument('--output', default=RESULTS_FILE, help="설정/이미지별 결과 파일 (.jsonl 또는 .csv)")
+    parser.add_argument('--summary', default=SUMMARY_FILE, help="설정별 요약 CSV 파일")
+    parser.add_argument('--no-save', action='store_true', help="프로필 파일을 저장하지 않음")
+    args = parser.parse_args()
+
+    autotune(args.targets, args.max_pixels, args.qualities, args.max_loss, args.cost, args.task, args.concurrency,
+             args.limit, args.images, args.reference, args.output, args.summary, not args.no_save)
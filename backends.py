@@ -0,0 +1,364 @@
+import os
+import time
+import random
+import json
+import threading
+from structured_output import CONTACT_SCHEMA
+from image_preprocess import detect_mime_type
+
+
+class Backend:
+    """벤치마크용 모델 백엔드 인터페이스
+
+    setup()에서 클라이언트/모델을 준비하고, generate()는 이미지 하나와 질문 하나로 응답을 생성해
+    {"text", "prompt_tokens", "output_tokens"} 딕셔너리를 반환합니다 (토큰 수를 알 수 없으면 None).
+    stream()은 같은 입력으로 응답 조각을 생성되는 대로 {"text": 조각} 딕셔너리로 내보내며,
+    토큰 수를 알게 되면 해당 청크에 prompt_tokens / output_tokens를 함께 담습니다.
+    generate_json()은 백엔드의 구조화 출력 기능으로 CONTACT_SCHEMA 형식의 JSON만 생성합니다 (반환 형식은 generate와 같음).
+    max_concurrency는 백엔드가 동시에 처리할 수 있는 최대 요청 수입니다 (None이면 제한 없음).
+    """
+    name = "base"
+    max_concurrency = None
+
+    def __init__(self, model):
+        self.model = model
+
+    def setup(self):
+        pass
+
+    def generate(self, image_path, image_data, question):
+        raise NotImplementedError
+
+    def stream(self, image_path, image_data, question):
+        """스트리밍을 지원하지 않는 백엔드는 전체 응답을 한 청크로 반환"""
+        yield self.generate(image_path, image_data, question)
+
+    def generate_json(self, image_path, image_data, prompt):
+        raise NotImplementedError(f"{self.name} 백엔드는 구조화 출력을 지원하지 않습니다.")
+
+    def close(self):
+        pass
+
+class HostPool:
+    """호스트별 Client를 유지하고, 진행 중인 요청이 가장 적은 호스트로 작업을 배분하는 클래스"""
+    def __init__(self, hosts, keep_alive='30m'):
+        from ollama import Client
+
+        self.keep_alive = keep_alive
+        # Client는 내부에 연결 풀을 가지므로 호스트당 하나만 만들어 재사용
+        self.clients = {host: Client(host=host) for host in hosts}
+        self.outstanding = {host: 0 for host in hosts}
+        self.completed = {host: 0 for host in hosts}
+        self.failed = {host: 0 for host in hosts}
+        self.busy_time = {host: 0.0 for host in hosts}
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """진행 중인 요청이 가장 적은 호스트를 골라 요청 수를 올리고 반환"""
+        with self.lock:
+            host = min(self.outstanding, key=lambda h: (self.outstanding[h], self.completed[h]))
+            self.outstanding[host] += 1
+            return host
+
+    def release(self, host, elapsed, ok):
+        """요청이 끝난 호스트의 진행 중 요청 수를 내리고 통계를 기록"""
+        with self.lock:
+            self.outstanding[host] -= 1
+            self.busy_time[host] += elapsed
+            if ok:
+                self.completed[host] += 1
+            else:
+                self.failed[host] += 1
+
+    def chat(self, **kwargs):
+        """가장 한가한 호스트로 chat 요청을 보내고 (응답, 호스트, 소요 시간)을 반환"""
+        host = self.acquire()
+        start_time = time.perf_counter()
+        ok = False
+        try:
+            response = self.clients[host].chat(keep_alive=self.keep_alive, **kwargs)
+            ok = True
+            return response, host, time.perf_counter() - start_time
+        finally:
+            self.release(host, time.perf_counter() - start_time, ok)
+
+    def chat_stream(self, **kwargs):
+        """가장 한가한 호스트로 stream=True chat 요청을 보내고 응답 청크를 받는 대로 반환 (스트림이 끝나야 호스트 반환)"""
+        host = self.acquire()
+        start_time = time.perf_counter()
+        ok = False
+        try:
+            yield from self.clients[host].chat(keep_alive=self.keep_alive, stream=True, **kwargs)
+            ok = True
+        finally:
+            self.release(host, time.perf_counter() - start_time, ok)
+
+    def warm_up(self, model):
+        """모든 호스트에 모델을 미리 로드 (빈 프롬프트 요청은 모델만 메모리에 올림)"""
+        for host, client in self.clients.items():
+            try:
+                client.generate(model=model, prompt='', keep_alive=self.keep_alive)
+            except Exception as e:
+                print(f"{host} 모델 사전 로드 실패: {str(e)}")
+
+    def report(self, elapsed):
+        """호스트별 처리량과 평균 지연 시간을 출력"""
+        print(f"\n전체 소요 시간: {elapsed:.2f}초")
+        for host in self.clients:
+            done = self.completed[host]
+            avg_latency = self.busy_time[host] / max(done + self.failed[host], 1)
+            print(f"{host} - 완료: {done} / 실패: {self.failed[host]} / "
+                  f"처리량: {done / elapsed if elapsed > 0 else 0.0:.2f} req/sec / 평균 지연 시간: {avg_latency:.2f}초")
+
+class GeminiBackend(Backend):
+    """Vertex AI Gemini 백엔드 (GOOGLE_CLOUD_PROJECT / GOOGLE_CLOUD_LOCATION 환경 변수 사용)"""
+    name = "gemini"
+    max_concurrency = 8
+
+    def __init__(self, model, params=None):
+        super().__init__(model)
+        self.params = params or {"temperature": 0.2, "top_p": 1, "top_k": 32}
+
+    def setup(self):
+        import vertexai
+        from vertexai.generative_models import GenerativeModel, GenerationConfig
+
+        vertexai.init(project=os.getenv('GOOGLE_CLOUD_PROJECT'), location=os.getenv('GOOGLE_CLOUD_LOCATION'))
+        self.client = GenerativeModel(self.model)
+        self.generation_config = GenerationConfig(**self.params)
+        self.json_config = GenerationConfig(**self.params, response_mime_type="application/json",
+                                            response_schema=CONTACT_SCHEMA)
+
+    def generate(self, image_path, image_data, question, generation_config=None):
+        from vertexai.generative_models import Part
+
+        contents = [Part.from_data(data=image_data, mime_type=detect_mime_type(image_data)), question]
+        response = self.client.generate_content(contents, generation_config=generation_config or self.generation_config)
+        usage = response.usage_metadata
+        return {
+            "text": response.text,
+            "prompt_tokens": usage.prompt_token_count,
+            "output_tokens": usage.candidates_token_count,
+        }
+
+    def stream(self, image_path, image_data, question):
+        from vertexai.generative_models import Part
+
+        contents = [Part.from_data(data=image_data, mime_type=detect_mime_type(image_data)), question]
+        for response in self.client.generate_content(contents, generation_config=self.generation_config, stream=True):
+            chunk = {"text": response.text if response.candidates and response.candidates[0].content.parts else ""}
+            usage = response.usage_metadata
+            # 사용량은 마지막 청크에만 채워지는 경우가 많으므로 값이 있을 때만 전달
+            if usage.candidates_token_count:
+                chunk.update(prompt_tokens=usage.prompt_token_count, output_tokens=usage.candidates_token_count)
+            yield chunk
+
+    def generate_json(self, image_path, image_data, prompt):
+        # response_mime_type + response_schema로 스키마에 맞는 JSON만 생성
+        return self.generate(image_path, image_data, prompt, generation_config=self.json_config)
+
+class OllamaBackend(Backend):
+    """Ollama 백엔드 (HOST_URL의 여러 호스트 중 가장 한가한 호스트로 요청)"""
+    name = "ollama"
+
+    def __init__(self, model, hosts=None, options=None):
+        super().__init__(model)
+        host_url = os.getenv('HOST_URL', 'http://localhost:11434')
+        self.hosts = hosts or [host.strip() for host in host_url.split(',') if host.strip()]
+        self.options = options or {"temperature": 0.3, "top_p": 0.1, "max_tokens": 200}
+        self.max_concurrency = len(self.hosts) * 2
+
+    def setup(self):
+        self.pool = HostPool(self.hosts, keep_alive=os.getenv('KEEP_ALIVE', '30m'))
+        self.pool.warm_up(self.model)
+
+    def generate(self, image_path, image_data, question, format=None):
+        response, _, _ = self.pool.chat(
+            model=self.model,
+            messages=[{'role': 'user', 'content': question, 'images': [image_data]}],
+            options=self.options,
+            format=format,
+        )
+        return {
+            "text": response['message']['content'],
+            "prompt_tokens": response.get('prompt_eval_count'),
+            "output_tokens": response.get('eval_count'),
+        }
+
+    def stream(self, image_path, image_data, question):
+        for response in self.pool.chat_stream(
+            model=self.model,
+            messages=[{'role': 'user', 'content': question, 'images': [image_data]}],
+            options=self.options,
+        ):
+            chunk = {"text": response['message']['content']}
+            # 마지막 청크(done=True)에 토큰 수가 들어 있음
+            if response.get('done'):
+                chunk.update(prompt_tokens=response.get('prompt_eval_count'), output_tokens=response.get('eval_count'))
+            yield chunk
+
+    def generate_json(self, image_path, image_data, prompt):
+        # format에 JSON 스키마를 주면 Ollama가 문법 제한 샘플링으로 스키마에 맞는 JSON만 생성
+        return self.generate(image_path, image_data, prompt, format=CONTACT_SCHEMA)
+
+class QwenBackend(Backend):
+    """로컬 Qwen2.5-VL 백엔드 (GPU 메모리를 공유하므로 한 번에 한 요청만 처리)"""
+    name = "qwen"
+    max_concurrency = 1
+
+    def setup(self):
+        from inference_qwen_models_single_turn import QwenModel
+
+        self.qwen = QwenModel(self.model)
+        if not self.qwen.initialize():
+            raise RuntimeError(f"{self.model} 모델 초기화 실패")
+
+    def generate(self, image_path, image_data, question, prefix_allowed_tokens_fn=None):
+        text = self.qwen.generate([image_path], [question], prefix_allowed_tokens_fn=prefix_allowed_tokens_fn)[0]
+        return {
+            "text": text,
+            "prompt_tokens": None,
+            "output_tokens": len(self.qwen.processor.tokenizer(text).input_ids),
+        }
+
+    def stream(self, image_path, image_data, question):
+        # TextIteratorStreamer는 디코딩된 텍스트 조각만 주므로 출력 토큰 수는 마지막에 다시 계산
+        pieces = []
+        for piece in self.qwen.stream(image_path, question):
+            pieces.append(piece)
+            yield {"text": piece}
+        yield {"text": "", "output_tokens": len(self.qwen.processor.tokenizer("".join(pieces)).input_ids)}
+
+    def generate_json(self, image_path, image_data, prompt):
+        return self.generate(image_path, image_data, prompt, prefix_allowed_tokens_fn=self.qwen.json_prefix_allowed_tokens_fn())
+
+    def close(self):
+        self.qwen.clear()
+
+class QwenServerBackend(Backend):
+    """qwen_server.py로 띄운 상주 Qwen 서버 백엔드 (모델은 서버에 한 번만 로드되고, 동시 요청은 서버가 배치로 묶음)
+
+    서버 주소는 QWEN_SERVER_URL 환경 변수 (기본값 http://127.0.0.1:8008)
+    """
+    name = "qwen-server"
+    max_concurrency = None
+
+    def __init__(self, model, url=None, timeout=300):
+        super().__init__(model)
+        self.url = (url or os.getenv('QWEN_SERVER_URL') or "http://127.0.0.1:8008").rstrip('/')
+        self.timeout = timeout
+
+    def request(self, path, payload=None):
+        import urllib.request
+        import urllib.error
+
+        data = None if payload is None else json.dumps(payload).encode('utf-8')
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            # 서버가 돌려준 오류 메시지를 그대로 전달
+            try:
+                message = json.loads(e.read().decode('utf-8')).get('error')
+            except ValueError:
+                message = None
+            raise RuntimeError(f"Qwen 서버 오류 {e.code}: {message or e.reason}")
+
+    def setup(self):
+        health = self.request('/health')
+        if health.get("model") != self.model:
+            raise RuntimeError(f"{self.url}의 모델은 {health.get('model')}입니다 (요청: {self.model})")
+
+    def generate(self, image_path, image_data, question, json_mode=False):
+        import base64
+
+        result = self.request('/generate', {"image": base64.b64encode(image_data).decode('ascii'),
+                                            "prompt": question, "json": json_mode})
+        return {"text": result["text"], "prompt_tokens": None, "output_tokens": result.get("output_tokens")}
+
+    def generate_json(self, image_path, image_data, prompt):
+        # 서버가 CONTACT_SCHEMA 제한 디코딩으로 생성
+        return self.generate(image_path, image_data, prompt, json_mode=True)
+
+    def metrics(self):
+        return self.request('/metrics')
+
+class MockBackend(Backend):
+    """네트워크/GPU 없이 하네스를 확인하기 위한 가짜 백엔드
+
+    model 이름으로 지연 프로필을 고릅니다 (fast / slow / flaky, 그 외는 fast).
+    지연 시간은 로그 정규 분포를 따르고, flaky는 일부 요청을 실패시킵니다.
+    """
+    name = "mock"
+    PROFILES = {
+        "fast": {"median": 0.05, "sigma": 0.3, "error_rate": 0.0},
+        "slow": {"median": 0.3, "sigma": 0.5, "error_rate": 0.0},
+        "flaky": {"median": 0.1, "sigma": 0.8, "error_rate": 0.2},
+    }
+
+    def __init__(self, model, seed=None):
+        super().__init__(model)
+        self.profile = self.PROFILES.get(model, self.PROFILES["fast"])
+        self.token_delay = self.profile["median"] / 20
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        """(첫 토큰까지의 지연 시간, 실패 여부) 샘플링"""
+        with self.lock:
+            delay = self.random.lognormvariate(0, self.profile["sigma"]) * self.profile["median"]
+            failed = self.random.random() < self.profile["error_rate"]
+        return delay, failed
+
+    def generate(self, image_path, image_data, question):
+        delay, failed = self.sample()
+        time.sleep(delay)
+        if failed:
+            raise RuntimeError("mock: 요청 실패")
+        text = f"{os.path.basename(image_path)}: {question}"
+        if "<extracted_info>" in question:
+            # 자유 형식 추출 지시문이면 실제 모델처럼 대화체 문장 사이에 JSON 블록을 넣어 응답
+            contact = {field: "" for field in CONTACT_SCHEMA["required"]}
+            contact.update(name=os.path.basename(image_path), other_details=[])
+            text = ("명함 정보를 정리해 드릴게요!\n<extracted_info>\n" + json.dumps(contact, ensure_ascii=False, indent=2)
+                    + "\n</extracted_info>\n이분은 어디서 만나셨나요? 만난 장소나 상황을 알려주시면 함께 기록해 둘게요.")
+        return {"text": text, "prompt_tokens": len(question.split()), "output_tokens": len(text.split())}
+
+    def generate_json(self, image_path, image_data, prompt):
+        delay, failed = self.sample()
+        time.sleep(delay)
+        if failed:
+            raise RuntimeError("mock: 요청 실패")
+        contact = {field: "" for field in CONTACT_SCHEMA["required"]}
+        contact.update(name=os.path.basename(image_path), other_details=[])
+        text = json.dumps(contact, ensure_ascii=False)
+        return {"text": text, "prompt_tokens": len(prompt.split()), "output_tokens": len(text.split())}
+
+    def stream(self, image_path, image_data, question):
+        # 첫 단어는 prefill 지연 후, 이후 단어는 단어당 token_delay 간격으로 전송
+        delay, failed = self.sample()
+        time.sleep(delay)
+        if failed:
+            raise RuntimeError("mock: 요청 실패")
+        words = f"{os.path.basename(image_path)}: {question}".split()
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.token_delay)
+            yield {"text": word if i == 0 else " " + word}
+        yield {"text": "", "prompt_tokens": len(question.split()), "output_tokens": len(words)}
+
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "ollama": OllamaBackend,
+    "qwen": QwenBackend,
+    "qwen-server": QwenServerBackend,
+    "mock": MockBackend,
+}
+
+def create_backend(target):
+    """'백엔드:모델' 문자열로 백엔드 인스턴스 생성 (예: ollama:llama3.2-vision, mock:fast)"""
+    backend_name, _, model = target.partition(':')
+    if backend_name not in BACKENDS or not model:
+        raise ValueError(f"잘못된 대상: {target} (형식: 백엔드:모델, 백엔드: {', '.join(BACKENDS)})")
+    return BACKENDS[backend_name](model)
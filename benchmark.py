@@ -0,0 +1,197 @@
+import os
+import math
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from dotenv import load_dotenv
+from backends import create_backend
+from benchmark_utils import IMAGES_DIR, QUESTIONS_FILE, encode_image_to_binary, load_jobs, list_image_files, latency_summary, consume_stream
+from image_preprocess import PreprocessCache, describe_image
+from structured_output import FREEFORM_EXTRACTION_PROMPT, JSON_EXTRACTION_PROMPT, parse_freeform_contact, parse_json_contact
+from result_writer import ResultWriter
+
+
+# 결과 파일 (호출별 결과는 행이 끝나는 대로 추가되며 같은 실행 ID로 재실행하면 완료된 작업은 건너뜀)
+RESULTS_FILE = os.path.join("results", "benchmark_results.csv")
+SUMMARY_FILE = os.path.join("results", "benchmark_summary.csv")
+RESULT_FIELDS = ["backend", "model", "task", "image", "question", "response", "parsed", "stream", "preprocess",
+                 "image_bytes", "vision_tokens", "preprocess_time", "latency", "ttft", "inter_token_latency",
+                 "prompt_tokens", "output_tokens", "error"]
+
+# 작업 종류: qa는 질문 파일의 질문, 추출 작업은 이미지마다 명함 정보 추출 한 번
+# extract-free는 기존 대화체 지시문(<extracted_info> 블록 포함), extract-json은 백엔드의 구조화 출력(JSON 스키마) 사용
+TASKS = {
+    "qa": None,
+    "extract-free": {"prompt": FREEFORM_EXTRACTION_PROMPT, "parse": parse_freeform_contact},
+    "extract-json": {"prompt": JSON_EXTRACTION_PROMPT, "parse": parse_json_contact},
+}
+
+def load_task_jobs(task, images_dir, questions_file):
+    """작업 종류에 맞는 (이미지 경로, 질문) 목록 (추출 작업은 이미지마다 추출 지시문 하나)"""
+    if TASKS[task] is None:
+        return load_jobs(images_dir, questions_file)
+    return [(image_path, TASKS[task]["prompt"]) for image_path in list_image_files(images_dir)]
+
+def run_job(backend, image_path, question, images_dir, stream=False, task="qa", preprocessor=None, profile=None):
+    """작업 하나를 실행하고 perf_counter로 잰 지연 시간과 함께 결과 행을 반환 (예외는 error 필드에 기록)
+
+    stream이 True면 스트리밍으로 요청해 첫 토큰까지의 시간(ttft)과 토큰 간 지연 시간도 기록합니다.
+    추출 작업은 응답을 파싱해 연락처 딕셔너리를 얻었는지(parsed)도 기록하며, 파싱 시간은 지연 시간에 포함됩니다.
+    preprocessor가 있으면 모델 프로필(profile이 없으면 모델 기본 프로필)로 전처리한 이미지를 보내며, 전처리 시간(캐시 적중이면 읽는 시간)은 지연 시간과 따로 기록합니다.
+    image_bytes와 vision_tokens(이미지 크기로 추정)는 실제로 보낸 이미지 기준입니다.
+    """
+    row = {"backend": backend.name, "model": backend.model, "task": task, "image": os.path.basename(image_path),
+           "question": question if TASKS[task] is None else '', "stream": stream, "preprocess": preprocessor is not None}
+    input_path = os.path.join(images_dir, image_path)
+    try:
+        if preprocessor is not None:
+            prepare_start = time.perf_counter()
+            info = preprocessor.prepare(input_path, backend.model, profile)
+            row["preprocess_time"] = time.perf_counter() - prepare_start
+            input_path, image_data = info["path"], info["data"]
+        else:
+            image_data = encode_image_to_binary(input_path)
+            info = describe_image(image_data, backend.model)
+        row.update(image_bytes=info["bytes"], vision_tokens=info["vision_tokens"])
+    except Exception as e:
+        row["error"] = f"이미지 준비 실패: {str(e)}"
+        return row
+
+    start_time = time.perf_counter()
+    try:
+        if stream:
+            output = consume_stream(backend.stream(input_path, image_data, question), start_time)
+            row.update(ttft=output["ttft"], inter_token_latency=output["inter_token_latency"])
+        elif task == "extract-json":
+            output = backend.generate_json(input_path, image_data, question)
+        else:
+            output = backend.generate(input_path, image_data, question)
+        row.update(response=output["text"], prompt_tokens=output["prompt_tokens"], output_tokens=output["output_tokens"])
+        if TASKS[task] is not None:
+            row["parsed"] = TASKS[task]["parse"](output["text"]) is not None
+    except Exception as e:
+        row["error"] = str(e) or type(e).__name__
+    row["latency"] = time.perf_counter() - start_time
+    return row
+
+def run_target(backend, jobs, concurrency, writer, images_dir, stream=False, task="qa", preprocessor=None):
+    """한 백엔드에 전체 작업을 동시성 concurrency로 보내고 (결과 행 리스트, 전체 소요 시간) 반환"""
+    # 백엔드가 감당할 수 있는 동시 요청 수를 넘지 않도록 제한 (예: 로컬 Qwen은 1)
+    if backend.max_concurrency is not None:
+        concurrency = min(concurrency, backend.max_concurrency)
+    pending = [(image_path, question) for image_path, question in jobs
+               if not writer.is_done(backend=backend.name, model=backend.model, task=task, image=os.path.basename(image_path),
+                                stream=stream, preprocess=preprocessor is not None)]
+    print(f"\n{backend.name}:{backend.model} - {task} 작업 {len(pending)}개 / 동시성 {concurrency}"
+          + (" / 스트리밍" if stream else "") + (" / 이미지 전처리" if preprocessor is not None else ""))
+
+    rows = []
+    sweep_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_job, backend, image_path, question, images_dir, stream, task, preprocessor) for image_path, question in pending]
+        for future in futures:
+            row = future.result()
+            writer.write(row)
+            rows.append(row)
+    return rows, time.perf_counter() - sweep_start
+
+def summarize(rows, elapsed):
+    """백엔드/모델 하나의 요약: 요청 수, 오류율, 지연 시간 백분위수, 처리량(jobs/sec, tokens/sec), 추출 작업의 파싱 실패율"""
+    ok = [row for row in rows if not row.get("error")]
+    latencies = [row["latency"] for row in ok]
+    output_tokens = [row["output_tokens"] for row in ok if row.get("output_tokens") is not None]
+    summary = {
+        "requests": len(rows),
+        "errors": len(rows) - len(ok),
+        "error_rate": (len(rows) - len(ok)) / len(rows) if rows else 0.0,
+    }
+    summary.update({f"latency_{name}": value for name, value in latency_summary(latencies).items()})
+    # 스트리밍 실행이면 TTFT 백분위수와 평균 토큰 간 지연 시간 추가
+    ttfts = [row["ttft"] for row in ok if row.get("ttft") is not None and not math.isnan(row["ttft"])]
+    if ttfts:
+        summary.update({f"ttft_{name}": value for name, value in latency_summary(ttfts).items() if name != "max"})
+        inter_token = [row["inter_token_latency"] for row in ok if not math.isnan(row["inter_token_latency"])]
+        summary["inter_token_latency_mean"] = sum(inter_token) / len(inter_token) if inter_token else float('nan')
+    summary["jobs_per_sec"] = len(ok) / elapsed if elapsed > 0 else 0.0
+    # 토큰 수를 알려주는 백엔드만 tokens/sec 계산 (전체 벽시계 시간 기준 / 요청당 생성 속도)
+    summary["tokens_per_sec"] = sum(output_tokens) / elapsed if output_tokens and elapsed > 0 else float('nan')
+    summary["tokens_per_sec_per_request"] = (
+        sum(output_tokens) / sum(row["latency"] for row in ok if row.get("output_tokens") is not None)
+        if output_tokens else float('nan')
+    )
+    summary["output_tokens_mean"] = sum(output_tokens) / len(output_tokens) if output_tokens else float('nan')
+    # 보낸 이미지 크기와 비전 토큰 (--preprocess 유무로 실행해 전처리 전후 비교)
+    prompt_tokens = [row["prompt_tokens"] for row in ok if row.get("prompt_tokens") is not None]
+    summary["prompt_tokens_mean"] = sum(prompt_tokens) / len(prompt_tokens) if prompt_tokens else float('nan')
+    for field in ("image_bytes", "vision_tokens", "preprocess_time"):
+        values = [row[field] for row in rows if row.get(field) is not None]
+        if values:
+            summary[f"{field}_mean"] = sum(values) / len(values)
+    # 추출 작업이면 응답은 받았지만 연락처 JSON을 얻지 못한 비율
+    parsed = [row["parsed"] for row in ok if row.get("parsed") is not None]
+    if parsed:
+        summary["parse_failure_rate"] = parsed.count(False) / len(parsed)
+    return summary
+
+def run_benchmark(targets, concurrency=4, limit=None, images_dir=IMAGES_DIR, questions_file=QUESTIONS_FILE,
+                  results_file=RESULTS_FILE, summary_file=SUMMARY_FILE, stream=False, task="qa", preprocess=False):
+    """모든 대상(백엔드:모델)에 같은 작업 목록과 동시성 설정으로 벤치마크를 실행하고 요약 표 반환"""
+    jobs = load_task_jobs(task, images_dir, questions_file)
+    if limit:
+        jobs = jobs[:limit]
+    if not jobs:
+        return None
+
+    writer = ResultWriter(results_file, RESULT_FIELDS, key_fields=["backend", "model", "task", "image", "stream", "preprocess"])
+    preprocessor = PreprocessCache() if preprocess else None
+    summaries = []
+    for target in targets:
+        backend = create_backend(target)
+        try:
+            backend.setup()
+        except Exception as e:
+            print(f"{target} 준비 실패, 건너뜀: {str(e)}")
+            continue
+        try:
+            rows, elapsed = run_target(backend, jobs, concurrency, writer, images_dir, stream, task, preprocessor)
+        finally:
+            backend.close()
+        if rows:
+            summaries.append(dict({"target": target, "task": task, "preprocess": preprocess}, **summarize(rows, elapsed)))
+    writer.close()
+    if preprocessor is not None:
+        preprocessor.report()
+
+    if not summaries:
+        return None
+    df_summary = pd.DataFrame(summaries).set_index("target")
+    if os.path.dirname(summary_file):
+        os.makedirs(os.path.dirname(summary_file), exist_ok=True)
+    df_summary.to_csv(summary_file, encoding='utf-8-sig')
+    print(f"\n{df_summary.round(3).to_string()}")
+    print(f"\n요약 표가 {summary_file} 파일에 저장되었습니다.")
+    return df_summary
+
+if __name__ == '__main__':
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="같은 작업 목록과 동시성으로 여러 백엔드의 지연 시간/처리량/오류율 비교")
+    parser.add_argument('--targets', nargs='+', required=True,
+                        help="백엔드:모델 목록 (예: gemini:gemini-2.0-flash ollama:llama3.2-vision qwen:Qwen/Qwen2.5-VL-3B-Instruct qwen-server:Qwen/Qwen2.5-VL-3B-Instruct mock:fast)")
+    parser.add_argument('--concurrency', type=int, default=4, help="동시에 보낼 최대 요청 수 (백엔드 한도를 넘지 않음)")
+    parser.add_argument('--limit', type=int, default=None, help="사용할 이미지/질문 작업 수")
+    parser.add_argument('--images', default=IMAGES_DIR, help="이미지 폴더")
+    parser.add_argument('--questions', default=QUESTIONS_FILE, help="질문 파일")
+    parser.add_argument('--output', default=RESULTS_FILE, help="호출별 결과 파일 (.csv 또는 .jsonl)")
+    parser.add_argument('--summary', default=SUMMARY_FILE, help="모델별 요약 CSV 파일")
+    parser.add_argument('--stream', action='store_true', help="스트리밍으로 요청해 TTFT와 토큰 간 지연 시간 측정")
+    parser.add_argument('--task', choices=list(TASKS), default="qa",
+                        help="qa: 질문 파일의 질문 / extract-free: 기존 대화체 추출 지시문 / extract-json: 구조화 출력(JSON 스키마) 추출")
+    parser.add_argument('--preprocess', action='store_true',
+                        help="모델 프로필로 전처리(방향 보정, 여백 자르기, 픽셀 예산 축소, 재인코딩)한 이미지를 전송")
+    args = parser.parse_args()
+    if args.stream and args.task == "extract-json":
+        parser.error("--task extract-json은 스트리밍을 지원하지 않습니다.")
+
+    run_benchmark(args.targets, args.concurrency, args.limit, args.images, args.questions, args.output, args.summary,
+                  args.stream, args.task, args.preprocess)
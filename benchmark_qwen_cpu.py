@@ -0,0 +1,164 @@
+import os
+import csv
+import time
+import queue
+import difflib
+import argparse
+import multiprocessing as mp
+
+import torch
+
+from inference_qwen_models_single_turn import QwenModel, OomPolicy, load_data, peak_rss_mb, peak_cuda_mb
+
+
+# 비교할 실행 설정 (bf16이 기준 경로, GPU가 없으면 cpu에서 bf16으로 실행)
+CONFIGS = {
+    "bf16": {"device": None, "torch_dtype": "bfloat16", "quantize": False},
+    "cpu_fp32": {"device": "cpu", "torch_dtype": "float32", "quantize": False},
+    "cpu_int8": {"device": "cpu", "torch_dtype": "float32", "quantize": True},
+}
+
+RESULT_FIELDS = ["config", "device", "load_time", "mean_latency", "load_rss_mb", "peak_rss_mb", "peak_cuda_mb",
+                 "similarity_to_bf16", "exact_match_to_bf16", "failed_images", "oom_retries", "error"]
+
+# 설정 하나의 최대 실행 시간(초)과 자식 프로세스 상태 확인 주기(초)
+# 자식 프로세스가 결과를 보내기 전에 죽거나(메모리 부족으로 강제 종료 등) 멈추면 실패로 기록하고 다음 설정으로 진행
+CONFIG_TIMEOUT = 3600
+POLL_INTERVAL = 5
+
+def run_config(checkpoint, config, num_threads, image_paths, questions, result_queue):
+    """설정 하나를 별도 프로세스에서 실행해 결과를 큐로 전달 (실패하면 {"error": 메시지} 전달)"""
+    try:
+        outcome = measure_config(checkpoint, config, num_threads, image_paths, questions)
+        result_queue.put(outcome if outcome is not None else {"error": "모델 초기화 실패"})
+    except Exception as e:
+        print(f"벤치마크 실행 실패: {str(e)}")
+        result_queue.put({"error": str(e) or type(e).__name__})
+
+def wait_for_outcome(process, result_queue, timeout=CONFIG_TIMEOUT):
+    """자식 프로세스의 결과를 기다림 (프로세스가 결과 없이 끝나거나 timeout초가 지나면 {"error": 메시지} 반환)"""
+    deadline = time.perf_counter() + timeout if timeout else None
+    while True:
+        try:
+            return result_queue.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            pass
+        if not process.is_alive():
+            # 프로세스가 결과를 넣은 직후 끝났을 수 있으므로 한 번 더 확인
+            try:
+                return result_queue.get(timeout=1)
+            except queue.Empty:
+                return {"error": f"프로세스가 결과 없이 종료됨 (exitcode {process.exitcode})"}
+        if deadline is not None and time.perf_counter() > deadline:
+            process.terminate()
+            return {"error": f"{timeout}초 안에 끝나지 않아 중단"}
+
+def measure_config(checkpoint, config, num_threads, image_paths, questions):
+    """초기화 시간, 이미지별 응답/지연 시간, 최대 RSS를 측정
+
+    메모리가 부족하면 OomPolicy가 픽셀 예산, 오프로딩 순으로 낮춰 다시 시도하고, 그래도 실패한 이미지는 응답 None으로 기록
+    """
+    device = config["device"] or ('cuda' if torch.cuda.is_available() else 'cpu')
+    qwen_instance = QwenModel(checkpoint, device=device, torch_dtype=getattr(torch, config["torch_dtype"]),
+                              quantize=config["quantize"], num_threads=num_threads)
+    start_time = time.perf_counter()
+    if not qwen_instance.initialize():
+        return None
+    load_time = time.perf_counter() - start_time
+    load_rss = peak_rss_mb()
+
+    policy = OomPolicy(qwen_instance)
+    responses, latencies, errors = [], [], 0
+    for image_path, question in zip(image_paths, questions):
+        result = policy.run([image_path], [question])[0]
+        if result.get("error"):
+            print(f"추론 실패: {os.path.basename(image_path)} - {result['error']}")
+            errors += 1
+        responses.append(result.get("response"))
+        latencies.append(result.get("inference_time"))
+
+    return {
+        "device": device,
+        "load_time": load_time,
+        "load_rss_mb": load_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_cuda_mb": peak_cuda_mb(device) or 0.0,
+        "responses": responses,
+        "latencies": latencies,
+        "errors": errors,
+        "oom_retries": policy.oom_retries,
+    }
+
+def similarity(reference, candidate):
+    """기준 응답과 후보 응답의 문자 단위 유사도 (0~1)"""
+    if reference is None or candidate is None:
+        return 0.0
+    return difflib.SequenceMatcher(None, reference, candidate).ratio()
+
+def run_benchmark(checkpoint, config_names, num_images, num_threads, timeout=CONFIG_TIMEOUT):
+    image_files, questions = load_data()
+    image_paths = [os.path.join('data', 'images', image_file) for image_file in image_files[:num_images]]
+    questions = questions[:len(image_paths)]
+
+    # 최대 RSS는 프로세스 단위로만 측정되므로 설정마다 새 프로세스에서 실행
+    ctx = mp.get_context("spawn")
+    outcomes = {}
+    rows = []
+    for name in config_names:
+        result_queue = ctx.Queue()
+        process = ctx.Process(target=run_config,
+                              args=(checkpoint, CONFIGS[name], num_threads, image_paths, questions, result_queue))
+        process.start()
+        outcome = wait_for_outcome(process, result_queue, timeout)
+        process.join()
+        if outcome.get("error"):
+            print(f"{name} 설정 실패: {outcome['error']}")
+            rows.append({"config": name, "error": outcome["error"]})
+            continue
+        outcomes[name] = outcome
+
+    reference = outcomes.get("bf16")
+    print(f"\n{'설정':<10}{'장치':<6}{'로드(초)':>10}{'평균 지연(초)':>14}{'최대 RSS(MB)':>14}{'유사도':>8}{'일치율':>8}")
+    for name, outcome in outcomes.items():
+        latencies = [latency for latency in outcome["latencies"] if latency is not None]
+        mean_latency = sum(latencies) / len(latencies) if latencies else 0.0
+        if reference is not None:
+            scores = [similarity(ref, cand) for ref, cand in zip(reference["responses"], outcome["responses"])]
+            mean_similarity = sum(scores) / len(scores)
+            exact_match = sum(ref == cand for ref, cand in zip(reference["responses"], outcome["responses"])) / len(scores)
+        else:
+            mean_similarity = exact_match = float('nan')
+        print(f"{name:<10}{outcome['device']:<6}{outcome['load_time']:>10.1f}{mean_latency:>14.2f}"
+              f"{outcome['peak_rss_mb']:>14.0f}{mean_similarity:>8.3f}{exact_match:>8.2f}")
+        rows.append({
+            "config": name,
+            "device": outcome["device"],
+            "load_time": round(outcome["load_time"], 2),
+            "mean_latency": round(mean_latency, 2),
+            "load_rss_mb": round(outcome["load_rss_mb"]),
+            "peak_rss_mb": round(outcome["peak_rss_mb"]),
+            "peak_cuda_mb": round(outcome["peak_cuda_mb"]),
+            "similarity_to_bf16": round(mean_similarity, 4),
+            "exact_match_to_bf16": round(exact_match, 4),
+            "failed_images": outcome["errors"],
+            "oom_retries": outcome["oom_retries"],
+            "error": None,
+        })
+
+    if rows:
+        with open("qwen_cpu_benchmark.csv", mode='w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        print("\n벤치마크 결과가 qwen_cpu_benchmark.csv 파일에 저장되었습니다.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Qwen2.5-VL bf16 / cpu fp32 / cpu int8 지연 시간, 메모리, 응답 유사도 비교")
+    parser.add_argument('--checkpoint', default="Qwen/Qwen2.5-VL-3B-Instruct")
+    parser.add_argument('--configs', nargs='+', default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument('--num-images', type=int, default=5, help="비교에 사용할 이미지 수")
+    parser.add_argument('--threads', type=int, default=None, help="cpu 스레드 수 (기본값: 전체 코어)")
+    parser.add_argument('--timeout', type=int, default=CONFIG_TIMEOUT, help="설정 하나의 최대 실행 시간(초), 넘으면 실패로 기록")
+    args = parser.parse_args()
+
+    run_benchmark(args.checkpoint, args.configs, args.num_images, args.threads, args.timeout)
@@ -0,0 +1,97 @@
+import os
+import math
+import time
+
+
+IMAGES_DIR = os.path.join("data", "images")
+QUESTIONS_FILE = os.path.join("data", "questions.txt")
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.gif', '.bmp')
+
+def encode_image_to_binary(image_path):
+    """이미지를 바이너리 형태로 읽어서 반환하는 함수"""
+    with open(image_path, 'rb') as f:
+        return f.read()
+
+def load_questions(filepath=QUESTIONS_FILE):
+    """질문 텍스트 파일을 읽어 리스트로 반환하는 함수 (각 줄 하나의 질문)"""
+    questions = []
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                questions.append(line)
+    return questions
+
+def list_image_files(images_dir=IMAGES_DIR):
+    """이미지 폴더의 이미지 파일 이름을 번호 순으로 정렬해 반환하는 함수 (이미지가 아닌 파일은 제외)"""
+    image_files = [name for name in os.listdir(images_dir) if name.lower().endswith(IMAGE_EXTENSIONS)]
+    return sorted(image_files, key=lambda x: int(''.join(filter(str.isdigit, x)) or 0))
+
+def load_jobs(images_dir=IMAGES_DIR, questions_file=QUESTIONS_FILE):
+    """이미지 파일과 질문을 짝지어 (이미지 파일명, 질문) 리스트로 반환하는 함수"""
+    image_files = list_image_files(images_dir)
+    if not image_files:
+        print(f"이미지 파일을 찾을 수 없습니다. {images_dir} 폴더를 확인하세요.")
+        return []
+
+    questions = load_questions(questions_file)
+    if not questions:
+        print(f"질문 파일에 내용이 없습니다. {questions_file} 파일을 확인하세요.")
+        return []
+
+    return list(zip(image_files, questions))
+
+def percentile(values, q):
+    """값 리스트의 q 백분위수 (선형 보간, 값이 없으면 nan)"""
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower, upper = math.floor(position), math.ceil(position)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def latency_summary(latencies):
+    """지연 시간 리스트의 평균, p50/p95/p99, 최대값 반환"""
+    return {
+        "mean": sum(latencies) / len(latencies) if latencies else float('nan'),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies) if latencies else float('nan'),
+    }
+
+def consume_stream(chunks, start_time):
+    """스트리밍 응답 청크를 모두 읽으며 첫 토큰까지의 시간(TTFT), 토큰 간 지연 시간, 전체 시간을 측정하는 함수
+
+    Args:
+        chunks: {"text": 조각, (선택) "prompt_tokens", "output_tokens"} 딕셔너리를 내보내는 이터레이터
+        start_time: 요청을 보내기 직전의 time.perf_counter() 값
+
+    Returns:
+        dict: text, prompt_tokens, output_tokens, ttft, inter_token_latency, total_time, chunks
+            inter_token_latency는 출력 토큰 수를 알면 (전체 - TTFT) / (출력 토큰 수 - 1),
+            모르면 텍스트가 있는 청크 사이 간격의 평균
+    """
+    pieces = []
+    arrivals = []
+    usage = {"prompt_tokens": None, "output_tokens": None}
+    for chunk in chunks:
+        now = time.perf_counter()
+        if chunk.get("text"):
+            pieces.append(chunk["text"])
+            arrivals.append(now)
+        for name in usage:
+            if chunk.get(name) is not None:
+                usage[name] = chunk[name]
+    total_time = time.perf_counter() - start_time
+
+    ttft = arrivals[0] - start_time if arrivals else float('nan')
+    if usage["output_tokens"] and usage["output_tokens"] > 1 and arrivals:
+        inter_token_latency = (arrivals[-1] - arrivals[0]) / (usage["output_tokens"] - 1)
+    elif len(arrivals) > 1:
+        inter_token_latency = (arrivals[-1] - arrivals[0]) / (len(arrivals) - 1)
+    else:
+        inter_token_latency = float('nan')
+
+    return dict(usage, text="".join(pieces), ttft=ttft, inter_token_latency=inter_token_latency,
+                total_time=total_time, chunks=len(arrivals))
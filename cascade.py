@@ -0,0 +1,156 @@
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from dotenv import load_dotenv
+from backends import create_backend
+from benchmark import TASKS, run_job
+from benchmark_utils import IMAGES_DIR, list_image_files, latency_summary
+from autotune import REFERENCE_FILE, field_accuracy, load_references
+from image_preprocess import PreprocessCache
+from structured_output import REQUIRED_FIELDS, contact_problems, parse_json_contact
+from result_writer import ResultWriter
+
+
+RESULTS_FILE = os.path.join("results", "cascade_results.jsonl")
+SUMMARY_FILE = os.path.join("results", "cascade_summary.csv")
+
+LOCAL_TARGET = "qwen:Qwen/Qwen2.5-VL-3B-Instruct"
+REMOTE_TARGET = "gemini:gemini-2.0-flash"
+
+RESULT_FIELDS = ["mode", "image", "source", "escalated", "reasons", "response", "accuracy", "latency",
+                 "local_latency", "remote_latency", "local_response", "error"]
+
+def extract(backend, image_path, images_dir, preprocessor=None):
+    """구조화 출력으로 명함 한 장을 추출하고 (run_job 결과 행, 연락처 딕셔너리 또는 None) 반환"""
+    row = run_job(backend, image_path, TASKS["extract-json"]["prompt"], images_dir, task="extract-json", preprocessor=preprocessor)
+    info = None if row.get("error") else parse_json_contact(row.get("response"))
+    return row, info
+
+def cascade_job(local, remote, image_path, images_dir, preprocessor=None, required_fields=REQUIRED_FIELDS):
+    """로컬 모델로 먼저 추출하고, 필드 검증에 실패한 명함만 원격 모델로 다시 추출한 결과 행 반환
+
+    latency는 로컬 추출부터 (필요하면) 원격 추출까지의 전체 시간이며, 로컬/원격 시간은 따로 기록합니다.
+    """
+    start_time = time.perf_counter()
+    local_row, info = extract(local, image_path, images_dir, preprocessor)
+    problems = [f"로컬 오류: {local_row['error']}"] if local_row.get("error") else contact_problems(info, required_fields)
+    row = {"mode": "cascade", "image": os.path.basename(image_path), "local_latency": local_row.get("latency"),
+           "local_response": local_row.get("response")}
+    if not problems:
+        row.update(source="local", escalated=False, response=local_row.get("response"))
+    else:
+        remote_row, _ = extract(remote, image_path, images_dir, preprocessor)
+        row.update(source="remote", escalated=True, reasons="; ".join(problems), response=remote_row.get("response"),
+                   remote_latency=remote_row.get("latency"), error=remote_row.get("error"))
+    row["latency"] = time.perf_counter() - start_time
+    return row
+
+def remote_job(remote, image_path, images_dir, preprocessor=None):
+    """비교용: 모든 명함을 원격 모델로만 추출한 결과 행"""
+    remote_row, _ = extract(remote, image_path, images_dir, preprocessor)
+    return {"mode": "remote-only", "image": os.path.basename(image_path), "source": "remote", "escalated": False,
+            "response": remote_row.get("response"), "latency": remote_row.get("latency"),
+            "remote_latency": remote_row.get("latency"), "error": remote_row.get("error")}
+
+def run_mode(mode, job, images, concurrency, writer, references):
+    """한 방식으로 모든 이미지를 처리하고 결과 행 기록 (같은 실행 ID에서 이미 끝난 이미지는 건너뜀)"""
+    pending = [image for image in images if not writer.is_done(mode=mode, image=image)]
+    print(f"{mode}: 이미지 {len(pending)}장 / 동시성 {concurrency}")
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(job, image) for image in pending]
+        for future in futures:
+            row = future.result()
+            row["accuracy"] = None if row.get("error") else field_accuracy(references.get(row["image"]), row.get("response"))
+            writer.write(row)
+
+def summarize_modes(rows):
+    """방식별 이미지 수, 원격 호출 비율(에스컬레이션율), 정확도, 전체 지연 시간 백분위수, 오류율"""
+    summary = {}
+    for mode in ("cascade", "remote-only"):
+        mode_rows = [row for row in rows if row.get("mode") == mode]
+        if not mode_rows:
+            continue
+        ok = [row for row in mode_rows if not row.get("error")]
+        scored = [row["accuracy"] for row in ok if row.get("accuracy") is not None and not pd.isna(row["accuracy"])]
+        local = [row["accuracy"] for row in ok if row.get("source") == "local"
+                 and row.get("accuracy") is not None and not pd.isna(row["accuracy"])]
+        escalated = sum(1 for row in mode_rows if str(row.get("escalated")) == "True")
+        remote_calls = escalated if mode == "cascade" else len(mode_rows)
+        summary[mode] = dict(
+            images=len(mode_rows),
+            escalation_rate=escalated / len(mode_rows) if mode == "cascade" else float('nan'),
+            remote_calls=remote_calls,
+            accuracy=sum(scored) / len(scored) if scored else float('nan'),
+            local_accuracy=sum(local) / len(local) if local else float('nan'),
+            error_rate=(len(mode_rows) - len(ok)) / len(mode_rows),
+            **{f"latency_{name}": value for name, value in latency_summary([row["latency"] for row in ok]).items()},
+        )
+    return pd.DataFrame.from_dict(summary, orient='index')
+
+def run_cascade(local_target=LOCAL_TARGET, remote_target=REMOTE_TARGET, concurrency=4, limit=None, images_dir=IMAGES_DIR,
+                reference_file=REFERENCE_FILE, results_file=RESULTS_FILE, summary_file=SUMMARY_FILE,
+                preprocess=False, compare=True, required_fields=REQUIRED_FIELDS):
+    """캐스케이드(로컬 → 검증 실패 시 원격)와 원격 단독을 같은 이미지로 실행하고 에스컬레이션율/정확도/지연 시간 비교"""
+    images = list_image_files(images_dir)
+    if limit:
+        images = images[:limit]
+    references = load_references(reference_file, list_image_files(images_dir)) if os.path.exists(reference_file) else {}
+    if not references:
+        print(f"{reference_file} 파일이 없어 정확도는 계산하지 않습니다.")
+
+    local, remote = create_backend(local_target), create_backend(remote_target)
+    local.setup()
+    remote.setup()
+    preprocessor = PreprocessCache() if preprocess else None
+    writer = ResultWriter(results_file, RESULT_FIELDS, key_fields=["mode", "image"])
+    try:
+        # 로컬 모델이 한 번에 처리할 수 있는 요청 수를 넘지 않도록 제한 (예: 로컬 Qwen은 1)
+        workers = min(concurrency, local.max_concurrency) if local.max_concurrency is not None else concurrency
+        run_mode("cascade", lambda image: cascade_job(local, remote, image, images_dir, preprocessor, required_fields),
+                 images, workers, writer, references)
+        if compare:
+            workers = min(concurrency, remote.max_concurrency) if remote.max_concurrency is not None else concurrency
+            run_mode("remote-only", lambda image: remote_job(remote, image, images_dir, preprocessor),
+                     images, workers, writer, references)
+    finally:
+        local.close()
+        remote.close()
+    writer.close()
+    if preprocessor is not None:
+        preprocessor.report()
+
+    # 이어서 실행한 경우에도 이번 실행 ID의 전체 결과로 요약
+    rows = [row for row in writer.read_rows() if row.get("run_id") == writer.run_id]
+    summary = summarize_modes(rows)
+    print(f"\n로컬: {local_target} / 원격: {remote_target}\n{summary.round(3).to_string()}")
+    reasons = pd.Series([reason for row in rows if row.get("mode") == "cascade" and row.get("reasons")
+                         for reason in str(row["reasons"]).split("; ")])
+    if not reasons.empty:
+        # 형식 오류는 값이 제각각이므로 필드별로 묶어 집계
+        print("\n에스컬레이션 사유:\n" + reasons.str.split(":").str[0].value_counts().to_string())
+    if os.path.dirname(summary_file):
+        os.makedirs(os.path.dirname(summary_file), exist_ok=True)
+    summary.assign(local=local_target, remote=remote_target).to_csv(summary_file, encoding='utf-8-sig')
+    print(f"\n요약 표가 {summary_file} 파일에 저장되었습니다.")
+    return summary
+
+if __name__ == '__main__':
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="로컬 모델로 먼저 추출하고 필드 검증에 실패한 명함만 원격 모델로 보내는 캐스케이드를 원격 단독과 비교")
+    parser.add_argument('--local', default=LOCAL_TARGET, help="먼저 실행할 로컬 백엔드:모델 (예: ollama:llama3.2-vision)")
+    parser.add_argument('--remote', default=REMOTE_TARGET, help="검증 실패 시 보낼 원격 백엔드:모델")
+    parser.add_argument('--required', nargs='*', default=REQUIRED_FIELDS, help="비어 있으면 원격으로 보낼 필드")
+    parser.add_argument('--concurrency', type=int, default=4, help="동시에 처리할 최대 명함 수 (백엔드 한도를 넘지 않음)")
+    parser.add_argument('--limit', type=int, default=None, help="사용할 이미지 수")
+    parser.add_argument('--images', default=IMAGES_DIR, help="이미지 폴더")
+    parser.add_argument('--reference', default=REFERENCE_FILE, help="정답 CSV 파일 (response 컬럼, 선택적으로 image 컬럼)")
+    parser.add_argument('--output', default=RESULTS_FILE, help="방식/이미지별 결과 파일 (.jsonl 또는 .csv)")
+    parser.add_argument('--summary', default=SUMMARY_FILE, help="방식별 요약 CSV 파일")
+    parser.add_argument('--preprocess', action='store_true', help="모델 프로필로 전처리한 이미지를 전송")
+    parser.add_argument('--no-compare', action='store_true', help="원격 단독 비교 실행을 건너뜀")
+    args = parser.parse_args()
+
+    run_cascade(args.local, args.remote, args.concurrency, args.limit, args.images, args.reference, args.output,
+                args.summary, args.preprocess, not args.no_compare, args.required)
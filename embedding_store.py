@@ -0,0 +1,115 @@
+import os
+import re
+import hashlib
+import numpy as np
+
+
+STORE_DIR = os.path.join("cache", "embeddings")
+
+class EmbeddingStore:
+    """텍스트와 인코더 이름의 해시를 키로 임베딩을 저장하는 memory-mapped float16 저장소
+
+    인코더마다 <이름>.f16 (헤더 없는 float16 임베딩 행렬)과 <이름>.index (첫 줄은 차원, 이후 한 줄에 키 하나, 줄 순서가 행 번호)
+    두 파일을 씁니다. 새 임베딩은 두 파일 끝에 덧붙이기만 하므로 추가 비용은 저장된 임베딩 수와 관계없고,
+    행렬은 mmap으로 열기 때문에 저장된 임베딩을 다시 읽을 때 전체를 메모리에 올리지 않습니다.
+    """
+    def __init__(self, encoder_name, directory=STORE_DIR):
+        self.encoder_name = encoder_name
+        os.makedirs(directory, exist_ok=True)
+        prefix = os.path.join(directory, re.sub(r'[^A-Za-z0-9._-]', '_', encoder_name))
+        self.matrix_path = prefix + ".f16"
+        self.index_path = prefix + ".index"
+        self.hits = 0
+        self.misses = 0
+
+        self.index = {}
+        self.dim = None
+        self.matrix = None
+        if os.path.exists(self.index_path) and os.path.exists(self.matrix_path):
+            self.load()
+
+    def load(self):
+        """색인과 행렬을 읽고, 추가 도중 중단돼 두 파일의 행 수가 다르면 짧은 쪽에 맞춰 자름"""
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            header = f.readline().strip()
+            keys = [line.strip() for line in f]
+        if not header.isdigit():
+            return
+        self.dim = int(header)
+        rows = min(len(keys), os.path.getsize(self.matrix_path) // (self.dim * 2))
+        if os.path.getsize(self.matrix_path) != rows * self.dim * 2:
+            with open(self.matrix_path, 'r+b') as f:
+                f.truncate(rows * self.dim * 2)
+        if len(keys) != rows:
+            keys = keys[:rows]
+            with open(self.index_path, 'w', encoding='utf-8') as f:
+                f.write(f"{self.dim}\n" + "".join(key + '\n' for key in keys))
+        self.index = {key: row for row, key in enumerate(keys)}
+        self.open_matrix()
+
+    def open_matrix(self):
+        rows = len(self.index)
+        self.matrix = np.memmap(self.matrix_path, dtype=np.float16, mode='r', shape=(rows, self.dim)) if rows else None
+
+    def key(self, text):
+        """텍스트 + 인코더 이름의 SHA-256"""
+        return hashlib.sha256(f"{self.encoder_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def get_or_encode(self, texts, encode):
+        """저장된 임베딩은 그대로 읽고, 없는 텍스트만 encode(텍스트 리스트)로 인코딩해 저장한 뒤 (len(texts), d) 행렬 반환"""
+        if not texts:
+            # 아직 아무것도 저장하지 않은 저장소는 차원을 모르므로 (0, 0)
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        keys = [self.key(text) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key in self.index:
+                self.hits += 1
+            else:
+                self.misses += 1
+                missing.setdefault(key, text)
+
+        if missing:
+            self.append(list(missing), encode(list(missing.values())))
+
+        rows = np.fromiter((self.index[key] for key in keys), dtype=np.int64, count=len(keys))
+        return np.asarray(self.matrix[rows], dtype=np.float32)
+
+    def append(self, keys, vectors):
+        """새 임베딩을 행렬 파일 끝에 덧붙이고 색인에 키 추가 (행렬을 먼저 쓰므로 중간에 중단돼도 다음 로드에서 맞춰짐)"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float16)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(self.index_path, 'w', encoding='utf-8') as f:
+                f.write(f"{self.dim}\n")
+            open(self.matrix_path, 'wb').close()
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"임베딩 차원 {vectors.shape[1]}이 저장소 차원 {self.dim}과 다릅니다.")
+
+        with open(self.matrix_path, 'ab') as f:
+            f.write(vectors.tobytes())
+        old_rows = len(self.index)
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            for offset, key in enumerate(keys):
+                f.write(key + '\n')
+                self.index[key] = old_rows + offset
+        # 새 행까지 보이도록 mmap만 다시 열고 기존 행은 복사하지 않음
+        self.open_matrix()
+
+    def stats(self):
+        """적중/미스 횟수, 적중률, 저장된 임베딩 수와 파일 크기 반환"""
+        lookups = self.hits + self.misses
+        size = sum(os.path.getsize(path) for path in (self.matrix_path, self.index_path) if os.path.exists(path))
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.index),
+            "bytes": size,
+        }
+
+    def report(self):
+        """저장소 통계 출력"""
+        stats = self.stats()
+        print(f"임베딩 저장소 ({self.encoder_name}) - 적중: {stats['hits']} / 미스: {stats['misses']} / "
+              f"적중률: {stats['hit_rate']:.1%} / 임베딩: {stats['entries']} / 크기: {stats['bytes'] / 1024**2:.2f}MB")
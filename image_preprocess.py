@@ -0,0 +1,246 @@
+import io
+import os
+import re
+import json
+import math
+import time
+import hashlib
+import argparse
+import threading
+from PIL import Image, ImageOps, ImageChops
+from benchmark_utils import IMAGES_DIR, encode_image_to_binary, list_image_files
+
+
+PREPROCESS_DIR = os.path.join("cache", "preprocessed")
+# autotune.py가 고른 모델별 프로필 (있으면 계열 기본값 대신 사용)
+PROFILES_DIR = "profiles"
+
+# 모델 계열별 전처리 프로필 (max_pixels: 가로x세로 픽셀 예산, multiple: 가로/세로를 맞출 배수, quality: JPEG 품질)
+# gemini: 768x768 타일 하나에 258토큰이므로 긴 변이 타일 두 개를 넘지 않는 정도로 제한
+# qwen: 28x28 픽셀이 비전 토큰 하나 (1024토큰 예산), 28의 배수로 맞춰 프로세서가 다시 리사이즈하지 않도록 함
+# ollama: llama3.2-vision 기준 560x560 타일 최대 4개
+PROFILES = {
+    "gemini": {"max_pixels": 768 * 768, "multiple": None, "quality": 85, "trim": True},
+    "qwen": {"max_pixels": 1024 * 28 * 28, "multiple": 28, "quality": 90, "trim": True},
+    "ollama": {"max_pixels": 1120 * 1120, "multiple": None, "quality": 85, "trim": True},
+}
+
+# 그대로 보내도 되는 형식 (그 외 형식은 항상 JPEG로 다시 인코딩)
+PASSTHROUGH_FORMATS = {"JPEG", "PNG", "WEBP"}
+
+def model_family(model):
+    """모델 이름으로 전처리 프로필/토큰 추정에 쓸 계열 반환 (gemini / qwen / ollama)"""
+    name = model.lower()
+    if "gemini" in name:
+        return "gemini"
+    if "qwen" in name:
+        return "qwen"
+    return "ollama"
+
+def profile_path(model):
+    """모델별 프로필 파일 경로 (모델 이름의 / : 등은 _로 바꿈)"""
+    return os.path.join(PROFILES_DIR, re.sub(r'[^\w.-]', '_', model) + ".json")
+
+def profile_for(model):
+    """모델의 전처리 프로필 (계열 기본값에 profiles/<모델>.json의 설정을 덮어씀)"""
+    profile = dict(PROFILES[model_family(model)])
+    if os.path.exists(profile_path(model)):
+        with open(profile_path(model), 'r', encoding='utf-8') as f:
+            profile.update(json.load(f)["profile"])
+    return profile
+
+def detect_format(data):
+    """이미지 바이트의 실제 형식 이름(PIL 기준, 예: JPEG/PNG/WEBP) 반환 (이미지가 아니면 None)"""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return image.format
+    except Exception:
+        return None
+
+def detect_mime_type(data):
+    """이미지 바이트의 실제 MIME 타입 (확장자가 아니라 내용으로 판단, 알 수 없으면 image/jpeg)"""
+    return Image.MIME.get(detect_format(data), "image/jpeg")
+
+def estimate_vision_tokens(width, height, family):
+    """이미지 크기로 모델 계열별 비전 토큰 수 추정
+
+    gemini: 두 변이 모두 384 이하면 258, 아니면 768x768 타일마다 258
+    qwen: 28의 배수로 반올림한 뒤 28x28 픽셀마다 1 (프로세서 기본 max_pixels 12845056까지)
+    ollama: llama3.2-vision 기준 560x560 타일(최대 4개)마다 1601
+    """
+    if family == "gemini":
+        if width <= 384 and height <= 384:
+            return 258
+        return math.ceil(width / 768) * math.ceil(height / 768) * 258
+    if family == "qwen":
+        width, height = fit_to_budget(width, height, 12845056, 28)
+        return max(4, (width // 28) * (height // 28))
+    return min(4, math.ceil(width / 560) * math.ceil(height / 560)) * 1601
+
+def fit_to_budget(width, height, max_pixels, multiple=None):
+    """가로세로 비율을 유지하며 넓이가 max_pixels 이하가 되는 크기 반환 (multiple이 있으면 각 변을 그 배수로 맞춤)"""
+    scale = min(1.0, math.sqrt(max_pixels / (width * height)))
+    new_width, new_height = width * scale, height * scale
+    if multiple:
+        new_width = max(multiple, round(new_width / multiple) * multiple)
+        new_height = max(multiple, round(new_height / multiple) * multiple)
+        # 반올림으로 예산을 넘으면 한 칸씩 줄임
+        while new_width * new_height > max_pixels and max(new_width, new_height) > multiple:
+            if new_width >= new_height:
+                new_width -= multiple
+            else:
+                new_height -= multiple
+    return max(1, int(new_width)), max(1, int(new_height))
+
+def trim_border(image, tolerance=16, margin=8):
+    """왼쪽 위 모서리와 같은 색의 단색 여백을 잘라낸 이미지 반환 (여백이 없으면 원본)"""
+    rgb = image.convert("RGB")
+    background = Image.new("RGB", rgb.size, rgb.getpixel((0, 0)))
+    diff = ImageChops.difference(rgb, background).convert("L")
+    bbox = diff.point(lambda value: 255 if value > tolerance else 0).getbbox()
+    if bbox is None:
+        return image
+    left, top, right, bottom = bbox
+    bbox = (max(0, left - margin), max(0, top - margin), min(image.width, right + margin), min(image.height, bottom + margin))
+    if bbox == (0, 0, image.width, image.height):
+        return image
+    return image.crop(bbox)
+
+def to_rgb(image):
+    """투명 영역은 흰 배경으로 채워 RGB로 변환"""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+def describe_image(data, model):
+    """전처리하지 않은 이미지의 형식, 크기, 바이트 수, 모델 계열 기준 추정 비전 토큰 수"""
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        return {"format": image.format, "width": width, "height": height, "bytes": len(data),
+                "vision_tokens": estimate_vision_tokens(width, height, model_family(model))}
+
+def preprocess_image(data, profile, family="gemini"):
+    """이미지 바이트를 전처리 (실제 형식 확인, EXIF 방향 보정, 단색 여백 자르기, 픽셀 예산으로 축소, JPEG 재인코딩)
+
+    회전/축소가 필요 없고 다시 인코딩한 결과가 원본보다 크면 원본 바이트를 그대로 사용합니다.
+
+    Returns:
+        dict: data, mime_type, format, width, height, bytes, vision_tokens와
+            원본의 original_format, original_width, original_height, original_bytes, original_vision_tokens, preprocess_time
+    """
+    start_time = time.perf_counter()
+    with Image.open(io.BytesIO(data)) as original:
+        original_format = original.format
+        original_size = original.size
+        image = ImageOps.exif_transpose(original)
+        rotated = image.size != original_size or original.getexif().get(0x0112, 1) != 1
+        if profile.get("trim"):
+            image = trim_border(image)
+        target_size = fit_to_budget(image.width, image.height, profile["max_pixels"], profile.get("multiple"))
+        if target_size != image.size:
+            image = image.resize(target_size, Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        to_rgb(image).save(buffer, format="JPEG", quality=profile["quality"], optimize=True)
+        output, output_format, output_size = buffer.getvalue(), "JPEG", image.size
+        # 회전이 필요 없고 원본이 이미 예산 안이면, 여백만 자른 결과가 원본보다 클 때 원본을 그대로 사용
+        fits = fit_to_budget(*original_size, profile["max_pixels"], profile.get("multiple")) == original_size
+        if not rotated and fits and original_format in PASSTHROUGH_FORMATS and len(data) <= len(output):
+            output, output_format, output_size = data, original_format, original_size
+
+    return {
+        "data": output,
+        "mime_type": Image.MIME[output_format],
+        "format": output_format,
+        "width": output_size[0],
+        "height": output_size[1],
+        "bytes": len(output),
+        "vision_tokens": estimate_vision_tokens(*output_size, family),
+        "original_format": original_format,
+        "original_width": original_size[0],
+        "original_height": original_size[1],
+        "original_bytes": len(data),
+        "original_vision_tokens": estimate_vision_tokens(*original_size, family),
+        "preprocess_time": time.perf_counter() - start_time,
+    }
+
+class PreprocessCache:
+    """전처리 결과를 (원본 이미지 해시, 프로필) 해시로 저장하는 디스크 캐시
+
+    같은 이미지와 프로필은 한 번만 처리되며, 결과 이미지(<키>.jpg 등)와 정보(<키>.json)가 함께 저장됩니다.
+    Qwen처럼 파일 경로를 입력으로 받는 모델은 결과 이미지의 path를 그대로 사용합니다.
+    """
+    def __init__(self, directory=PREPROCESS_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def make_key(self, data, profile):
+        material = json.dumps({"image": hashlib.sha256(data).hexdigest(), "profile": profile}, sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def prepare_bytes(self, data, model, profile=None):
+        """이미지 바이트를 모델 프로필로 전처리한 결과 반환 (캐시에 있으면 다시 처리하지 않음, path 포함)"""
+        profile = profile or profile_for(model)
+        key = self.make_key(data, profile)
+        info_path = os.path.join(self.directory, key + ".json")
+        if os.path.exists(info_path):
+            with open(info_path, 'r', encoding='utf-8') as f:
+                info = json.load(f)
+            with open(info["path"], 'rb') as f:
+                info["data"] = f.read()
+            info["cached"] = True
+            with self.lock:
+                self.hits += 1
+            return info
+
+        info = preprocess_image(data, profile, model_family(model))
+        info["path"] = os.path.join(self.directory, key + "." + info["format"].lower().replace("jpeg", "jpg"))
+        # 다른 스레드/프로세스가 반쯤 쓴 파일을 읽지 않도록 임시 파일에 쓴 뒤 교체 (정보 파일은 마지막에)
+        for path, content, mode in ((info["path"], info["data"], 'wb'),
+                                    (info_path, json.dumps({k: v for k, v in info.items() if k != "data"}), 'w')):
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, mode) as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        info["cached"] = False
+        with self.lock:
+            self.misses += 1
+        return info
+
+    def prepare(self, image_path, model, profile=None):
+        """이미지 파일을 모델 프로필로 전처리한 결과 반환"""
+        return self.prepare_bytes(encode_image_to_binary(image_path), model, profile)
+
+    def report(self):
+        total = self.hits + self.misses
+        if total:
+            print(f"전처리 캐시 - 적중: {self.hits} / 처리: {self.misses} / 적중률: {self.hits / total:.1%}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="모델 계열별 이미지 전처리 결과(크기, 추정 비전 토큰, 처리 시간)를 원본과 비교")
+    parser.add_argument('--images', default=IMAGES_DIR, help="이미지 폴더")
+    parser.add_argument('--models', nargs='+', default=["gemini-2.0-flash", "Qwen/Qwen2.5-VL-3B-Instruct", "llama3.2-vision"],
+                        help="전처리 프로필을 고를 모델 이름")
+    args = parser.parse_args()
+
+    cache = PreprocessCache()
+    for model in args.models:
+        family = model_family(model)
+        print(f"\n{model} ({family}, {profile_for(model)})")
+        totals = {"original_bytes": 0, "bytes": 0, "original_vision_tokens": 0, "vision_tokens": 0, "preprocess_time": 0.0}
+        for name in list_image_files(args.images):
+            info = cache.prepare(os.path.join(args.images, name), model)
+            for field in totals:
+                totals[field] += info[field]
+            print(f"{name}: {info['original_format']} {info['original_width']}x{info['original_height']} {info['original_bytes'] / 1024:.0f}KB "
+                  f"{info['original_vision_tokens']}토큰 -> {info['format']} {info['width']}x{info['height']} {info['bytes'] / 1024:.0f}KB "
+                  f"{info['vision_tokens']}토큰" + (" (캐시)" if info["cached"] else f" ({info['preprocess_time'] * 1000:.0f}ms)"))
+        print(f"합계: {totals['original_bytes'] / 1024:.0f}KB -> {totals['bytes'] / 1024:.0f}KB / "
+              f"추정 비전 토큰 {totals['original_vision_tokens']} -> {totals['vision_tokens']} / 처리 시간 {totals['preprocess_time']:.2f}초")
+    cache.report()
@@ -1,16 +1,26 @@
 import os
-import csv
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from ollama import Client
 import time
+from response_cache import ResponseCache
+from result_writer import ResultWriter
+from benchmark_utils import encode_image_to_binary, load_jobs
+from backends import HostPool
+from image_preprocess import PreprocessCache
+from scheduler import Scheduler, STATS_FIELDS, stats_columns
 
 load_dotenv()
+# 여러 호스트는 쉼표로 구분 (예: HOST_URL=http://gpu1:11434,http://gpu2:11434)
 HOST_URL = os.getenv('HOST_URL')
 
 if HOST_URL is None:
     raise ValueError("HOST_URL이 .env 파일에 정의되어 있지 않습니다.")
 
-client = Client(host=HOST_URL)
+HOSTS = [host.strip() for host in HOST_URL.split(',') if host.strip()]
+# 동시에 처리할 최대 요청 수 (기본값: 호스트당 2개)
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', str(len(HOSTS) * 2)))
+# 모델을 메모리에 유지할 시간 (호출 사이에 모델이 다시 로드되지 않도록 함)
+KEEP_ALIVE = os.getenv('KEEP_ALIVE', '30m')
 
 # 테스트할 모델 리스트 (원하는 모델들을 여기에 추가)
 MODELS_TO_TEST = [
@@ -21,83 +31,132 @@ MODELS_TO_TEST = [
     # "llava-llama3",
 ]
 
-def encode_image_to_binary(image_path):
-    """이미지를 바이너리 형태로 읽어서 반환하는 함수"""
-    with open(image_path, 'rb') as f:
-        return f.read()
-
-def load_questions(filepath):
-    """질문 텍스트 파일을 읽어 리스트로 반환하는 함수 (각 줄 하나의 질문)"""
-    questions = []
-    with open(filepath, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                questions.append(line)
-    return questions
-
-def run_tests():
-    image_files = sorted(os.listdir(os.path.join("data", "images")), 
-                    key=lambda x: int(''.join(filter(str.isdigit, x))))
-    if not image_files:
-        print("이미지 파일을 찾을 수 없습니다. data/images/ 폴더를 확인하세요.")
-        return
+# 이미지 전처리 (True면 방향 보정, 모델별 픽셀 예산으로 축소/재인코딩한 이미지를 전송)
+PREPROCESS = True
+
+# 생성 옵션 (응답 캐시 키에도 사용)
+OPTIONS = {
+    'temperature': 0.3,
+    'top_p': 0.1,
+    'frequency_penalty': 0.5,
+    'presence_penalty': 0.5,
+    'stop': ['!', '?'],
+    'max_tokens': 200
+}
+
+# 모델별 분당 요청/토큰 한도 (없는 모델은 제한 없음, 토큰은 응답의 prompt_eval_count + eval_count로 사후 차감)
+RATE_LIMITS = {
+    # "llama3.2-vision": {"rpm": 120, "tpm": 200000},
+}
+# 일시적 오류(429/503/시간 초과) 재시도 횟수와, 최근 지연 시간의 이 백분위수보다 오래 걸리면 다른 호스트로 한 번 더 요청 (None이면 헤징 안 함)
+MAX_RETRIES = 5
+HEDGE_PERCENTILE = 95
 
-    questions = load_questions(os.path.join("data", "questions.txt"))
-    if not questions:
-        print("질문 파일에 내용이 없습니다. data/questions.txt 파일을 확인하세요.")
+# 결과 파일 (.csv 또는 .jsonl, 행이 끝나는 대로 추가되며 같은 실행 ID로 재실행하면 완료된 작업은 건너뜀)
+RESULTS_FILE = "ollama_results.csv"
+RESULT_FIELDS = ["model", "image", "question", "response", "inference_time", "host", "cached"] + STATS_FIELDS + ["error"]
+
+def response_tokens(result):
+    """pool.chat 결과에서 입력+출력 토큰 수 계산 (TPM 한도 차감용)"""
+    response = result[0]
+    return (response.get('prompt_eval_count') or 0) + (response.get('eval_count') or 0)
+
+def run_job(model, image_path, question, pool, scheduler, preprocessor, cache, writer):
+    """이미지/질문 작업 하나를 실행하고 결과 행을 바로 기록하는 함수"""
+    if preprocessor is not None:
+        image_data = preprocessor.prepare(os.path.join('data','images',image_path), model)["data"]
+    else:
+        image_data = encode_image_to_binary(os.path.join('data','images',image_path))
+    print(f"모델: {model} / 이미지: {os.path.basename(image_path)} / 질문: {question}")
+    cache_key = cache.make_key(model, image_data, question, '', OPTIONS)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        writer.write({
+            "model": model,
+            "image": os.path.basename(image_path),
+            "question": question,
+            "response": cached[0],
+            "inference_time": cached[1],
+            "host": '',
+            "cached": True
+        })
         return
 
-    results = []
-
-    # 모델, 이미지, 질문별로 테스트 실행
-    for model in MODELS_TO_TEST:
-        for image_path, question in zip(image_files, questions):
-            image_data = encode_image_to_binary(os.path.join('data','images',image_path))
-            print(f"모델: {model} / 이미지: {os.path.basename(image_path)} / 질문: {question}")
-            try:
-                start_time = time.time()
-                response = client.chat(
-                    model=model,
-                    messages=[
-                        {
-                            'role': 'user',
-                            'content': question,
-                            'images': [image_data]
-                        }
-                    ],
-                    options={
-                        'temperature': 0.3,
-                        'top_p': 0.1,
-                        'frequency_penalty': 0.5,
-                        'presence_penalty': 0.5,
-                        'stop': ['!', '?'],
-                        'max_tokens': 200
+    host = ''
+    error = ''
+    stats = None
+    try:
+        # 한도 대기, 일시적 오류 재시도, 느린 요청 헤징은 scheduler가 처리
+        (response, host, elapsed), stats = scheduler.call(
+            model,
+            lambda: pool.chat(
+                model=model,
+                messages=[
+                    {
+                        'role': 'user',
+                        'content': question,
+                        'images': [image_data]
                     }
-                )
-                    # 응답 메시지 추출 (없으면 빈 문자열)
-                inference_time = round(time.time() - start_time, 2)
-                response_text = response.get('message', {}).get('content', '')
-            except Exception as e:
-                response_text = f"Error: {str(e)}"
-                inference_time = 0.0
-            
-            results.append({
-                "model": model,
-                "image": os.path.basename(image_path),
-                "question": question,
-                "response": response_text,
-                "inference_time": inference_time
-            })
-
-    # 결과를 CSV 파일로 저장 (한 파일에 모든 결과가 기록됨)
-    csv_file = "test_results.csv"
-    with open(csv_file, mode='w', newline='', encoding='utf-8-sig') as f:
-        writer = csv.DictWriter(f, fieldnames=["model", "image", "question", "response","inference_time"])
-        writer.writeheader()
-        writer.writerows(results)
-
-    print(f"테스트 결과가 {csv_file} 파일에 저장되었습니다.")
+                ],
+                options=OPTIONS
+            ),
+            count_tokens=response_tokens
+        )
+        # 응답 메시지 추출 (없으면 빈 문자열)
+        inference_time = round(elapsed, 2)
+        response_text = response.get('message', {}).get('content', '')
+        cache.put(cache_key, model, response_text, inference_time)
+    except Exception as e:
+        # 실패한 행은 error를 채워 기록 (재실행 시 다시 시도, 평균이 왜곡되지 않도록 inference_time은 비움)
+        error = str(e)
+        response_text = f"Error: {error}"
+        inference_time = None
+
+    writer.write({
+        "model": model,
+        "image": os.path.basename(image_path),
+        "question": question,
+        "response": response_text,
+        "inference_time": inference_time,
+        "host": host,
+        "cached": False,
+        **stats_columns(stats),
+        "error": error
+    })
+
+def run_tests(max_workers=MAX_WORKERS):
+    jobs = load_jobs()
+    if not jobs:
+        return
+
+    cache = ResponseCache()
+    writer = ResultWriter(RESULTS_FILE, RESULT_FIELDS, key_fields=["model", "image"])
+    pool = HostPool(HOSTS, keep_alive=KEEP_ALIVE)
+    scheduler = Scheduler(RATE_LIMITS, max_retries=MAX_RETRIES,
+                          hedge_percentile=HEDGE_PERCENTILE if len(HOSTS) > 1 else None)
+    preprocessor = PreprocessCache() if PREPROCESS else None
+    sweep_start = time.perf_counter()
+
+    # 모델, 이미지, 질문별로 테스트 실행 (워커 풀이 호스트들로 작업을 분산, 완료된 작업부터 기록)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for model in MODELS_TO_TEST:
+            pending = [(image_path, question) for image_path, question in jobs
+                       if not writer.is_done(model=model, image=os.path.basename(image_path))]
+            if not pending:
+                continue
+            pool.warm_up(model)
+            futures = [executor.submit(run_job, model, image_path, question, pool, scheduler, preprocessor, cache, writer)
+                       for image_path, question in pending]
+            for future in futures:
+                future.result()
+
+    pool.report(time.perf_counter() - sweep_start)
+    scheduler.close()
+    if preprocessor is not None:
+        preprocessor.report()
+    cache.report()
+    cache.close()
+    writer.close()
 
 if __name__ == '__main__':
     run_tests()
\ No newline at end of file
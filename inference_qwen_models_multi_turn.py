@@ -0,0 +1,211 @@
+import os
+import time
+import torch
+from PIL import Image
+from transformers import DynamicCache
+from transformers.generation.streamers import BaseStreamer
+import benchmark_utils
+from result_writer import ResultWriter
+from image_preprocess import PreprocessCache
+from inference_qwen_models_single_turn import (MODELS_TO_TEST, GENERATION_KWARGS, SYSTEM_PROMPT, PREPROCESS,
+                                               DEVICE, CPU_QUANTIZE, CPU_THREADS, QwenModel, input_image_path)
+
+
+# 대화마다 비교할 KV 캐시 방식
+# reuse: 이전 턴까지의 past_key_values(시스템 지침, 이미지, 대화 기록)를 재사용하고 새 토큰만 prefill
+# full: 매 턴 전체 대화를 처음부터 prefill (이미지도 매번 다시 인코딩)
+CACHE_MODES = ["reuse", "full"]
+
+# 결과 파일 (.csv 또는 .jsonl, 턴이 끝나는 대로 추가되며 같은 실행 ID로 재실행하면 모든 턴이 기록된 대화는 건너뜀)
+# 지연 시간 측정이 목적이므로 응답 캐시는 사용하지 않음
+RESULTS_FILE = "qwen_multiturn_results.csv"
+RESULT_FIELDS = ["model", "image", "turn", "question", "response", "inference_time", "cache_mode",
+                 "prompt_tokens", "reused_tokens", "output_tokens", "prefill_time", "decode_time", "decode_time_per_token"]
+
+class TimingStreamer(BaseStreamer):
+    """generate가 넘기는 토큰 시점을 기록하는 스트리머 (첫 put은 프롬프트, 이후 put은 생성된 토큰)"""
+    def __init__(self):
+        self.times = []
+
+    def put(self, value):
+        # 생성된 토큰은 CPU로 옮긴 뒤 넘어오므로 이 시점에는 GPU 연산이 끝나 있음
+        self.times.append(time.perf_counter())
+
+    def end(self):
+        pass
+
+def common_prefix_length(a, b):
+    """두 토큰 ID 텐서의 공통 접두사 길이"""
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    mismatch = (a[:n] != b[:n]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else n
+
+class QwenConversation:
+    """Qwen2.5-VL과 이미지 한 장으로 여러 턴 대화 (모델의 답변을 다음 턴의 대화 기록에 넣음)
+
+    cache_mode가 "reuse"면 이전 턴에서 만든 past_key_values를 유지하고, 새 턴의 입력 중 캐시와 같은 접두사는 건너뛰고
+    나머지 토큰만 prefill합니다. 이미지 토큰은 접두사에 있으므로 두 번째 턴부터는 비전 인코더를 다시 실행하지 않습니다.
+    """
+    def __init__(self, qwen, image_path, cache_mode="reuse"):
+        self.qwen = qwen
+        self.image_path = image_path
+        self.image = Image.open(image_path)
+        self.cache_mode = cache_mode
+        self.messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        self.past_key_values = None
+        self.cached_ids = None  # past_key_values에 들어 있는 토큰 ID
+
+    def send(self, question):
+        """질문 한 턴을 보내고 (답변, 측정값 딕셔너리) 반환"""
+        if len(self.messages) == 1:
+            # 첫 턴에만 이미지를 넣음
+            self.messages.append({"role": "user", "content": [{"type": "text", "text": question}, {"image": self.image_path}]})
+        else:
+            self.messages.append({"role": "user", "content": [{"type": "text", "text": question}]})
+        processor = self.qwen.processor
+        text = processor.apply_chat_template(self.messages, tokenize=False, add_generation_prompt=True)
+        inputs = processor(text=[text], images=[self.image], return_tensors="pt").to(self.qwen.device)
+        input_ids = inputs.input_ids[0]
+
+        reused = 0
+        if self.cache_mode == "reuse":
+            if self.past_key_values is None:
+                self.past_key_values = DynamicCache()
+            else:
+                # 다시 토큰화한 이전 답변이 생성한 토큰과 다를 수 있으므로 실제로 일치하는 접두사까지만 재사용
+                # (새 토큰이 최소 하나는 prefill되어야 하므로 입력 길이 - 1을 넘지 않음)
+                reused = min(common_prefix_length(self.cached_ids, input_ids.to(self.cached_ids.device)), len(input_ids) - 1)
+                self.past_key_values.crop(reused)
+
+        streamer = TimingStreamer()
+        start_time = time.perf_counter()
+        # past_key_values가 있으면 generate는 캐시 뒤의 토큰만 모델에 넣고, 첫 prefill이 아니면 pixel_values도 넘기지 않음
+        # (M-RoPE 위치 보정값 rope_deltas는 이 대화의 첫 prefill에서 계산된 값을 모델이 그대로 사용)
+        output = self.qwen.model.generate(**inputs, **GENERATION_KWARGS, past_key_values=self.past_key_values,
+                                          streamer=streamer, return_dict_in_generate=True)
+        end_time = time.perf_counter()
+        sequence = output.sequences[0]
+        generated_ids = sequence[len(input_ids):]
+        answer = processor.decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        if self.cache_mode == "reuse":
+            # 마지막으로 생성된 토큰은 아직 캐시에 없음
+            self.cached_ids = sequence[:self.past_key_values.get_seq_length()]
+        self.messages.append({"role": "assistant", "content": [{"type": "text", "text": answer}]})
+
+        # streamer.times[0]은 프롬프트 전달 시점, [1]은 첫 토큰 생성 시점
+        first_token_time = streamer.times[1] if len(streamer.times) > 1 else end_time
+        decode_tokens = max(len(generated_ids) - 1, 0)
+        return answer, {
+            "prompt_tokens": len(input_ids),
+            "reused_tokens": reused,
+            "output_tokens": len(generated_ids),
+            "prefill_time": round(first_token_time - start_time, 4),
+            "decode_time": round(end_time - first_token_time, 4),
+            "decode_time_per_token": round((end_time - first_token_time) / decode_tokens, 4) if decode_tokens else None,
+            "inference_time": round(end_time - start_time, 2),
+        }
+
+    def close(self):
+        """대화의 KV 캐시 해제"""
+        self.past_key_values = None
+        self.cached_ids = None
+        self.image.close()
+        if self.qwen.device == 'cuda':
+            torch.cuda.empty_cache()
+
+def load_jobs():
+    """이미지 파일과 3턴 질문을 짝지어 (이미지 파일명, 질문, 턴 리스트) 리스트로 반환하는 함수"""
+    jobs = []
+    for image_path, question in benchmark_utils.load_jobs():
+        turns = [turn.strip() for turn in question.split('|')]
+        if len(turns) != 3:
+            print(f"잘못된 질문 형식: {question}")
+            continue
+        jobs.append((image_path, question, turns))
+    return jobs
+
+def is_conversation_done(writer, checkpoint, image_path, turns, cache_mode):
+    """대화의 모든 턴이 이미 기록되었는지 확인"""
+    return all(writer.is_done(model=checkpoint, image=os.path.basename(image_path), turn=turn_idx, cache_mode=cache_mode)
+               for turn_idx in range(1, len(turns) + 1))
+
+def print_turn_summary(rows):
+    """턴 번호와 캐시 방식별 평균 prefill/디코딩 시간, 입력/재사용 토큰 수, 그리고 방식 간 응답 일치율 출력"""
+    groups = {}
+    for row in rows:
+        groups.setdefault((row["turn"], row["cache_mode"]), []).append(row)
+    for (turn, cache_mode), group in sorted(groups.items()):
+        n = len(group)
+        print(f"턴 {turn} / {cache_mode} - 입력 토큰: {sum(r['prompt_tokens'] for r in group) / n:.0f} / "
+              f"재사용 토큰: {sum(r['reused_tokens'] for r in group) / n:.0f} / "
+              f"prefill: {sum(r['prefill_time'] for r in group) / n:.3f}초 / "
+              f"디코딩: {sum(r['decode_time'] for r in group) / n:.3f}초 / 출력 토큰: {sum(r['output_tokens'] for r in group) / n:.0f}")
+
+    # greedy 디코딩이므로 캐시 재사용 여부와 관계없이 같은 답변이 나와야 함 (수치 오차로 드물게 달라질 수 있음)
+    responses = {}
+    for row in rows:
+        responses.setdefault((row["model"], row["image"], row["turn"]), {})[row["cache_mode"]] = row["response"]
+    pairs = [modes for modes in responses.values() if len(modes) > 1]
+    if pairs:
+        same = sum(1 for modes in pairs if len(set(modes.values())) == 1)
+        print(f"캐시 방식 간 응답 일치: {same}/{len(pairs)}턴")
+
+def run_tests():
+    jobs = load_jobs()
+    if not jobs:
+        return
+
+    preprocessor = PreprocessCache() if PREPROCESS else None
+    writer = ResultWriter(RESULTS_FILE, RESULT_FIELDS, key_fields=["model", "image", "turn", "cache_mode"])
+    turn_rows = []
+
+    for checkpoint in MODELS_TO_TEST['qwen']:
+        todo = [(image_path, question, turns, cache_mode) for image_path, question, turns in jobs for cache_mode in CACHE_MODES
+                if not is_conversation_done(writer, checkpoint, image_path, turns, cache_mode)]
+        if not todo:
+            continue
+
+        qwen_instance = QwenModel(checkpoint, device=DEVICE, quantize=CPU_QUANTIZE, num_threads=CPU_THREADS)
+        if not qwen_instance.initialize():
+            continue
+
+        for image_path, question, turns, cache_mode in todo:
+            full_image_path = input_image_path(preprocessor, os.path.join('data', 'images', image_path), checkpoint)
+            print(f"모델: {checkpoint} / 이미지: {os.path.basename(image_path)} / KV 캐시: {cache_mode}")
+
+            conversation = QwenConversation(qwen_instance, full_image_path, cache_mode)
+            try:
+                for turn_idx, question_part in enumerate(turns, start=1):
+                    answer, timing = conversation.send(question_part)
+                    print(f"질문: {question_part}")
+                    print(f"답변: {answer} (prefill: {timing['prefill_time']:.3f}초 / 디코딩: {timing['decode_time']:.3f}초 / "
+                          f"재사용 토큰: {timing['reused_tokens']}/{timing['prompt_tokens']})")
+                    row = dict({
+                        "model": checkpoint,
+                        "image": os.path.basename(image_path),
+                        "turn": turn_idx,
+                        "question": question,
+                        "response": answer,
+                        "cache_mode": cache_mode,
+                    }, **timing)
+                    turn_rows.append(row)
+                    # 이어서 실행하는 대화는 이미 기록된 턴을 다시 쓰지 않음
+                    if not writer.is_done(model=checkpoint, image=os.path.basename(image_path), turn=turn_idx, cache_mode=cache_mode):
+                        writer.write(row)
+            except RuntimeError as e:
+                # 실패한 대화는 남은 턴을 건너뛰고 다음 대화로 진행 (재실행 시 다시 시도)
+                print(f"Error: {str(e)}")
+            finally:
+                conversation.close()
+
+        qwen_instance.clear()
+
+    print_turn_summary(turn_rows)
+    if preprocessor is not None:
+        preprocessor.report()
+    writer.close()
+
+if __name__ == '__main__':
+    run_tests()
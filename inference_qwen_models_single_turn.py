@@ -1,9 +1,18 @@
 import os
-import csv
+import gc
 import time
+import argparse
+import resource
+import threading
 import torch
 from PIL import Image
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor
+from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, TextIteratorStreamer
+from transformers.models.qwen2_vl.image_processing_qwen2_vl import smart_resize
+from response_cache import ResponseCache
+from result_writer import ResultWriter
+from benchmark_utils import encode_image_to_binary, list_image_files, load_questions
+from image_preprocess import PreprocessCache, profile_for
+from structured_output import CONTACT_SCHEMA
 
 
 # 테스트할 모델 리스트
@@ -15,128 +24,603 @@ MODELS_TO_TEST = {
     ]
 }
 
+# 배치 추론 설정 (BATCH_SIZE가 None이면 가용 메모리로 자동 결정, 1이면 이미지별 추론)
+BATCH_SIZE = None
+MAX_BATCH_SIZE = 16
+# greedy 디코딩 (배치와 단건 추론 결과가 거의 같지만, 패딩에 따른 수치 오차로 드물게 달라질 수 있음: --check-batch로 확인)
+GENERATION_KWARGS = {"max_new_tokens": 200, "do_sample": False}
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+# 이미지 전처리 (True면 방향 보정, 여백 자르기, 1024 비전 토큰 예산에 맞춰 28의 배수 크기로 축소한 이미지를 사용)
+PREPROCESS = True
+
+# 결과 파일 (.csv 또는 .jsonl, 행이 끝나는 대로 추가되며 같은 실행 ID로 재실행하면 완료된 작업은 건너뜀)
+RESULTS_FILE = "qwen_results.csv"
+RESULT_FIELDS = ["model", "image", "question", "response", "inference_time",
+                 "batch_id", "batch_size", "batch_time", "cached", "max_pixels", "offload", "peak_memory_mb", "error"]
+
+# 메모리 부족(OOM) 대응: 배치를 반으로 나누고, 한 장도 안 되면 픽셀 예산을 반으로 줄이고 (OOM_MIN_PIXELS까지),
+# 그래도 안 되면 CPU 오프로딩으로 모델을 다시 로드 (OOM_OFFLOAD), 모든 단계가 실패한 이미지는 error로 기록
+OOM_MIN_PIXELS = 256 * 28 * 28
+OOM_OFFLOAD = True
+# 오프로딩 시 가중치에 쓸 남은 GPU 메모리 비율 (나머지는 활성값/KV 캐시 여유분) 과 디스크 오프로딩 폴더
+OFFLOAD_GPU_FRACTION = 0.7
+OFFLOAD_DIR = os.path.join("cache", "offload")
+
+# 체크포인트별 단계(load/preprocess/inference)의 최대 메모리 기록 파일
+MEMORY_FILE = os.path.join("results", "qwen_memory.csv")
+MEMORY_FIELDS = ["model", "stage", "device", "offload", "batch_size", "max_pixels", "images", "oom_retries",
+                 "peak_cuda_mb", "peak_rss_mb", "elapsed", "error"]
+
+# 실행 장치 설정 (DEVICE가 None이면 GPU 유무로 결정, "cpu"면 SDPA + 스레드 수 지정 + 선택적 int8 양자화)
+DEVICE = None
+CPU_QUANTIZE = False
+CPU_THREADS = None
+
 class QwenModel:
-    def __init__(self, checkpoint):
+    def __init__(self, checkpoint, device=None, torch_dtype=None, quantize=False, num_threads=None):
         self.checkpoint = checkpoint
+        # device가 None이면 GPU가 있을 때 cuda, 없으면 cpu 사용
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        # cuda는 bf16, cpu는 fp32가 기본값 (cpu에서 bf16은 AVX512-BF16 지원 CPU에서만 빠름)
+        self.torch_dtype = torch_dtype or (torch.bfloat16 if self.device == 'cuda' else torch.float32)
+        self.quantize = quantize  # cpu 전용: nn.Linear 동적 int8 양자화
+        self.num_threads = num_threads  # cpu 전용: None이면 전체 코어 사용
         self.model = None
         self.processor = None
+        self.json_prefix_fn = None
+        self.offload = False
         
-    def initialize(self):
-        """Qwen 모델 초기화"""
-        print(f"\n{self.checkpoint} 모델 초기화 중...")
+    def initialize(self, offload=False):
+        """Qwen 모델 초기화 (offload=True면 GPU에는 가중치 일부만 올리고 나머지 층은 CPU/디스크에 둠)"""
+        self.offload = offload
+        print(f"\n{self.checkpoint} 모델 초기화 중... (device: {self.device}, dtype: {self.torch_dtype}, int8: {self.quantize}, 오프로딩: {offload})")
         try:
-            self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-                self.checkpoint,
-                torch_dtype=torch.bfloat16,
-                attn_implementation="flash_attention_2",
-                device_map="auto"
-            )
+            if self.device == 'cuda':
+                offload_kwargs = {}
+                if offload:
+                    # device_map="auto"는 GPU를 가중치로 가득 채우므로 여유분을 남기도록 GPU별 한도를 지정
+                    max_memory = {i: int(torch.cuda.mem_get_info(i)[0] * OFFLOAD_GPU_FRACTION) for i in range(torch.cuda.device_count())}
+                    max_memory["cpu"] = int(os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') * 0.8)
+                    offload_kwargs = {"max_memory": max_memory, "offload_folder": OFFLOAD_DIR}
+                self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+                    self.checkpoint,
+                    torch_dtype=self.torch_dtype,
+                    attn_implementation="flash_attention_2",
+                    device_map="auto",
+                    **offload_kwargs
+                )
+            else:
+                torch.set_num_threads(self.num_threads or os.cpu_count())
+                # flash_attention_2는 CUDA 전용이므로 cpu에서는 SDPA 사용
+                self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+                    self.checkpoint,
+                    torch_dtype=self.torch_dtype,
+                    attn_implementation="sdpa",
+                    low_cpu_mem_usage=True
+                )
+                self.model.eval()
+                if self.quantize:
+                    self.model = torch.ao.quantization.quantize_dynamic(
+                        self.model, {torch.nn.Linear}, dtype=torch.qint8
+                    )
             self.processor = AutoProcessor.from_pretrained(self.checkpoint)
             print(f"{self.checkpoint} 모델 초기화 완료")
             return True
         except RuntimeError as e:
-            if "out of memory" in str(e):
-                print(f"GPU 메모리 부족: {self.checkpoint} 모델 스킵")
+            if is_oom(e):
+                self.clear()
+                free_memory(self.device)
+                if self.device == 'cuda' and not offload and OOM_OFFLOAD:
+                    print(f"GPU 메모리 부족: {self.checkpoint} 모델을 CPU 오프로딩으로 다시 로드")
+                    return self.initialize(offload=True)
+                print(f"메모리 부족: {self.checkpoint} 모델 스킵")
             else:
                 print(f"모델 초기화 실패: {str(e)}")
             return False
             
+    def cache_params(self):
+        """응답 캐시 키에 넣을 생성 파라미터 (dtype/양자화에 따라 출력이 달라지므로 포함)"""
+        return dict(GENERATION_KWARGS, torch_dtype=str(self.torch_dtype), quantize=self.quantize)
+
+    def vision_tokens(self, image):
+        """프로세서가 리사이즈한 뒤의 이미지 토큰 수 (해상도 버킷 기준)"""
+        image_processor = self.processor.image_processor
+        factor = image_processor.patch_size * image_processor.merge_size
+        height, width = smart_resize(image.height, image.width, factor=factor,
+                                     min_pixels=image_processor.min_pixels,
+                                     max_pixels=image_processor.max_pixels)
+        return (height // factor) * (width // factor)
+
+    def auto_batch_size(self, max_seq_len):
+        """가용 메모리와 시퀀스당 KV 캐시 크기로 배치 크기를 추정"""
+        config = getattr(self.model.config, "text_config", self.model.config)
+        head_dim = config.hidden_size // config.num_attention_heads
+        dtype_bytes = torch.finfo(self.model.dtype).bits // 8
+        kv_bytes_per_token = 2 * config.num_hidden_layers * config.num_key_value_heads * head_dim * dtype_bytes
+        # 활성값과 비전 인코더 사용량을 감안해 KV 캐시의 4배를 샘플당 사용량으로 가정
+        bytes_per_sample = 4 * kv_bytes_per_token * (max_seq_len + GENERATION_KWARGS["max_new_tokens"])
+
+        if self.device == 'cuda':
+            free_bytes, _ = torch.cuda.mem_get_info()
+        else:
+            free_bytes = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+        return max(1, min(MAX_BATCH_SIZE, int(free_bytes * 0.8) // bytes_per_sample))
+
+    def generate(self, image_paths, questions, prefix_allowed_tokens_fn=None):
+        """이미지/질문 여러 쌍을 한 번의 processor/generate 호출로 추론 (왼쪽 패딩)
+
+        prefix_allowed_tokens_fn을 주면 매 디코딩 단계에서 허용된 토큰만 생성 (JSON 스키마 제한 디코딩 등)
+        """
+        images = [Image.open(image_path) for image_path in image_paths]
+        texts = [
+            self.processor.apply_chat_template(build_messages(image_path, question), tokenize=False, add_generation_prompt=True)
+            for image_path, question in zip(image_paths, questions)
+        ]
+        # 배치 생성은 새 토큰이 오른쪽에 붙으므로 패딩은 왼쪽에 둬야 함
+        self.processor.tokenizer.padding_side = "left"
+        inputs = self.processor(text=texts, images=images, padding=True, return_tensors="pt")
+        inputs = inputs.to(self.device)
+
+        output_ids = self.model.generate(**inputs, **GENERATION_KWARGS, prefix_allowed_tokens_fn=prefix_allowed_tokens_fn)
+        generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in zip(inputs.input_ids, output_ids)]
+        return self.processor.batch_decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+
+    def json_prefix_allowed_tokens_fn(self):
+        """CONTACT_SCHEMA 형식의 JSON만 생성하도록 제한하는 prefix_allowed_tokens_fn (처음 한 번만 만들어 재사용)"""
+        # 제한 디코딩은 선택 의존성 lm-format-enforcer 사용 (pip install lm-format-enforcer)
+        if self.json_prefix_fn is None:
+            try:
+                from lmformatenforcer import JsonSchemaParser
+                from lmformatenforcer.integrations.transformers import build_transformers_prefix_allowed_tokens_fn
+            except ImportError:
+                raise ImportError("Qwen 구조화 출력에는 lm-format-enforcer가 필요합니다: pip install lm-format-enforcer")
+            self.json_prefix_fn = build_transformers_prefix_allowed_tokens_fn(
+                self.processor.tokenizer, JsonSchemaParser(CONTACT_SCHEMA))
+        return self.json_prefix_fn
+
+    def stream(self, image_path, question):
+        """이미지/질문 한 쌍을 추론하며 디코딩된 텍스트 조각을 생성되는 대로 반환 (generate는 별도 스레드에서 실행)"""
+        image = Image.open(image_path)
+        text = self.processor.apply_chat_template(build_messages(image_path, question), tokenize=False, add_generation_prompt=True)
+        inputs = self.processor(text=[text], images=[image], return_tensors="pt").to(self.device)
+
+        streamer = TextIteratorStreamer(self.processor.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        thread = threading.Thread(target=self.model.generate, kwargs=dict(inputs, streamer=streamer, **GENERATION_KWARGS))
+        thread.start()
+        try:
+            yield from streamer
+        finally:
+            thread.join()
+
     def clear(self):
         """GPU 메모리 해제"""
         if self.model is not None:
             del self.model
             del self.processor
-            torch.cuda.empty_cache()
+            if self.device == 'cuda':
+                torch.cuda.empty_cache()
             self.model = None
             self.processor = None
+            self.json_prefix_fn = None
+
+def is_oom(e):
+    """GPU/CPU 메모리 부족 예외인지 확인"""
+    return isinstance(e, MemoryError) or "out of memory" in str(e) or "can't allocate memory" in str(e)
+
+def free_memory(device):
+    """OOM 뒤 남은 텐서를 정리하고 캐시된 GPU 메모리 반환"""
+    gc.collect()
+    if device == 'cuda':
+        torch.cuda.empty_cache()
+
+def peak_rss_mb():
+    """현재 프로세스의 최대 RSS(MB) 반환 (Linux의 ru_maxrss 단위는 KB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def reset_peak_memory(device):
+    """단계별 최대 GPU 메모리를 재기 위해 기록 초기화 (RSS 최대값은 프로세스 단위라 초기화할 수 없음)"""
+    if device == 'cuda':
+        for i in range(torch.cuda.device_count()):
+            torch.cuda.reset_peak_memory_stats(i)
+
+def peak_cuda_mb(device):
+    """마지막 초기화 이후 모든 GPU의 최대 할당량 합(MB), cpu면 None"""
+    if device != 'cuda':
+        return None
+    return sum(torch.cuda.max_memory_allocated(i) for i in range(torch.cuda.device_count())) / 1024**2
+
+def memory_row(qwen_instance, stage, start_time, **settings):
+    """메모리 기록 파일에 쓸 단계 행 (최대 GPU 메모리는 reset_peak_memory 이후 기준)"""
+    return dict({
+        "model": qwen_instance.checkpoint,
+        "stage": stage,
+        "device": qwen_instance.device,
+        "offload": qwen_instance.offload,
+        "peak_cuda_mb": peak_cuda_mb(qwen_instance.device),
+        "peak_rss_mb": peak_rss_mb(),
+        "elapsed": round(time.perf_counter() - start_time, 2),
+    }, **settings)
+
+class OomPolicy:
+    """메모리 부족(OOM)이면 설정을 한 단계씩 낮춰 같은 작업을 다시 시도하고, 맞는 설정을 기억해 이후 배치부터 바로 사용
+
+    순서: 배치를 반으로 나눔 → 한 장이면 픽셀 예산을 반으로 (OOM_MIN_PIXELS까지) → CPU 오프로딩으로 모델을 다시 로드.
+    모든 단계가 실패한 이미지는 error가 채워진 결과로 돌려주므로 다음 이미지는 계속 처리되고, 재실행 시 다시 시도됩니다.
+    """
+    def __init__(self, qwen_instance, preprocessor=None):
+        self.qwen = qwen_instance
+        self.preprocessor = preprocessor
+        # 픽셀 예산을 줄일 때는 PREPROCESS가 꺼져 있어도 전처리 캐시 사용
+        self.fallback_preprocessor = preprocessor
+        self.max_batch_size = None  # None이면 제한 없음
+        self.max_pixels = None  # None이면 모델 프로필 기본값 (전처리하지 않으면 원본)
+        self.oom_retries = 0
+        self.largest_batch = 0
+        self.peak_cuda_mb = None
+
+    def image_path(self, source_path):
+        """현재 픽셀 예산으로 준비한 이미지 경로"""
+        if self.max_pixels is None:
+            return input_image_path(self.preprocessor, source_path, self.qwen.checkpoint)
+        if self.fallback_preprocessor is None:
+            self.fallback_preprocessor = PreprocessCache()
+        profile = dict(profile_for(self.qwen.checkpoint), max_pixels=self.max_pixels)
+        return self.fallback_preprocessor.prepare(source_path, self.qwen.checkpoint, profile)["path"]
+
+    def reduce(self, batch_size):
+        """OOM 뒤 한 단계 낮은 설정으로 바꾸고 True 반환 (더 낮출 설정이 없으면 False)"""
+        self.oom_retries += 1
+        free_memory(self.qwen.device)
+        if batch_size > 1:
+            self.max_batch_size = batch_size // 2
+            print(f"메모리 부족: 배치 크기를 {self.max_batch_size}로 줄여 다시 시도")
+            return True
+
+        default_pixels = profile_for(self.qwen.checkpoint)["max_pixels"]
+        if self.max_pixels is None:
+            max_pixels = default_pixels if self.preprocessor is None else default_pixels // 2
+        else:
+            max_pixels = self.max_pixels // 2
+        if max_pixels >= OOM_MIN_PIXELS:
+            self.max_pixels = max_pixels
+            print(f"메모리 부족: 픽셀 예산을 {max_pixels // (28 * 28)} 비전 토큰으로 줄여 다시 시도")
+            return True
+
+        if OOM_OFFLOAD and self.qwen.device == 'cuda' and not self.qwen.offload:
+            print("메모리 부족: CPU 오프로딩으로 모델을 다시 로드해 다시 시도")
+            self.qwen.clear()
+            if not self.qwen.initialize(offload=True):
+                return False
+            # 오프로딩으로 여유가 생겼으므로 픽셀 예산은 기본값부터 다시 시작
+            self.max_pixels = None
+            return True
+        return False
+
+    def run(self, source_paths, questions):
+        """이미지/질문 배치를 추론해 항목별 결과 딕셔너리 리스트 반환 (response 또는 error, 사용한 이미지와 설정, 시간, 최대 메모리)"""
+        if self.qwen.model is None:
+            return [{"error": "모델이 로드되어 있지 않습니다."} for _ in source_paths]
+        if self.max_batch_size is not None and len(source_paths) > self.max_batch_size:
+            n = self.max_batch_size
+            return [result for i in range(0, len(source_paths), n)
+                    for result in self.run(source_paths[i:i + n], questions[i:i + n])]
+
+        image_paths = [self.image_path(source_path) for source_path in source_paths]
+        reset_peak_memory(self.qwen.device)
+        start_time = time.perf_counter()
+        try:
+            response_texts = self.qwen.generate(image_paths, questions)
+        except (RuntimeError, MemoryError) as e:
+            if not is_oom(e):
+                raise
+            if self.reduce(len(source_paths)):
+                return self.run(source_paths, questions)
+            print(f"메모리 부족: 더 낮출 설정이 없어 이미지 {len(source_paths)}장을 실패로 기록")
+            return [{"error": f"메모리 부족: {str(e)}", "image_path": image_path, "max_pixels": self.max_pixels,
+                     "offload": self.qwen.offload} for image_path in image_paths]
+
+        batch_time = time.perf_counter() - start_time
+        peak = peak_cuda_mb(self.qwen.device)
+        if peak is not None:
+            self.peak_cuda_mb = max(self.peak_cuda_mb or 0.0, peak)
+        self.largest_batch = max(self.largest_batch, len(source_paths))
+        print(f"배치 추론 시간: {batch_time:.2f}초 / 배치 크기: {len(source_paths)} / 샘플당: {batch_time / len(source_paths):.2f}초"
+              + (f" / 최대 GPU 메모리: {peak:.0f}MB" if peak is not None else ""))
+        return [{
+            "response": response_text,
+            "image_path": image_path,
+            "inference_time": round(batch_time / len(source_paths), 2),
+            "batch_size": len(source_paths),
+            "batch_time": round(batch_time, 2),
+            "max_pixels": self.max_pixels,
+            "offload": self.qwen.offload,
+            "peak_memory_mb": round(peak if peak is not None else peak_rss_mb()),
+        } for image_path, response_text in zip(image_paths, response_texts)]
+
+    def memory_row(self, start_time, images):
+        """추론 단계 전체의 메모리 기록 행 (최대 GPU 메모리는 배치별 최대값 중 가장 큰 값)"""
+        row = memory_row(self.qwen, "inference", start_time, batch_size=self.largest_batch or None,
+                         max_pixels=self.max_pixels, images=images, oom_retries=self.oom_retries)
+        row["peak_cuda_mb"] = self.peak_cuda_mb
+        return row
+
+def build_messages(image_path, question):
+    """시스템/사용자 메시지를 Qwen chat template 형식으로 구성"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": [
+            {"type": "text", "text": question},
+            {"image": image_path},
+        ]},
+    ]
+
+def input_image_path(preprocessor, image_path, checkpoint):
+    """모델에 넣을 이미지 경로 (preprocessor가 있으면 전처리 캐시에 저장된 이미지 경로)"""
+    if preprocessor is None:
+        return image_path
+    return preprocessor.prepare(image_path, checkpoint)["path"]
 
 def load_data():
     """테스트용 이미지와 질문 로드"""
-    image_files = sorted(os.listdir(os.path.join("data", "images")), 
-                    key=lambda x: int(''.join(filter(str.isdigit, x))))
+    image_files = list_image_files()
     if not image_files:
         raise FileNotFoundError("이미지 파일을 찾을 수 없습니다.")
 
-    with open(os.path.join("data", "questions.txt"), 'r', encoding='utf-8') as f:
-        questions = [line.strip() for line in f if line.strip()]
+    questions = load_questions()
     if not questions:
         raise FileNotFoundError("질문 파일이 비어있습니다.")
 
     return image_files, questions
 
-def run_inference(qwen_instance, image_path, question):
-    """Qwen 모델 추론 실행"""
-    print(f"\n=== {qwen_instance.checkpoint} 추론 시작 ===")
-    if torch.cuda.is_available():
-        print(f"GPU 메모리: {torch.cuda.memory_allocated()/1024**3:.2f}GB")
-    
-    start_time = time.time()
+def make_batches(qwen_instance, image_paths, batch_size=None):
+    """이미지를 비전 토큰 수로 정렬해 비슷한 해상도끼리 배치로 묶는 함수 (인덱스 리스트의 리스트 반환)"""
+    tokens = []
+    for image_path in image_paths:
+        with Image.open(image_path) as image:
+            tokens.append(qwen_instance.vision_tokens(image))
+    order = sorted(range(len(image_paths)), key=lambda i: tokens[i])
+
+    if batch_size is None:
+        # 가장 긴 이미지 기준으로 텍스트 여유분 512 토큰을 더해 배치 크기 추정
+        batch_size = qwen_instance.auto_batch_size(max(tokens) + 512)
+        print(f"자동 배치 크기: {batch_size}")
+
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+def result_row(checkpoint, image_file, question, result, batch_idx=None):
+    """OomPolicy.run의 항목 결과를 결과 파일 행으로 구성 (실패하면 error만 채워짐)"""
+    return {
+        "model": checkpoint,
+        "image": image_file,
+        "question": question,
+        "response": result.get("response"),
+        "inference_time": result.get("inference_time"),
+        "batch_id": batch_idx,
+        "batch_size": result.get("batch_size"),
+        "batch_time": result.get("batch_time"),
+        "cached": False,
+        "max_pixels": result.get("max_pixels"),
+        "offload": result.get("offload"),
+        "peak_memory_mb": result.get("peak_memory_mb"),
+        "error": result.get("error"),
+    }
+
+def load_model(checkpoint, memory_writer):
+    """모델을 로드하고 로드 단계의 최대 메모리를 기록 (실패하면 None)"""
+    qwen_instance = QwenModel(checkpoint, device=DEVICE, quantize=CPU_QUANTIZE, num_threads=CPU_THREADS)
+    reset_peak_memory(qwen_instance.device)
+    start_time = time.perf_counter()
+    loaded = qwen_instance.initialize()
+    memory_writer.write(dict(memory_row(qwen_instance, "load", start_time), error=None if loaded else "모델 로드 실패"))
+    return qwen_instance if loaded else None
+
+def print_memory_summary(policy, num_samples, num_failed, elapsed):
+    """체크포인트 하나의 처리 결과와 최종 설정(맞는 배치 크기/픽셀 예산/오프로딩) 출력"""
+    print(f"\n{policy.qwen.checkpoint} - 샘플 수: {num_samples} / 실패: {num_failed} / 추론 시간: {elapsed:.2f}초"
+          + (f" / 샘플당 평균: {elapsed / num_samples:.2f}초" if num_samples else ""))
+    print(f"최종 설정 - 최대 배치 크기: {policy.max_batch_size or '제한 없음'} / "
+          f"픽셀 예산: {policy.max_pixels or '기본값'} / 오프로딩: {policy.qwen.offload} / OOM 재시도: {policy.oom_retries}"
+          + (f" / 최대 GPU 메모리: {policy.peak_cuda_mb:.0f}MB" if policy.peak_cuda_mb is not None else "")
+          + f" / 최대 RSS: {peak_rss_mb():.0f}MB")
+
+def run_tests_batched(batch_size=BATCH_SIZE):
+    """해상도 버킷별 배치 추론으로 전체 이미지를 처리하고 샘플당/배치당 지연 시간과 단계별 최대 메모리를 기록
+
+    메모리가 부족하면 OomPolicy가 배치 크기, 픽셀 예산, 오프로딩 순으로 낮춰 다시 시도하므로 남은 이미지를 버리지 않습니다.
+    """
     try:
-        image = Image.open(image_path)
-        messages = [
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": [
-                {"type": "text", "text": question},
-                {"image": image_path},
-            ]},
-        ]
-        
-        text = qwen_instance.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        inputs = qwen_instance.processor(text=[text], images=[image], padding=True, return_tensors="pt")
-        inputs = inputs.to('cuda' if torch.cuda.is_available() else 'cpu')
+        image_files, questions = load_data()
+    except FileNotFoundError as e:
+        print(f"데이터 로드 실패: {str(e)}")
+        return
 
-        output_ids = qwen_instance.model.generate(**inputs, max_new_tokens=200)
-        generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in zip(inputs.input_ids, output_ids)]
-        response_text = qwen_instance.processor.batch_decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)[0]
-        
-        inference_time = round(time.time() - start_time, 2)
-        print(f"추론 시간: {inference_time}초")
-        
-        return response_text, inference_time
-    except RuntimeError as e:
-        if "out of memory" in str(e):
-            print("GPU 메모리 부족으로 추론 실패")
-            return None, None
-        raise
+    image_files, questions = image_files[:len(questions)], questions[:len(image_files)]
+    source_image_paths = [os.path.join('data', 'images', image_path) for image_path in image_files]
+    preprocessor = PreprocessCache() if PREPROCESS else None
+    cache = ResponseCache()
+    writer = ResultWriter(RESULTS_FILE, RESULT_FIELDS, key_fields=["model", "image"])
+    memory_writer = ResultWriter(MEMORY_FILE, MEMORY_FIELDS, key_fields=["model", "stage"], run_id=writer.run_id)
+
+    for checkpoint in MODELS_TO_TEST['qwen']:
+        todo = [i for i in range(len(image_files)) if not writer.is_done(model=checkpoint, image=image_files[i])]
+        if not todo:
+            continue
+
+        qwen_instance = load_model(checkpoint, memory_writer)
+        if qwen_instance is None:
+            continue
+
+        # 응답 캐시 키와 배치 구성은 모델이 실제로 받는 (전처리한) 이미지 기준
+        reset_peak_memory(qwen_instance.device)
+        preprocess_start = time.perf_counter()
+        full_image_paths = [input_image_path(preprocessor, path, checkpoint) for path in source_image_paths]
+        memory_writer.write(memory_row(qwen_instance, "preprocess", preprocess_start, images=len(full_image_paths)))
+        cache_keys = {}
+        pending = []
+        for i in todo:
+            cache_keys[i] = cache.make_key(checkpoint, encode_image_to_binary(full_image_paths[i]), questions[i],
+                                           SYSTEM_PROMPT, qwen_instance.cache_params())
+            cached = cache.get(cache_keys[i])
+            if cached is None:
+                pending.append(i)
+                continue
+            writer.write({
+                "model": checkpoint,
+                "image": image_files[i],
+                "question": questions[i],
+                "response": cached[0],
+                "inference_time": cached[1],
+                "cached": True
+            })
+
+        # 캐시에 없는 작업만 배치로 추론하고, 배치가 끝날 때마다 결과 기록
+        policy = OomPolicy(qwen_instance, preprocessor)
+        inference_start = time.perf_counter()
+        batches = make_batches(qwen_instance, [full_image_paths[i] for i in pending], batch_size) if pending else []
+        num_samples = num_failed = 0
+        for batch_idx, batch in enumerate(batches):
+            batch = [pending[j] for j in batch]
+            print(f"\n=== {checkpoint} 배치 추론 시작 (배치 크기: {len(batch)}) ===")
+            results = policy.run([source_image_paths[i] for i in batch], [questions[i] for i in batch])
+            for i, result in zip(batch, results):
+                writer.write(result_row(checkpoint, image_files[i], questions[i], result, batch_idx))
+                if result.get("error"):
+                    num_failed += 1
+                    continue
+                num_samples += 1
+                # 픽셀 예산을 줄여 얻은 응답은 기본 설정의 응답으로 캐시하지 않음
+                if result["max_pixels"] is None:
+                    cache.put(cache_keys[i], checkpoint, result["response"], result["inference_time"])
+
+        if batches:
+            memory_writer.write(policy.memory_row(inference_start, num_samples))
+            print_memory_summary(policy, num_samples, num_failed, time.perf_counter() - inference_start)
+
+        qwen_instance.clear()
+
+    if preprocessor is not None:
+        preprocessor.report()
+    cache.report()
+    cache.close()
+    writer.close()
+    memory_writer.close()
 
 def run_tests():
-    results = []
     try:
         image_files, questions = load_data()
     except FileNotFoundError as e:
         print(f"데이터 로드 실패: {str(e)}")
         return
+    preprocessor = PreprocessCache() if PREPROCESS else None
+    cache = ResponseCache()
+    writer = ResultWriter(RESULTS_FILE, RESULT_FIELDS, key_fields=["model", "image"])
+    memory_writer = ResultWriter(MEMORY_FILE, MEMORY_FIELDS, key_fields=["model", "stage"], run_id=writer.run_id)
 
     for checkpoint in MODELS_TO_TEST['qwen']:
-        qwen_instance = QwenModel(checkpoint)
-        if not qwen_instance.initialize():
+        jobs = [(image_path, question) for image_path, question in zip(image_files, questions)
+                if not writer.is_done(model=checkpoint, image=os.path.basename(image_path))]
+        if not jobs:
+            continue
+
+        qwen_instance = load_model(checkpoint, memory_writer)
+        if qwen_instance is None:
             continue
 
-        for image_path, question in zip(image_files, questions):
-            full_image_path = os.path.join('data', 'images', image_path)
+        policy = OomPolicy(qwen_instance, preprocessor)
+        inference_start = time.perf_counter()
+        num_samples = num_failed = 0
+        for image_path, question in jobs:
+            source_image_path = os.path.join('data', 'images', image_path)
+            full_image_path = input_image_path(preprocessor, source_image_path, checkpoint)
             print(f"모델: {checkpoint} / 이미지: {os.path.basename(image_path)}")
             
-            response_text, inference_time = run_inference(qwen_instance, full_image_path, question)
-            if response_text is None:  # GPU 메모리 부족으로 실패
-                break
-            
-            results.append({
-                "model": checkpoint,
-                "image": os.path.basename(image_path),
-                "question": question,
-                "response": response_text,
-                "inference_time": inference_time
-            })
+            cache_key = cache.make_key(checkpoint, encode_image_to_binary(full_image_path), question,
+                                       SYSTEM_PROMPT, qwen_instance.cache_params())
+            cached = cache.get(cache_key)
+            if cached is not None:
+                writer.write({
+                    "model": checkpoint,
+                    "image": os.path.basename(image_path),
+                    "question": question,
+                    "response": cached[0],
+                    "inference_time": cached[1],
+                    "cached": True
+                })
+                continue
+
+            # 메모리가 부족하면 픽셀 예산, 오프로딩 순으로 낮춰 다시 시도하고, 그래도 실패하면 error로 기록하고 다음 이미지로 진행
+            result = policy.run([source_image_path], [question])[0]
+            writer.write(result_row(checkpoint, os.path.basename(image_path), question, result))
+            if result.get("error"):
+                num_failed += 1
+                continue
+            num_samples += 1
+            if result["max_pixels"] is None:
+                cache.put(cache_key, checkpoint, result["response"], result["inference_time"])
+
+        if num_samples or num_failed:
+            memory_writer.write(policy.memory_row(inference_start, num_samples))
+            print_memory_summary(policy, num_samples, num_failed, time.perf_counter() - inference_start)
         
         qwen_instance.clear()
 
-    # 결과 저장
-    if results:
-        with open("qwen_results.csv", mode='w', newline='', encoding='utf-8-sig') as f:
-            writer = csv.DictWriter(f, fieldnames=["model", "image", "question", "response", "inference_time"])
-            writer.writeheader()
-            writer.writerows(results)
-        print("\n테스트 결과가 저장되었습니다.")
+    if preprocessor is not None:
+        preprocessor.report()
+    cache.report()
+    cache.close()
+    writer.close()
+    memory_writer.close()
+
+def check_batch_consistency(num_images=8, batch_size=4):
+    """같은 이미지를 배치 추론과 이미지별 추론으로 한 번씩 실행해 응답 일치율 출력 (결과 파일과 응답 캐시는 쓰지 않음)
+
+    Returns:
+        list: 응답이 다른 이미지 파일명 리스트 (모델을 로드하지 못하면 None)
+    """
+    try:
+        image_files, questions = load_data()
+    except FileNotFoundError as e:
+        print(f"데이터 로드 실패: {str(e)}")
+        return None
+    image_files, questions = image_files[:num_images], questions[:num_images]
+    preprocessor = PreprocessCache() if PREPROCESS else None
+    mismatched = []
+
+    for checkpoint in MODELS_TO_TEST['qwen']:
+        qwen_instance = QwenModel(checkpoint, device=DEVICE, quantize=CPU_QUANTIZE, num_threads=CPU_THREADS)
+        if not qwen_instance.initialize():
+            return None
+        image_paths = [input_image_path(preprocessor, os.path.join('data', 'images', image_path), checkpoint)
+                       for image_path in image_files]
+        batched = []
+        for batch in make_batches(qwen_instance, image_paths, batch_size):
+            texts = qwen_instance.generate([image_paths[i] for i in batch], [questions[i] for i in batch])
+            batched.extend(zip(batch, texts))
+        batched = dict(batched)
+        same = 0
+        for i, image_path in enumerate(image_paths):
+            single = qwen_instance.generate([image_path], [questions[i]])[0]
+            if single == batched[i]:
+                same += 1
+            else:
+                mismatched.append(image_files[i])
+                print(f"응답 불일치: {image_files[i]}\n  배치: {batched[i]}\n  단건: {single}")
+        print(f"{checkpoint} - 배치({batch_size})/단건 응답 일치: {same}/{len(image_paths)}장")
+        qwen_instance.clear()
+    return mismatched
 
 if __name__ == '__main__':
-    run_tests()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Qwen2.5-VL 모델로 명함 이미지 질문 응답 추론")
+    parser.add_argument('--check-batch', type=int, default=None, metavar='N',
+                        help="추론 대신 이미지 N장을 배치/단건으로 한 번씩 추론해 응답 일치율만 확인")
+    parser.add_argument('--batch-size', type=int, default=4, help="--check-batch에서 사용할 배치 크기")
+    args = parser.parse_args()
+
+    if args.check_batch:
+        check_batch_consistency(args.check_batch, args.batch_size)
+    elif BATCH_SIZE == 1:
+        run_tests()
+    else:
+        run_tests_batched()
\ No newline at end of file
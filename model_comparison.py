@@ -0,0 +1,139 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from sentence_transformers import SentenceTransformer
+from embedding_store import EmbeddingStore
+
+
+ENCODER_NAME = "all-mpnet-base-v2"
+REFERENCE_FILE = os.path.join("results", "Correct_Answer.csv")
+# 러너가 쓰는 결과 파일 (Gemini_OCR_model.RESULTS_FILE, inference_qwen_models_single_turn.RESULTS_FILE)
+# 러너 모듈은 vertexai/torch를 import하므로 경로만 같게 둠
+RESULT_FILES = [
+    "gemini_results.csv",
+    "qwen_results.csv",
+]
+
+class SimilarityScorer:
+    """Sentence Transformer 인코더를 한 번만 로드해 정답/모델 응답을 배치로 임베딩하고 유사도를 계산하는 클래스
+
+    use_store가 True면 임베딩 저장소에 있는 문장은 다시 인코딩하지 않으며, 모든 문장이 저장소에 있으면 인코더도 로드하지 않습니다.
+    """
+    def __init__(self, model_name=ENCODER_NAME, batch_size=64, use_store=True):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.store = EmbeddingStore(model_name) if use_store else None
+        self._model = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    def encode_new(self, sentences):
+        """인코더로 문장 리스트를 (문장 수, 차원) float32 행렬로 임베딩"""
+        return self.model.encode(list(sentences), batch_size=self.batch_size,
+                                 convert_to_numpy=True, show_progress_bar=False).astype(np.float32)
+
+    def encode(self, sentences):
+        """문장 리스트를 (문장 수, 차원) float32 행렬로 임베딩 (저장소에 있는 문장은 저장된 값 사용)"""
+        if self.store is None:
+            return self.encode_new(sentences)
+        return self.store.get_or_encode(list(sentences), self.encode_new)
+
+    def score(self, references, candidates):
+        """모델별 응답을 정답과 비교한 유사도(dot product) 행렬 반환
+
+        Args:
+            references (list): 정답 문장 리스트 (길이 n)
+            candidates (dict): {모델 이름: 응답 문장 리스트 (길이 n)}
+
+        Returns:
+            pd.DataFrame: (n, 모델 수) 유사도 표. i번째 행은 i번째 정답과 각 모델의 i번째 응답의 유사도
+        """
+        names = list(candidates)
+        n = len(references)
+        # 정답과 모든 모델의 응답을 한 번에 인코딩
+        sentences = list(references) + [sentence for name in names for sentence in candidates[name]]
+        embeddings = self.encode(sentences)
+        reference_embeddings = embeddings[:n]
+        candidate_embeddings = embeddings[n:].reshape(len(names), n, -1)
+
+        # 한 번의 배치 행렬 곱으로 (n, 모델 수) 유사도 표 전체를 계산 (i번째 정답 · 각 모델의 i번째 응답)
+        similarity = np.einsum('mnd,nd->nm', candidate_embeddings, reference_embeddings)
+        return pd.DataFrame(similarity, columns=names)
+
+def model_label(model, result_file):
+    """결과 파일의 model 값으로 표 컬럼 이름 생성 (예전 Gemini 결과처럼 객체 문자열이면 파일 이름 사용)"""
+    model = str(model)
+    if model.startswith("<"):
+        return os.path.splitext(os.path.basename(result_file))[0]
+    return model
+
+def load_results(result_files, turn=1):
+    """결과 파일들을 읽어 {모델 이름: 결과 DataFrame} 반환 (turn 컬럼이 있으면 해당 턴만 사용)"""
+    results = {}
+    for result_file in result_files:
+        df = pd.read_csv(result_file)
+        if "turn" in df.columns and turn is not None:
+            df = df[df.turn == turn]
+        if "model" not in df.columns:
+            df["model"] = model_label("<", result_file)
+        for model, df_model in df.groupby("model", sort=False):
+            results[model_label(model, result_file)] = df_model.reset_index(drop=True)
+    return results
+
+def align(df_ans, results):
+    """정답과 모델 응답을 같은 순서로 맞춤 (image 컬럼이 있으면 이미지 기준, 없으면 행 순서 기준)
+
+    Returns:
+        (정답 문장 리스트, {모델 이름: 응답 문장 리스트}, 이미지 이름 리스트 또는 None)
+    """
+    if "image" in df_ans.columns and all("image" in df.columns for df in results.values()):
+        # 모든 모델이 응답한 이미지만 비교
+        answered = [set(df.image) for df in results.values()]
+        images = [image for image in df_ans.image if all(image in images_ for images_ in answered)]
+        references = df_ans.set_index("image").response.loc[images].tolist()
+        candidates = {name: df.drop_duplicates("image", keep="last").set_index("image").response.loc[images].tolist()
+                      for name, df in results.items()}
+        return references, candidates, images
+
+    n = min([len(df_ans)] + [len(df) for df in results.values()])
+    references = df_ans.response[:n].tolist()
+    candidates = {name: df.response[:n].tolist() for name, df in results.items()}
+    return references, candidates, None
+
+def score_models(reference_file=REFERENCE_FILE, result_files=RESULT_FILES, turn=1, scorer=None):
+    """정답 파일과 결과 파일들로 모델별 유사도 표(pd_score) 생성"""
+    scorer = scorer or SimilarityScorer()
+    df_ans = pd.read_csv(reference_file)
+    results = load_results(result_files, turn=turn)
+    references, candidates, images = align(df_ans, results)
+    candidates = {name: ["" if pd.isna(text) else str(text) for text in texts] for name, texts in candidates.items()}
+
+    pd_score = scorer.score(["" if pd.isna(text) else str(text) for text in references], candidates)
+    if images is not None:
+        pd_score.index = images
+    return pd_score
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="정답과 모델 응답의 임베딩 유사도로 모델 성능 비교")
+    parser.add_argument('--reference', default=REFERENCE_FILE, help="정답 CSV 파일")
+    parser.add_argument('--results', nargs='+', default=RESULT_FILES, help="모델 결과 CSV 파일 (여러 개 가능)")
+    parser.add_argument('--turn', type=int, default=1, help="멀티턴 결과에서 비교할 턴")
+    parser.add_argument('--encoder', default=ENCODER_NAME, help="Sentence Transformer 모델 이름")
+    parser.add_argument('--output', default=os.path.join("results", "similarity_scores.csv"))
+    parser.add_argument('--no-store', action='store_true', help="임베딩 저장소를 사용하지 않고 모두 새로 인코딩")
+    args = parser.parse_args()
+
+    scorer = SimilarityScorer(args.encoder, use_store=not args.no_store)
+    pd_score = score_models(args.reference, args.results, args.turn, scorer)
+    pd_score.to_csv(args.output, encoding='utf-8-sig')
+    if scorer.store is not None:
+        scorer.store.report()
+
+    # 평균 유사도가 높은 순서로 모델 순위 출력
+    print(pd_score.mean().sort_values(ascending=False).to_string())
+    print(f"\n유사도 표가 {args.output} 파일에 저장되었습니다.")
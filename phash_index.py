@@ -0,0 +1,169 @@
+import io
+import os
+import time
+import random
+import hashlib
+import argparse
+import threading
+import numpy as np
+from PIL import Image, ImageOps
+
+
+INDEX_PATH = os.path.join("cache", "phash_index.tsv")
+# 기본값 0: 바이트가 같은(SHA-256이 같은) 이미지만 중복으로 봄
+# 9x8 dHash는 같은 회사 양식에 이름/전화번호만 다른 명함도 거리 0~2로 충돌할 수 있으므로,
+# 근접 중복(다시 찍은 사진/재압축/축소)까지 묶으려면 그 위험을 감수하는 곳에서만 max_distance=NEAR_DISTANCE로 켬
+MAX_DISTANCE = 0
+NEAR_DISTANCE = 2
+
+# numpy 2.0 미만은 np.bitwise_count가 없으므로 바이트별 1의 개수 표로 계산
+POPCOUNT_TABLE = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+def dhash(data, hash_size=8):
+    """이미지 바이트의 64비트 difference hash (EXIF 방향 보정 후 흑백 9x8로 줄여 가로로 이웃한 픽셀의 밝기 비교)"""
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image).convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+        pixels = np.asarray(image, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def hamming_distances(hashes, image_hash):
+    """uint64 배열의 각 해시와 image_hash 사이의 해밍 거리 배열"""
+    diff = hashes ^ np.uint64(image_hash)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(diff)
+    return POPCOUNT_TABLE[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+class PerceptualIndex:
+    """근접 중복 명함 이미지를 찾는 dHash 색인
+
+    해시는 uint64 numpy 배열 하나에 모아 두고 XOR + 비트 수 세기로 전체와의 해밍 거리를 한 번에 계산합니다 (30만 장에서 1ms 이하).
+    각 해시에는 처음 본 이미지의 키(기본값: 이미지 바이트의 SHA-256)와 SHA-256을 함께 저장하며,
+    canonical()은 중복이면 처음 본 이미지의 키를 돌려주므로 응답 캐시 키로 쓰면 이전 추출 결과를 그대로 재사용합니다.
+    max_distance가 0(기본값)이면 SHA-256이 같은 이미지만 중복으로 보고, 0보다 크면 dHash 거리가 그 이하인 이미지도 중복으로 봅니다.
+    dHash는 명함의 배치만 보므로 같은 양식의 다른 사람 명함을 같은 명함으로 볼 수 있어, 근접 중복은 결과를 검토할 수 있는 곳에서만 켭니다.
+    추가한 해시는 path에 한 줄씩 덧붙여 저장하고, 다음 실행에서 다시 읽습니다.
+    """
+    def __init__(self, path=INDEX_PATH, max_distance=MAX_DISTANCE):
+        self.path = path
+        self.max_distance = max_distance
+        self.hashes = np.zeros(1024, dtype=np.uint64)
+        self.keys = []
+        self.digests = {}  # SHA-256 -> 대표 키
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    # 해시, 키, SHA-256 (SHA-256 칸이 없는 이전 형식은 키가 SHA-256)
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) >= 2 and parts[1]:
+                        self.append(int(parts[0], 16), parts[1], parts[2] if len(parts) > 2 else parts[1])
+        self.file = None
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.file = open(path, 'a', encoding='utf-8')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def append(self, image_hash, key, digest=None):
+        """배열이 차면 두 배로 늘려 해시 추가 (잠금은 호출하는 쪽에서)"""
+        if len(self.keys) == len(self.hashes):
+            self.hashes = np.concatenate([self.hashes, np.zeros(len(self.hashes), dtype=np.uint64)])
+        self.hashes[len(self.keys)] = image_hash
+        self.keys.append(key)
+        if digest is not None:
+            self.digests.setdefault(digest, key)
+
+    def nearest(self, image_hash, max_distance):
+        """가장 가까운 해시의 (키, 거리) 반환 (max_distance보다 멀거나 색인이 비어 있으면 None, 잠금은 호출하는 쪽에서)"""
+        if not self.keys:
+            return None
+        distances = hamming_distances(self.hashes[:len(self.keys)], image_hash)
+        index = int(distances.argmin())
+        if distances[index] > max_distance:
+            return None
+        return self.keys[index], int(distances[index])
+
+    def find(self, image_hash, max_distance=None):
+        """가장 가까운 해시의 (키, 거리) 반환 (max_distance보다 멀거나 색인이 비어 있으면 None)"""
+        with self.lock:
+            return self.nearest(image_hash, self.max_distance if max_distance is None else max_distance)
+
+    def add(self, image_hash, key, digest=None):
+        with self.lock:
+            self.record(image_hash, key, digest)
+
+    def record(self, image_hash, key, digest=None):
+        """해시를 추가하고 파일에 한 줄 덧붙임 (잠금은 호출하는 쪽에서)"""
+        digest = digest or key
+        self.append(image_hash, key, digest)
+        if self.file is not None:
+            self.file.write(f"{image_hash:016x}\t{key}\t{digest}\n")
+            self.file.flush()
+
+    def canonical(self, data, key=None):
+        """이미지의 대표 키와 거리 반환 (중복이면 처음 본 이미지의 키, 아니면 이 이미지의 키를 색인에 추가하고 거리 0)
+
+        SHA-256이 같은 이미지는 항상 중복이며, dHash 거리로 찾은 근접 중복은 max_distance가 0보다 클 때만 씁니다.
+
+        Args:
+            data: 이미지 바이트
+            key: 이 이미지의 키 (None이면 SHA-256)
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        key = key or digest
+        image_hash = dhash(data)
+        # 찾기와 추가 사이에 다른 스레드가 같은 명함을 추가하지 않도록 한 번에 처리
+        with self.lock:
+            if digest in self.digests:
+                self.exact_hits += 1
+                return self.digests[digest], 0
+            match = self.nearest(image_hash, self.max_distance) if self.max_distance > 0 else None
+            if match is not None:
+                self.near_hits += 1
+                return match
+            self.misses += 1
+            self.record(image_hash, key, digest)
+            return key, 0
+
+    def report(self):
+        total = self.exact_hits + self.near_hits + self.misses
+        if total:
+            print(f"중복 색인 - 같은 이미지: {self.exact_hits} / 근접 중복: {self.near_hits} / 새 이미지: {self.misses} / "
+                  f"색인 크기: {len(self)} / 최대 거리: {self.max_distance}")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="무작위 해시 색인으로 근접 중복 조회 시간 측정")
+    parser.add_argument('--size', type=int, default=300000, help="색인에 넣을 해시 수")
+    parser.add_argument('--queries', type=int, default=1000, help="조회 횟수")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    index = PerceptualIndex(path=None, max_distance=NEAR_DISTANCE)
+    for i in range(args.size):
+        index.append(rng.getrandbits(64), str(i))
+    # 절반은 색인에 있는 해시에서 비트 몇 개만 바꾼 근접 중복, 절반은 새 해시
+    queries = []
+    for i in range(args.queries):
+        if i % 2 == 0:
+            image_hash = int(index.hashes[rng.randrange(args.size)])
+            for bit in rng.sample(range(64), rng.randint(0, NEAR_DISTANCE)):
+                image_hash ^= 1 << bit
+        else:
+            image_hash = rng.getrandbits(64)
+        queries.append(image_hash)
+
+    start_time = time.perf_counter()
+    found = sum(index.find(image_hash) is not None for image_hash in queries)
+    elapsed = time.perf_counter() - start_time
+    print(f"색인 {args.size}개 / 조회 {args.queries}번 / 중복 {found}개 / 조회당 {elapsed / args.queries * 1000:.3f}ms")
@@ -0,0 +1,255 @@
+import io
+import json
+import time
+import queue
+import base64
+import argparse
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from benchmark_utils import latency_summary
+from image_preprocess import PreprocessCache
+from structured_output import JSON_EXTRACTION_PROMPT
+
+
+CHECKPOINT = "Qwen/Qwen2.5-VL-3B-Instruct"
+HOST = "127.0.0.1"
+PORT = 8008
+
+# 동적 배치: 첫 요청이 들어온 뒤 BATCH_WINDOW초 동안 들어온 요청을 최대 MAX_BATCH_SIZE개까지 한 번의 generate로 처리
+MAX_BATCH_SIZE = 8
+BATCH_WINDOW = 0.02
+# 지연 시간 통계에 쓸 최근 요청/배치 수
+METRICS_WINDOW = 1000
+
+class BatchQueue:
+    """요청을 모아 동적 배치로 추론하는 큐
+
+    워커 스레드 하나가 첫 요청을 기다렸다가 batch_window초 동안 들어온 요청을 max_batch_size개까지 모아
+    qwen.generate 한 번으로 처리합니다. JSON 요청(제한 디코딩)과 일반 요청은 같은 배치에 섞지 않습니다.
+    배치가 메모리 부족으로 실패하면 요청을 하나씩 다시 처리합니다.
+    """
+    def __init__(self, qwen, max_batch_size=MAX_BATCH_SIZE, batch_window=BATCH_WINDOW):
+        self.qwen = qwen
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.batch_sizes = Counter()
+        self.queue_times = deque(maxlen=METRICS_WINDOW)
+        self.batch_times = deque(maxlen=METRICS_WINDOW)
+        self.latencies = deque(maxlen=METRICS_WINDOW)
+        self.started_at = time.time()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, image, prompt, json_mode=False):
+        """요청을 큐에 넣고 {"text", "output_tokens", "queue_time", "batch_size", "batch_time", "latency"}를 돌려줄 Future 반환"""
+        future = Future()
+        self.queue.put({"image": image, "prompt": prompt, "json": json_mode, "future": future,
+                        "enqueued_at": time.perf_counter()})
+        with self.lock:
+            self.requests += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return future
+
+    def collect(self):
+        """첫 요청을 기다린 뒤 batch_window 안에 들어온 요청을 max_batch_size개까지 모아 반환"""
+        items = [self.queue.get()]
+        deadline = time.perf_counter() + self.batch_window
+        while len(items) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def run(self):
+        while True:
+            items = self.collect()
+            for json_mode in (True, False):
+                group = [item for item in items if item["json"] == json_mode]
+                if group:
+                    self.process(group)
+
+    def generate(self, items):
+        prefix_fn = self.qwen.json_prefix_allowed_tokens_fn() if items[0]["json"] else None
+        return self.qwen.generate([item["image"] for item in items], [item["prompt"] for item in items],
+                                  prefix_allowed_tokens_fn=prefix_fn)
+
+    def process(self, items):
+        """배치 하나를 추론하고 요청마다 결과(또는 예외)를 Future에 전달"""
+        start_time = time.perf_counter()
+        try:
+            texts = self.generate(items)
+        except RuntimeError as e:
+            if "out of memory" not in str(e) or len(items) == 1:
+                self.fail(items, e)
+                return
+            print(f"메모리 부족으로 배치({len(items)}개)를 하나씩 다시 처리합니다.")
+            for item in items:
+                self.process([item])
+            return
+        except Exception as e:
+            self.fail(items, e)
+            return
+
+        # 토크나이저는 스레드 안전하지 않으므로 출력 토큰 수도 워커 스레드에서 계산
+        tokenizer = getattr(self.qwen.processor, "tokenizer", None)
+        output_tokens = [len(tokenizer(text).input_ids) if tokenizer is not None else None for text in texts]
+        end_time = time.perf_counter()
+        batch_time = end_time - start_time
+        with self.lock:
+            self.batches += 1
+            self.batch_sizes[len(items)] += 1
+            self.batch_times.append(batch_time)
+            for item in items:
+                self.queue_times.append(start_time - item["enqueued_at"])
+                self.latencies.append(end_time - item["enqueued_at"])
+        for item, text, tokens in zip(items, texts, output_tokens):
+            item["future"].set_result({
+                "text": text,
+                "output_tokens": tokens,
+                "queue_time": start_time - item["enqueued_at"],
+                "batch_size": len(items),
+                "batch_time": batch_time,
+                "latency": end_time - item["enqueued_at"],
+            })
+
+    def fail(self, items, error):
+        with self.lock:
+            self.errors += len(items)
+        for item in items:
+            item["future"].set_exception(error)
+
+    def metrics(self):
+        """큐 길이, 배치 크기 분포, 대기/배치/전체 지연 시간 통계"""
+        with self.lock:
+            served = sum(size * count for size, count in self.batch_sizes.items())
+            return {
+                "model": self.qwen.checkpoint,
+                "uptime": time.time() - self.started_at,
+                "queue_depth": self.queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "requests": self.requests,
+                "errors": self.errors,
+                "batches": self.batches,
+                "batch_size_mean": served / self.batches if self.batches else 0.0,
+                "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                "max_batch_size": self.max_batch_size,
+                "batch_window": self.batch_window,
+                "queue_time": latency_summary(list(self.queue_times)),
+                "batch_time": latency_summary(list(self.batch_times)),
+                "latency": latency_summary(list(self.latencies)),
+            }
+
+class QwenServerHandler(BaseHTTPRequestHandler):
+    """POST /generate (추론), GET /metrics (큐/배치/지연 시간 통계), GET /health (로드된 모델) 요청 핸들러"""
+
+    def log_message(self, format, *args):
+        # 요청마다 출력되는 기본 접근 로그는 생략
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        batch_queue = self.server.batch_queue
+        if self.path == '/metrics':
+            self.send_json(200, batch_queue.metrics())
+        elif self.path == '/health':
+            self.send_json(200, {"status": "ok", "model": batch_queue.qwen.checkpoint})
+        else:
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            request = self.read_body()
+            data = base64.b64decode(request["image"])
+        except (KeyError, ValueError) as e:
+            self.send_json(400, {'error': f'잘못된 요청: {str(e)}'})
+            return
+
+        json_mode = bool(request.get("json"))
+        prompt = request.get("prompt") or (JSON_EXTRACTION_PROMPT if json_mode else '')
+        if not prompt:
+            self.send_json(400, {'error': '잘못된 요청: prompt가 없습니다.'})
+            return
+        # Qwen은 이미지를 파일 경로(또는 파일 객체)로 읽으므로 전처리 캐시 파일 경로를 넘김
+        preprocessor = self.server.preprocessor
+        try:
+            image = preprocessor.prepare_bytes(data, self.server.batch_queue.qwen.checkpoint)["path"] if preprocessor else io.BytesIO(data)
+        except Exception as e:
+            self.send_json(400, {'error': f'이미지 준비 실패: {str(e)}'})
+            return
+
+        try:
+            result = self.server.batch_queue.submit(image, prompt, json_mode).result()
+        except Exception as e:
+            self.send_json(500, {'error': str(e) or type(e).__name__})
+            return
+        self.send_json(200, result)
+
+def start_server(qwen, host=HOST, port=PORT, max_batch_size=MAX_BATCH_SIZE, batch_window=BATCH_WINDOW, preprocess=True):
+    """초기화된 QwenModel로 백그라운드 스레드에서 서버를 띄우고 (서버, URL)을 반환하는 함수 (port=0이면 빈 포트)"""
+    server = ThreadingHTTPServer((host, port), QwenServerHandler)
+    server.daemon_threads = True
+    server.batch_queue = BatchQueue(qwen, max_batch_size, batch_window)
+    server.preprocessor = PreprocessCache() if preprocess else None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Qwen2.5-VL을 한 번 로드해 두고 HTTP 요청을 동적 배치로 처리하는 로컬 추론 서버")
+    parser.add_argument('--model', default=CHECKPOINT, help="Qwen 체크포인트")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE, help="한 배치의 최대 요청 수")
+    parser.add_argument('--batch-window', type=float, default=BATCH_WINDOW, help="첫 요청 뒤 다른 요청을 기다릴 시간(초)")
+    parser.add_argument('--no-preprocess', action='store_true', help="모델 프로필로 이미지를 전처리하지 않음")
+    args = parser.parse_args()
+
+    from inference_qwen_models_single_turn import QwenModel
+
+    load_start = time.perf_counter()
+    qwen = QwenModel(args.model)
+    if not qwen.initialize():
+        raise SystemExit(f"{args.model} 모델 초기화 실패")
+    print(f"모델 로드 시간: {time.perf_counter() - load_start:.2f}초")
+
+    server, url = start_server(qwen, args.host, args.port, args.max_batch_size, args.batch_window, not args.no_preprocess)
+    print(f"Qwen 서버 실행 중: {url} (POST /generate, GET /metrics, GET /health) / 최대 배치 {args.max_batch_size} / 대기 {args.batch_window * 1000:.0f}ms")
+    try:
+        while True:
+            time.sleep(60)
+            metrics = server.batch_queue.metrics()
+            if metrics["requests"]:
+                print(f"요청 {metrics['requests']} / 오류 {metrics['errors']} / 배치 {metrics['batches']} / "
+                      f"평균 배치 크기 {metrics['batch_size_mean']:.2f} / 큐 {metrics['queue_depth']} / "
+                      f"p95 지연 {metrics['latency']['p95']:.2f}초")
+    except KeyboardInterrupt:
+        server.shutdown()
+        qwen.clear()
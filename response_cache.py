@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+CACHE_PATH = os.path.join("cache", "responses.sqlite")
+# 기본 제한: 전체 500MB, 30일 (None이면 제한 없음)
+MAX_BYTES = 500 * 1024**2
+MAX_AGE_DAYS = 30
+
+def sha256_bytes(data):
+    """바이트 데이터의 SHA-256 해시(16진수 문자열) 반환"""
+    return hashlib.sha256(data).hexdigest()
+
+class ResponseCache:
+    """모델 ID, 이미지 해시, 프롬프트/시스템 지침, 생성 파라미터를 키로 모델 응답을 저장하는 SQLite 캐시
+
+    SCR_CACHE_BYPASS=1 환경 변수(또는 bypass=True)면 캐시를 읽지 않고 새로 호출한 결과로 덮어씁니다.
+    """
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_BYTES, max_age_days=MAX_AGE_DAYS, bypass=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.bypass = bypass if bypass is not None else os.getenv('SCR_CACHE_BYPASS', '') == '1'
+        self.hits = 0
+        self.misses = 0
+        # Ollama 워커 스레드 등 여러 스레드에서 같은 연결을 쓰므로 잠금으로 직렬화
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                inference_time REAL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed_at ON responses (accessed_at)")
+        self.conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model_id, image_data=None, prompt='', system_instruction='', params=None):
+        """캐시 키 생성 (prompt는 문자열 또는 대화 턴 리스트)
+
+        image_data는 바이트, 이미 계산한 이미지 키 문자열(예: PerceptualIndex.canonical의 대표 키), 또는 그 리스트
+        """
+        if image_data is None:
+            images = []
+        elif isinstance(image_data, (bytes, bytearray, str)):
+            images = [image_data if isinstance(image_data, str) else sha256_bytes(image_data)]
+        else:
+            images = [data if isinstance(data, str) else sha256_bytes(data) for data in image_data]
+        material = json.dumps({
+            "model": model_id,
+            "images": images,
+            "prompt": prompt,
+            "system_instruction": system_instruction or '',
+            "params": params or {},
+        }, ensure_ascii=False, sort_keys=True, default=str)
+        return sha256_bytes(material.encode('utf-8'))
+
+    def get(self, key):
+        """캐시된 (응답, 원래 추론 시간) 반환, 없거나 bypass면 None"""
+        if self.bypass:
+            self.misses += 1
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response, inference_time FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        return row[0], row[1]
+
+    def put(self, key, model_id, response, inference_time=None):
+        """응답 저장 (같은 키가 있으면 덮어씀)"""
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, str(model_id), response, inference_time, len(response.encode('utf-8')), now, now),
+            )
+            self.conn.commit()
+
+    def evict(self):
+        """오래된 항목과 크기 제한을 넘는 항목(가장 오래 사용되지 않은 것부터)을 삭제"""
+        with self.lock:
+            if self.max_age_days is not None:
+                self.conn.execute("DELETE FROM responses WHERE created_at < ?",
+                                  (time.time() - self.max_age_days * 86400,))
+            if self.max_bytes is not None:
+                total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_bytes:
+                    rows = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall()
+                    stale = []
+                    for key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        stale.append((key,))
+                        total -= size
+                    self.conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+            self.conn.commit()
+
+    def stats(self):
+        """적중/미스 횟수, 적중률, 저장된 항목 수와 크기 반환"""
+        with self.lock:
+            count, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": count,
+            "bytes": size,
+        }
+
+    def report(self):
+        """캐시 통계 출력"""
+        stats = self.stats()
+        bypass = " (bypass)" if self.bypass else ""
+        print(f"응답 캐시{bypass} - 적중: {stats['hits']} / 미스: {stats['misses']} / 적중률: {stats['hit_rate']:.1%} / "
+              f"항목: {stats['entries']} / 크기: {stats['bytes'] / 1024:.1f}KB")
+
+    def close(self):
+        self.evict()
+        self.conn.close()
@@ -0,0 +1,152 @@
+import os
+import csv
+import json
+import time
+import threading
+
+
+class ResultWriter:
+    """결과 행을 완료되는 즉시 파일 끝에 추가하는 기록기 (.jsonl 또는 .csv)
+
+    모든 행에 run_id를 기록하고, 같은 run_id로 다시 실행하면 이미 기록된 작업(key_fields 기준)을 건너뛸 수 있습니다.
+    run_id는 지정한 값, SCR_RUN_ID 환경 변수 순으로 정하고, 둘 다 없으면 새 실행 ID를 만듭니다.
+    다만 파일의 마지막 실행이 끝나지 않았으면(중단되었거나 실패한 작업이 남아 close()에서 완료로 표시되지 않음)
+    또는 resume=True(SCR_RESUME=1)이면 마지막 run_id를 이어서 사용합니다. 완료된 실행 ID는 path + ".complete"에 기록합니다.
+    error 필드가 채워진 행은 완료로 보지 않으므로 이어서 실행하면 다시 시도됩니다.
+    """
+    def __init__(self, path, fieldnames, key_fields, run_id=None, resume=None):
+        self.path = path
+        self.complete_path = path + ".complete"
+        self.format = 'jsonl' if path.endswith('.jsonl') else 'csv'
+        self.fieldnames = ["run_id"] + [name for name in fieldnames if name != "run_id"]
+        self.key_fields = key_fields
+        self.lock = threading.Lock()
+        self.failed = set()
+
+        self.repair()
+        last_run_id, completed_by_run = self.scan()
+        if resume is None:
+            resume = os.getenv('SCR_RESUME') == '1'
+        if last_run_id is not None and last_run_id not in self.complete_runs():
+            resume = True
+        self.run_id = run_id or os.getenv('SCR_RUN_ID') or (last_run_id if resume else None) or self.new_run_id(completed_by_run)
+        self.completed = completed_by_run.get(self.run_id, set())
+        if self.completed:
+            print(f"실행 {self.run_id} 이어서 진행: 완료된 작업 {len(self.completed)}개 건너뜀 "
+                  f"(새로 실행하려면 SCR_RUN_ID를 새 값으로 지정)")
+        else:
+            print(f"실행 ID: {self.run_id} / 결과 파일: {self.path}")
+
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not new_file and self.format == 'csv':
+            with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+                header = next(csv.reader(f), [])
+            if header != self.fieldnames:
+                raise ValueError(f"{path}의 컬럼 {header}이 현재 결과 형식 {self.fieldnames}과 다릅니다. "
+                                 f"다른 파일 이름을 사용하세요.")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, mode='a', newline='', encoding='utf-8-sig' if self.format == 'csv' else 'utf-8')
+        if self.format == 'csv':
+            self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames, extrasaction='ignore')
+            if new_file:
+                self.writer.writeheader()
+                self.file.flush()
+
+    def repair(self):
+        """쓰는 도중 중단돼 줄바꿈 없이 끝난 마지막 줄을 잘라냄 (이어서 쓴 행이 그 줄에 붙지 않도록)"""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, 'r+b') as f:
+            end = f.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(0, position - 4096)
+                f.seek(start)
+                chunk = f.read(position - start)
+                newline = chunk.rfind(b'\n')
+                if newline != -1:
+                    position = start + newline + 1
+                    break
+                position = start
+            if position != end:
+                print(f"{self.path}의 마지막 줄이 완전히 기록되지 않아 잘라냅니다 ({end - position}바이트).")
+                f.truncate(position)
+
+    def read_rows(self):
+        """기존 결과 파일의 행을 하나씩 반환 (파일 전체를 메모리에 올리지 않음)"""
+        if not os.path.exists(self.path):
+            return
+        if self.format == 'jsonl':
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        print(f"{self.path}에서 읽을 수 없는 줄을 건너뜁니다: {line[:80]}")
+        else:
+            with open(self.path, 'r', newline='', encoding='utf-8-sig') as f:
+                yield from csv.DictReader(f)
+
+    def scan(self):
+        """(파일의 마지막 run_id, run_id별 완료 작업 키 집합) 반환"""
+        completed_by_run = {}
+        last_run_id = None
+        for row in self.read_rows():
+            last_run_id = row.get("run_id") or last_run_id
+            if row.get("error"):
+                continue
+            completed_by_run.setdefault(row.get("run_id"), set()).add(self.key(row))
+        return last_run_id, completed_by_run
+
+    def new_run_id(self, existing):
+        """시각으로 만든 새 실행 ID (같은 초에 만든 실행이 이미 있으면 번호를 붙임)"""
+        run_id = base = time.strftime('%Y%m%d-%H%M%S')
+        n = 1
+        while run_id in existing or run_id in self.complete_runs():
+            n += 1
+            run_id = f"{base}-{n}"
+        return run_id
+
+    def complete_runs(self):
+        """close()에서 완료로 표시된 실행 ID 집합"""
+        if not os.path.exists(self.complete_path):
+            return set()
+        with open(self.complete_path, 'r', encoding='utf-8') as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def key(self, row):
+        """작업 키 (CSV에서 읽은 값과 비교할 수 있도록 문자열로 통일)"""
+        return tuple(str(row.get(field, '')) for field in self.key_fields)
+
+    def is_done(self, **job):
+        """현재 run_id에서 이미 기록된 작업인지 확인"""
+        return self.key(job) in self.completed
+
+    def write(self, row):
+        """행 하나를 기록하고 바로 디스크로 flush"""
+        row = dict(row, run_id=self.run_id)
+        with self.lock:
+            if self.format == 'jsonl':
+                self.file.write(json.dumps(row, ensure_ascii=False, default=str) + '\n')
+            else:
+                self.writer.writerow(row)
+            self.file.flush()
+            if row.get("error"):
+                self.failed.add(self.key(row))
+            else:
+                self.completed.add(self.key(row))
+                self.failed.discard(self.key(row))
+
+    def close(self):
+        """파일을 닫고, 실패한 작업이 남지 않았으면 이 실행을 완료로 표시 (다음 실행은 새 실행 ID로 시작)"""
+        self.file.close()
+        if self.failed:
+            print(f"실패한 작업 {len(self.failed)}개: 다시 실행하면 실행 {self.run_id}을 이어서 실패한 작업만 재시도합니다.")
+        elif self.run_id not in self.complete_runs():
+            with open(self.complete_path, 'a', encoding='utf-8') as f:
+                f.write(self.run_id + '\n')
+        print(f"테스트 결과가 {self.path} 파일에 저장되었습니다.")
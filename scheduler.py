@@ -0,0 +1,264 @@
+import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from benchmark_utils import percentile
+
+
+# 재시도할 HTTP 상태 코드 (요청 한도 초과, 서버 오류, 서비스 불가, 게이트웨이 시간 초과)
+TRANSIENT_STATUS = {408, 429, 500, 502, 503, 504}
+
+def is_transient(error):
+    """일시적 오류(429/503/시간 초과/연결 실패 등)인지 확인하는 함수
+
+    google.api_core 예외는 code, ollama.ResponseError와 httpx 예외는 status_code로 상태 코드를 알려주므로 둘 다 확인합니다.
+    """
+    for attr in ("status_code", "code"):
+        status = getattr(error, attr, None)
+        if isinstance(status, int) and status in TRANSIENT_STATUS:
+            return True
+    if isinstance(error, (TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return True
+    # httpx.ReadTimeout, google.api_core.exceptions.DeadlineExceeded, httpx.ConnectError 등
+    name = type(error).__name__
+    return any(word in name for word in ("Timeout", "DeadlineExceeded", "ServiceUnavailable",
+                                         "ResourceExhausted", "ConnectError"))
+
+class TokenBucket:
+    """분당 한도(rate_per_minute)를 지키도록 요청/토큰을 배분하는 토큰 버킷
+
+    reserve()는 잠금 안에서 필요한 양을 미리 차감하고 기다려야 할 시간만 돌려주므로,
+    대기는 호출하는 쪽에서 time.sleep(스레드) 또는 asyncio.sleep(비동기)으로 할 수 있습니다.
+    """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        """amount만큼 차감하고 사용 가능해질 때까지 기다려야 할 시간(초) 반환 (0이면 바로 사용 가능)"""
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+            self.updated = now
+            # 한 번에 용량보다 많이 요청하면 용량만큼만 기다리도록 제한 (큰 요청이 영원히 막히지 않도록)
+            self.available -= min(amount, self.capacity)
+            if self.available >= 0:
+                return 0.0
+            return -self.available / self.rate
+
+    def adjust(self, amount):
+        """실제 사용량과 추정치의 차이를 반영 (양수면 추가 차감, 음수면 반환)"""
+        with self.lock:
+            self.available = min(self.capacity, self.available - amount)
+
+class Scheduler:
+    """모델별 RPM/TPM 한도, 일시적 오류 재시도(지터 지수 백오프), 느린 요청 헤징을 적용해 백엔드 호출을 실행하는 클래스
+
+    Args:
+        limits (dict): {모델 이름: {"rpm": 분당 요청 수, "tpm": 분당 토큰 수}} (없는 모델은 default_limits, 값이 None이면 제한 없음)
+        max_retries (int): 일시적 오류의 최대 재시도 횟수
+        base_delay / max_delay (float): 백오프 대기 시간 범위 (attempt번째 재시도는 0 ~ min(max_delay, base_delay * 2**attempt)초 중 무작위)
+        hedge_after (float): 요청이 이 시간(초)보다 오래 걸리면 같은 요청을 한 번 더 보내고 먼저 끝난 응답 사용 (None이면 사용 안 함)
+        hedge_percentile (float): hedge_after가 None일 때 최근 지연 시간의 이 백분위수를 헤징 기준으로 사용 (예: 95)
+
+    call()/call_async()는 (결과, 통계)를 반환하며, 통계에는 attempts, retries, throttle_wait, backoff_wait, hedged가 들어 있습니다.
+    """
+    def __init__(self, limits=None, default_limits=None, max_retries=5, base_delay=1.0, max_delay=60.0,
+                 hedge_after=None, hedge_percentile=None, seed=None):
+        self.limits = limits or {}
+        self.default_limits = default_limits or {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_after = hedge_after
+        self.hedge_percentile = hedge_percentile
+        self.random = random.Random(seed)
+        self.buckets = {}
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def buckets_for(self, model):
+        """모델의 (RPM 버킷, TPM 버킷) 반환 (한도가 없으면 None)"""
+        with self.lock:
+            if model not in self.buckets:
+                limits = self.limits.get(model, self.default_limits)
+                self.buckets[model] = (
+                    TokenBucket(limits["rpm"]) if limits.get("rpm") else None,
+                    TokenBucket(limits["tpm"]) if limits.get("tpm") else None,
+                )
+            return self.buckets[model]
+
+    def throttle_delay(self, model, tokens):
+        """요청 하나와 추정 토큰 수를 한도에서 차감하고 기다려야 할 시간 반환"""
+        rpm_bucket, tpm_bucket = self.buckets_for(model)
+        delay = 0.0
+        if rpm_bucket is not None:
+            delay = max(delay, rpm_bucket.reserve(1))
+        if tpm_bucket is not None and tokens:
+            delay = max(delay, tpm_bucket.reserve(tokens))
+        return delay
+
+    def settle_tokens(self, model, estimated, actual):
+        """응답의 실제 토큰 수로 TPM 버킷의 추정치를 보정"""
+        _, tpm_bucket = self.buckets_for(model)
+        if tpm_bucket is not None and actual is not None:
+            tpm_bucket.adjust(actual - (estimated or 0))
+
+    def backoff_delay(self, attempt):
+        """attempt번째 재시도 전 대기 시간 (full jitter)"""
+        with self.lock:
+            return self.random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def hedge_threshold(self):
+        """헤징 기준 시간 (고정값, 또는 최근 지연 시간이 20개 이상 쌓였을 때의 백분위수)"""
+        if self.hedge_after is not None:
+            return self.hedge_after
+        if self.hedge_percentile is not None:
+            with self.lock:
+                recent = self.latencies[-200:]
+            if len(recent) >= 20:
+                return percentile(recent, self.hedge_percentile)
+        return None
+
+    def record_latency(self, elapsed):
+        with self.lock:
+            self.latencies.append(elapsed)
+            if len(self.latencies) > 1000:
+                del self.latencies[:-200]
+
+    def run_hedged(self, fn, stats):
+        """fn을 실행하고, 기준 시간 안에 끝나지 않으면 한 번 더 실행해 먼저 끝난 결과 반환
+
+        먼저 끝난 쪽이 실패하면 다른 쪽의 결과를 기다립니다. 늦게 끝난 요청은 취소할 수 없으므로 결과만 버립니다.
+        """
+        threshold = self.hedge_threshold()
+        if threshold is None:
+            return fn()
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+        futures = [self.executor.submit(fn)]
+        done, _ = wait(futures, timeout=threshold)
+        if not done:
+            stats["hedged"] = True
+            futures.append(self.executor.submit(fn))
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def call(self, model, fn, tokens=None, count_tokens=None, hedge=True):
+        """한도에 맞춰 기다린 뒤 fn()을 실행하고, 일시적 오류는 백오프 후 재시도 (반환: (결과, 통계))
+
+        Args:
+            model: 한도를 적용할 모델 이름
+            fn: 인자 없이 호출할 함수 (예: lambda: client.chat(...))
+            tokens: TPM 한도에 미리 차감할 추정 토큰 수
+            count_tokens: 결과에서 실제 토큰 수를 꺼내는 함수 (있으면 추정치를 보정)
+            hedge: 헤징 사용 여부 (대화 기록을 바꾸는 호출처럼 두 번 보내면 안 되는 요청은 False)
+        """
+        stats = {"attempts": 0, "retries": 0, "throttle_wait": 0.0, "backoff_wait": 0.0, "hedged": False}
+        while True:
+            delay = self.throttle_delay(model, tokens)
+            if delay > 0:
+                stats["throttle_wait"] += delay
+                time.sleep(delay)
+
+            stats["attempts"] += 1
+            start_time = time.perf_counter()
+            try:
+                result = self.run_hedged(fn, stats) if hedge else fn()
+            except Exception as e:
+                if not is_transient(e) or stats["retries"] >= self.max_retries:
+                    raise
+                delay = self.backoff_delay(stats["retries"])
+                stats["retries"] += 1
+                stats["backoff_wait"] += delay
+                print(f"일시적 오류, {delay:.1f}초 후 재시도 ({stats['retries']}/{self.max_retries}): {str(e)}")
+                time.sleep(delay)
+                continue
+
+            self.record_latency(time.perf_counter() - start_time)
+            if count_tokens is not None:
+                self.settle_tokens(model, tokens, count_tokens(result))
+            return result, stats
+
+    async def call_async(self, model, make_coro, tokens=None, count_tokens=None, hedge=True):
+        """call의 비동기 버전 (make_coro는 호출할 때마다 새 코루틴을 만드는 함수, 예: lambda: model.generate_content_async(...))"""
+        stats = {"attempts": 0, "retries": 0, "throttle_wait": 0.0, "backoff_wait": 0.0, "hedged": False}
+        while True:
+            delay = self.throttle_delay(model, tokens)
+            if delay > 0:
+                stats["throttle_wait"] += delay
+                await asyncio.sleep(delay)
+
+            stats["attempts"] += 1
+            start_time = time.perf_counter()
+            try:
+                result = await (self.run_hedged_async(make_coro, stats) if hedge else make_coro())
+            except Exception as e:
+                if not is_transient(e) or stats["retries"] >= self.max_retries:
+                    raise
+                delay = self.backoff_delay(stats["retries"])
+                stats["retries"] += 1
+                stats["backoff_wait"] += delay
+                print(f"일시적 오류, {delay:.1f}초 후 재시도 ({stats['retries']}/{self.max_retries}): {str(e)}")
+                await asyncio.sleep(delay)
+                continue
+
+            self.record_latency(time.perf_counter() - start_time)
+            if count_tokens is not None:
+                self.settle_tokens(model, tokens, count_tokens(result))
+            return result, stats
+
+    async def run_hedged_async(self, make_coro, stats):
+        """run_hedged의 비동기 버전 (먼저 성공한 쪽을 쓰고 나머지 요청은 취소)"""
+        threshold = self.hedge_threshold()
+        if threshold is None:
+            return await make_coro()
+        tasks = [asyncio.ensure_future(make_coro())]
+        done, _ = await asyncio.wait(tasks, timeout=threshold)
+        if not done:
+            stats["hedged"] = True
+            tasks.append(asyncio.ensure_future(make_coro()))
+        error = None
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+# 결과 파일에 기록할 scheduler 통계 컬럼
+STATS_FIELDS = ["retries", "throttle_wait", "backoff_wait", "hedged"]
+
+def stats_columns(stats):
+    """scheduler 통계를 결과 행 컬럼으로 변환 (모델을 호출하지 않은 행은 빈 값)"""
+    if not stats:
+        return {field: '' for field in STATS_FIELDS}
+    return {
+        "retries": stats["retries"],
+        "throttle_wait": round(stats["throttle_wait"], 2),
+        "backoff_wait": round(stats["backoff_wait"], 2),
+        "hedged": stats["hedged"],
+    }
@@ -1,13 +1,22 @@
 import os
+import sys
 import json
-import tempfile
+import time
 import streamlit as st
-from pathlib import Path
-from PIL import Image
 # from dotenv import load_dotenv
 from google import genai  # 최신 Google Gemini SDK 사용
 from google.genai import types
 
+# 저장소 루트의 공용 모듈(backends, 그리고 batch_ingest가 쓰는 scheduler/result_writer 등)을 import할 수 있도록 경로 추가
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.append(ROOT_DIR)
+
+from upload_store import UploadStore
+from contact_store import ContactStore, parse_extracted_info
+from batch_ingest import ingest, MAX_WORKERS
+from backends import QwenServerBackend
+
 # 페이지 설정
 st.set_page_config(
     page_title="스마트 명함 관리 서비스",
@@ -21,8 +30,41 @@ api_key = "GOOGLE_API_KEY"
 if not api_key:
     raise ValueError("GOOGLE_API_KEY가 .env 파일에 정의되어 있지 않습니다.")
 
-# Google Gemini 클라이언트 초기화
-client = genai.Client(api_key=api_key)
+MODEL_NAME = 'gemini-2.0-flash'  # 비전 모델 사용
+# 상주 Qwen 서버 (qwen_server.py, QWEN_SERVER_URL이 있으면 일괄 등록에서 로컬 모델로 먼저 추출 가능)
+LOCAL_MODEL_NAME = os.getenv('QWEN_SERVER_MODEL', 'Qwen/Qwen2.5-VL-3B-Instruct')
+
+# Google Gemini 클라이언트 초기화 (st.cache_resource로 한 번만 만들고 모든 rerun과 세션이 재사용)
+@st.cache_resource
+def get_client():
+    return genai.Client(api_key=api_key)
+
+# 업로드 이미지 저장소 (내용 해시로 중복 제거, 디스크 사용량 제한)
+@st.cache_resource
+def get_upload_store():
+    return UploadStore()
+
+# 연락처 저장소 (SQLite + FTS5 전문 검색)
+@st.cache_resource
+def get_contact_store():
+    return ContactStore()
+
+# 로컬 Qwen 서버 백엔드 (QWEN_SERVER_URL이 없거나 서버에 연결할 수 없으면 None)
+@st.cache_resource
+def get_local_backend():
+    if not os.getenv('QWEN_SERVER_URL'):
+        return None
+    backend = QwenServerBackend(LOCAL_MODEL_NAME)
+    try:
+        backend.setup()
+    except Exception as e:
+        print(f"Qwen 서버에 연결할 수 없습니다: {str(e)}")
+        return None
+    return backend
+
+client = get_client()
+upload_store = get_upload_store()
+contact_store = get_contact_store()
 
 # 시스템 지침
 SYSTEM_INSTRUCTION = """
@@ -59,7 +101,16 @@ SYSTEM_INSTRUCTION = """
 친근한 어조를 유지하며, 사용자의 질문이나 설명 요청에 대응하세요.
 """
 
+GENERATE_CONFIG = types.GenerateContentConfig(
+    system_instruction=SYSTEM_INSTRUCTION,  # 시스템 지침 추가
+    max_output_tokens=1000,  # 출력 토큰 제한
+    temperature=0.7,  # 응답의 창의성 조정
+)
+
 # 세션 상태 초기화
+if 'chat' not in st.session_state:
+    # 대화 기록은 chat 세션이 Content 객체로 유지하므로 매 메시지마다 문자열로 다시 만들지 않음
+    st.session_state.chat = client.chats.create(model=MODEL_NAME, config=GENERATE_CONFIG)
 if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
 if 'uploaded_images' not in st.session_state:
@@ -68,47 +119,73 @@ if 'selected_images' not in st.session_state:
     st.session_state.selected_images = []
 if 'image_processed' not in st.session_state:
     st.session_state.image_processed = False
+if 'pending_contact' not in st.session_state:
+    # 마지막으로 추출한 <extracted_info>와, 그 뒤의 사용자 메시지(만남 맥락)가 시작되는 chat_history 위치
+    st.session_state.pending_contact = None
+    st.session_state.contact_context_start = 0
+if 'seen_uploads' not in st.session_state:
+    # 업로더 파일 ID -> 이미지 해시 (rerun마다 같은 파일을 다시 읽고 저장하지 않도록)
+    st.session_state.seen_uploads = {}
 
 # 채팅 메시지 표시 함수
+def display_message(message):
+    with st.chat_message(message["role"]):
+        st.write(message["content"])
+        if "images" in message and message["images"]:
+            for digest in message["images"]:
+                preview = upload_store.preview(digest)
+                if preview is not None:
+                    st.image(preview, width=200)
+        if "usage" in message:
+            st.caption(usage_caption(message["usage"]))
+
 def display_chat():
     for message in st.session_state.chat_history:
-        with st.chat_message(message["role"]):
-            st.write(message["content"])
-            if "images" in message and message["images"]:
-                for img_path in message["images"]:
-                    st.image(img_path, width=200)
+        display_message(message)
 
-# Google Gemini로 응답 생성 함수 (수정됨)
-def generate_response(user_input, images=None):
-    contents = []  # 텍스트 입력 추가
+def usage_caption(usage):
+    """턴별 토큰 수 표시 문자열"""
+    return (f"입력 토큰: {usage['prompt_tokens']} (캐시: {usage['cached_tokens']}) / "
+            f"출력 토큰: {usage['output_tokens']} / 첫 토큰: {usage['ttft']:.2f}초 / "
+            f"응답 시간: {usage['inference_time']:.2f}초")
 
-    # 이전 대화 기록 추가
-    for message in st.session_state.chat_history:
-        if message['role'] == 'user':
-            contents.append(f"user: {message['content']}")
-        else:
-            contents.append(f"assistant: {message['content']}")
-            
-    contents.append(f"user: {user_input}")
+# Google Gemini로 응답 생성 함수 (chat 세션에 새 메시지만 보내고 응답 텍스트를 받는 대로 반환)
+def generate_response(user_input, images=None, usage=None):
+    """응답 텍스트 조각을 생성되는 대로 내보내는 제너레이터 (스트림이 끝나면 usage에 토큰 수와 시간 기록)"""
+    message = []
 
-    
     # 이미지가 아직 처리되지 않았고, 이미지가 제공된 경우에만 포함
     if images and not st.session_state.image_processed:
-        for img_path in images:
-            img = Image.open(img_path)  # PIL Image 객체로 열기
-            contents.append(img)  # 이미지 추가
+        for digest in images:
+            img = upload_store.open_image(digest)  # PIL Image 객체로 열기
+            if img is not None:
+                message.append(img)  # 이미지 추가
         st.session_state.image_processed = True  # 이미지 처리 완료 플래그 설정
-    
-    response = client.models.generate_content(
-        model='gemini-2.0-flash',  # 비전 모델 사용
-        contents=contents,
-        config=types.GenerateContentConfig(
-            system_instruction=SYSTEM_INSTRUCTION,  # 시스템 지침 추가
-            max_output_tokens=1000,  # 출력 토큰 제한
-            temperature=0.7,  # 응답의 창의성 조정
-        )
-    )
-    return response.text
+
+    message.append(user_input)
+
+    start_time = time.perf_counter()
+    ttft = None
+    usage_metadata = None
+    for chunk in st.session_state.chat.send_message_stream(message):
+        if chunk.text:
+            if ttft is None:
+                ttft = time.perf_counter() - start_time
+            yield chunk.text
+        # 토큰 수는 마지막 청크에 누적값으로 들어 있음
+        if chunk.usage_metadata is not None:
+            usage_metadata = chunk.usage_metadata
+    inference_time = time.perf_counter() - start_time
+
+    if usage is not None:
+        usage.update({
+            "prompt_tokens": (usage_metadata.prompt_token_count if usage_metadata else None) or 0,
+            "cached_tokens": (usage_metadata.cached_content_token_count if usage_metadata else None) or 0,
+            "output_tokens": (usage_metadata.candidates_token_count if usage_metadata else None) or 0,
+            "ttft": ttft if ttft is not None else inference_time,
+            "inference_time": inference_time,
+        })
+    print(f"첫 토큰까지: {ttft if ttft is not None else inference_time:.2f}초 / 전체 응답 시간: {inference_time:.2f}초")
 
 # UI 구성
 st.title("📇 스마트 명함 관리 서비스")
@@ -125,13 +202,66 @@ with st.sidebar:
     )
     
     if uploaded_files:
-        st.session_state.uploaded_images = []
+        new_images = 0
+        digests = []
         for uploaded_file in uploaded_files:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=Path(uploaded_file.name).suffix) as tmp:
-                tmp.write(uploaded_file.read())
-                st.session_state.uploaded_images.append(tmp.name)
-        st.success(f"{len(uploaded_files)}개의 이미지가 업로드되었습니다.")
-        st.session_state.image_processed = False  # 새로운 이미지 업로드 시 플래그 초기화
+            # 이미 저장한 파일은 다시 읽지 않음 (저장소에서 삭제된 경우에만 다시 저장)
+            digest = st.session_state.seen_uploads.get(uploaded_file.file_id)
+            if digest is None or digest not in upload_store:
+                digest, _ = upload_store.add(uploaded_file.name, uploaded_file.getvalue())
+                st.session_state.seen_uploads[uploaded_file.file_id] = digest
+                new_images += digest not in st.session_state.uploaded_images
+            if digest not in digests:
+                digests.append(digest)
+        st.session_state.uploaded_images = digests
+        if new_images:
+            st.session_state.image_processed = False  # 새로운 이미지 업로드 시에만 플래그 초기화
+        st.success(f"{len(digests)}개의 이미지가 업로드되었습니다.")
+        stats = upload_store.stats()
+        st.caption(f"이미지 저장소: {stats['entries']}개 / {stats['bytes'] / 1024**2:.1f}MB")
+
+        # 일괄 등록: 대화 대신 명함마다 별도 추출 요청을 동시에 보내고 바로 연락처로 저장
+        local_backend = get_local_backend()
+        use_local = local_backend is not None and st.checkbox(
+            "로컬 Qwen 서버로 먼저 추출", value=True, help="필드 검증에 실패한 명함만 Gemini로 보냅니다.")
+        if st.button("업로드한 명함 일괄 등록", help="명함마다 별도 요청으로 동시에 추출해 연락처로 저장"):
+            cards = [(upload_store.name(digest), upload_store.read(digest)) for digest in digests]
+            progress = st.progress(0.0, text="명함 추출 중...")
+            ingest_start = time.perf_counter()
+            rows = ingest(client, cards, max_workers=MAX_WORKERS, model_name=MODEL_NAME, contact_store=contact_store,
+                          local=local_backend if use_local else None,
+                          on_result=lambda done, total, row: progress.progress(done / total, text=f"{done}/{total} {row['image']}"))
+            failed = sum(1 for row in rows if row.get("error"))
+            st.success(f"명함 {len(rows) - failed}장 등록 / 실패 {failed}장 ({time.perf_counter() - ingest_start:.1f}초)")
+            if use_local:
+                escalated = sum(1 for row in rows if row.get("escalation") and not row.get("duplicate_of"))
+                st.caption(f"Gemini로 보낸 명함: {escalated}장")
+            st.dataframe(rows, hide_index=True, column_order=["image", "name", "company", "phone", "email", "contact_id", "source", "error"])
+
+    if st.button("새 대화 시작"):
+        st.session_state.chat = client.chats.create(model=MODEL_NAME, config=GENERATE_CONFIG)
+        st.session_state.chat_history = []
+        st.session_state.image_processed = False
+        st.session_state.pending_contact = None
+        st.session_state.contact_context_start = 0
+        st.rerun()
+
+    st.header("연락처 검색")
+    search_query = st.text_input("이름, 회사, 전화번호, 이메일, 만난 곳 등", key="contact_search")
+    if search_query:
+        contacts = contact_store.search(search_query)
+        if contacts:
+            st.dataframe(contacts, hide_index=True,
+                         column_order=["name", "position", "company", "phone", "email", "context"])
+        else:
+            st.caption("검색 결과가 없습니다.")
+    st.caption(f"저장된 연락처: {contact_store.count()}개")
+
+    # 턴이 늘어도 입력 토큰(비용)과 응답 시간이 일정한지 확인할 수 있도록 턴별 사용량 표시
+    turn_usage = [message["usage"] for message in st.session_state.chat_history if "usage" in message]
+    if turn_usage:
+        st.header("턴별 토큰 사용량")
+        st.dataframe([dict(turn=turn, **usage) for turn, usage in enumerate(turn_usage, start=1)], hide_index=True)
 
 # 채팅 UI
 chat_container = st.container()
@@ -149,33 +279,67 @@ if st.session_state.uploaded_images:
             st.session_state.selected_images = st.multiselect(
                 "첨부할 이미지를 선택하세요",
                 options=st.session_state.uploaded_images,
-                format_func=lambda x: Path(x).name,
+                format_func=upload_store.name,
                 key="image_select"
             )
 
 if user_input:
     images_to_send = st.session_state.selected_images if st.session_state.selected_images else st.session_state.uploaded_images
+    usage = {}
     if not st.session_state.image_processed and images_to_send:  # 이미지가 처리되지 않았고 이미지가 있는 경우
-        st.session_state.chat_history.append({
+        user_message = {
             "role": "user",
             "content": user_input,
             "images": images_to_send
-        })
-        response = generate_response(user_input, images_to_send)
+        }
+        stream = generate_response(user_input, images_to_send, usage)
     else:  # 이미지가 처리된 경우 텍스트만 처리
-        st.session_state.chat_history.append({
+        user_message = {
             "role": "user",
             "content": user_input
-        })
-        response = generate_response(user_input)
+        }
+        stream = generate_response(user_input, usage=usage)
+    st.session_state.chat_history.append(user_message)
+
+    # 응답을 기다리는 동안 화면이 멈추지 않도록 새 메시지와 응답 조각을 바로 표시
+    with chat_container:
+        display_message(user_message)
+        with st.chat_message("assistant"):
+            try:
+                response = st.write_stream(stream)
+            except Exception as e:
+                # 실패한 질문은 대화 기록에서 빼고, 이번에 첨부한 이미지는 다음 질문에 다시 보냄
+                st.error(f"응답 생성 실패: {str(e)}")
+                st.session_state.chat_history.pop()
+                if "images" in user_message:
+                    st.session_state.image_processed = False
+                st.stop()
     
     st.session_state.chat_history.append({
         "role": "assistant",
-        "content": response
+        "content": response,
+        "usage": usage
     })
+    # 응답에 추출된 명함 정보가 있으면 저장 대기 (이후 사용자 메시지를 만남 맥락으로 함께 저장)
+    extracted_info = parse_extracted_info(response)
+    if extracted_info is not None:
+        if st.session_state.pending_contact is None:
+            st.session_state.contact_context_start = len(st.session_state.chat_history)
+        st.session_state.pending_contact = extracted_info
     st.session_state.selected_images = []  # 선택 초기화
     st.rerun()
 
+# 연락처 저장 버튼 (추출된 명함 정보 + 그 뒤에 나눈 만남 맥락)
+if st.session_state.pending_contact is not None and st.button("연락처 저장"):
+    context = "\n".join(message["content"] for message in st.session_state.chat_history[st.session_state.contact_context_start:]
+                        if message["role"] == "user")
+    contact_id, is_new = contact_store.save(st.session_state.pending_contact, context)
+    st.session_state.pending_contact = None
+    if is_new:
+        st.success(f"{contact_id}번 연락처로 저장되었습니다!")
+    else:
+        st.success(f"같은 사람의 {contact_id}번 연락처에 합쳤습니다!")
+
 # 대화 기록 저장 버튼
 if st.button("대화 기록 저장"):
     with open("chat_history.json", "w", encoding="utf-8") as f:
@@ -0,0 +1,213 @@
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from google.genai import types
+from contact_store import CONTACT_FIELDS, ContactStore
+
+# 저장소 루트의 공용 모듈(scheduler, result_writer, benchmark_utils, structured_output) 사용 (CLI로 직접 실행할 때)
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.append(ROOT_DIR)
+from scheduler import Scheduler, STATS_FIELDS, stats_columns
+from result_writer import ResultWriter
+from benchmark_utils import encode_image_to_binary, list_image_files
+from structured_output import CONTACT_SCHEMA, JSON_EXTRACTION_PROMPT, contact_problems, parse_json_contact
+from image_preprocess import detect_mime_type
+from response_cache import ResponseCache, sha256_bytes
+from phash_index import NEAR_DISTANCE, PerceptualIndex
+
+
+MODEL_NAME = 'gemini-2.0-flash'
+MAX_WORKERS = 8  # 동시에 처리할 명함 수
+RESULTS_FILE = os.path.join("results", "batch_ingest.jsonl")
+RESULT_FIELDS = ["image"] + CONTACT_FIELDS + ["other_details", "response", "inference_time", "contact_id", "duplicate_of", "duplicate_distance", "cached", "source", "escalation"] + STATS_FIELDS + ["error"]
+
+# 명함 한 장에서 연락처 정보만 추출 (대화 없이 한 번의 요청으로 끝나며, 응답 전체가 CONTACT_SCHEMA 형식의 JSON)
+EXTRACTION_PROMPT = JSON_EXTRACTION_PROMPT
+
+GENERATE_CONFIG = types.GenerateContentConfig(
+    max_output_tokens=500,
+    temperature=0.0,
+    response_mime_type="application/json",
+    response_schema=CONTACT_SCHEMA,
+)
+
+def parse_row(row, text):
+    """추출 응답을 결과 행의 연락처 필드로 채움 (JSON 형식이 아니면 error 필드에 기록)"""
+    info = parse_json_contact(text)
+    if info is None:
+        row["error"] = "응답이 연락처 JSON 형식이 아닙니다."
+        return row
+    row.update({field: info.get(field, '') for field in CONTACT_FIELDS}, other_details=info.get("other_details") or [])
+    return row
+
+def cache_key(model_name, image_key):
+    return ResponseCache.make_key(model_name, image_key, EXTRACTION_PROMPT, '', GENERATE_CONFIG.model_dump(exclude_none=True))
+
+def extract_local(local, image_name, image_data, cache=None, image_key=None):
+    """로컬 백엔드로 먼저 추출하고 (응답, 추론 시간, 캐시 여부, 검증 문제 목록) 반환 (문제가 없으면 Gemini로 보내지 않음)"""
+    key = ResponseCache.make_key(local.model, image_key or sha256_bytes(image_data), EXTRACTION_PROMPT, '', {"json": True}) if cache is not None else None
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        return cached[0], cached[1], True, contact_problems(parse_json_contact(cached[0]))
+
+    start_time = time.perf_counter()
+    try:
+        text = local.generate_json(image_name, image_data, EXTRACTION_PROMPT)["text"]
+    except Exception as e:
+        return None, None, False, [f"로컬 오류: {str(e)}"]
+    elapsed = round(time.perf_counter() - start_time, 2)
+    problems = contact_problems(parse_json_contact(text))
+    if cache is not None and not problems:
+        cache.put(key, local.model, text, elapsed)
+    return text, elapsed, False, problems
+
+def extract_card(client, scheduler, image_name, image_data, model_name=MODEL_NAME, cache=None, image_key=None, local=None):
+    """명함 한 장을 추출 요청으로 보내고 결과 행 반환 (실패하면 error 필드에 기록)
+
+    cache가 있으면 (모델, image_key, 지시문, 생성 설정)이 같은 이전 응답을 재사용하고, 새 응답은 저장합니다.
+    local(이미지 바이트로 추출하는 백엔드, 예: qwen-server)이 있으면 먼저 로컬로 추출하고,
+    필드 검증(contact_problems)에 실패한 명함만 Gemini로 보냅니다 (source에 응답한 모델, escalation에 사유).
+    """
+    row = {"image": image_name, "cached": False, "source": model_name}
+    if local is not None:
+        text, elapsed, cached, problems = extract_local(local, image_name, image_data, cache, image_key)
+        if not problems:
+            row.update(stats_columns(None), response=text, inference_time=elapsed, cached=cached, source=local.model)
+            return parse_row(row, text)
+        row["escalation"] = "; ".join(problems)
+
+    key = cache_key(model_name, image_key or sha256_bytes(image_data)) if cache is not None else None
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        response_text, inference_time = cached
+        row.update(stats_columns(None), response=response_text, inference_time=inference_time, cached=True)
+        return parse_row(row, response_text)
+
+    contents = [types.Part.from_bytes(data=image_data, mime_type=detect_mime_type(image_data)), EXTRACTION_PROMPT]
+
+    def generate():
+        start_time = time.perf_counter()
+        response = client.models.generate_content(model=model_name, contents=contents, config=GENERATE_CONFIG)
+        return response, time.perf_counter() - start_time
+
+    try:
+        # 한도 대기와 일시적 오류 재시도는 scheduler가 처리
+        (response, elapsed), stats = scheduler.call(model_name, generate)
+    except Exception as e:
+        row.update(stats_columns(None), error=str(e))
+        return row
+
+    row.update(stats_columns(stats), response=response.text, inference_time=round(elapsed, 2))
+    parse_row(row, response.text)
+    if cache is not None and not row.get("error"):
+        cache.put(key, model_name, response.text, row["inference_time"])
+    return row
+
+def ingest(client, cards, max_workers=MAX_WORKERS, model_name=MODEL_NAME, scheduler=None,
+           writer=None, contact_store=None, on_result=None, cache=None, dedup=None, local=None):
+    """명함 여러 장을 각각 별도 요청으로 동시에 추출 (최대 max_workers개 동시 요청)
+
+    Args:
+        cards (list): (이미지 이름, 이미지 바이트) 리스트
+        writer (ResultWriter): 있으면 끝난 결과부터 바로 기록
+        contact_store (ContactStore): 있으면 추출에 성공한 명함을 연락처로 저장
+        on_result: 결과가 하나 끝날 때마다 호출하는 함수 (끝난 수, 전체 수, 결과 행), 호출한 스레드에서 실행
+        cache (ResponseCache): 있으면 이전 추출 응답을 재사용
+        dedup (PerceptualIndex): 있으면 색인의 대표 키로 묶어 그룹마다 한 장만 추출하고 나머지는 그 결과를 복사
+            (duplicate_of에 추출한 이미지 이름, duplicate_distance에 dHash 거리, 캐시가 있으면 이전 실행의 같은 명함도 재사용)
+            없으면 바이트가 같은 이미지끼리만 묶음. 근접 중복 색인은 같은 양식의 다른 명함을 묶을 수 있으므로 결과를 검토할 때만 사용
+        local (Backend): 있으면 로컬 모델로 먼저 추출하고 검증에 실패한 명함만 Gemini로 보냄
+
+    Returns:
+        list: 끝난 순서대로의 결과 행 리스트
+    """
+    scheduler = scheduler or Scheduler()
+    # 대표 키별로 묶기 (dedup이 없으면 바이트가 같은 이미지끼리만 묶임)
+    groups = {}
+    for image_name, image_data in cards:
+        key, distance = dedup.canonical(image_data) if dedup is not None else (sha256_bytes(image_data), 0)
+        groups.setdefault(key, []).append((image_name, image_data, distance))
+
+    rows = []
+
+    def finish(row):
+        if writer is not None:
+            writer.write(row)
+        rows.append(row)
+        if on_result is not None:
+            on_result(len(rows), len(cards), row)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(extract_card, client, scheduler, members[0][0], members[0][1], model_name, cache, key, local): members
+                   for key, members in groups.items()}
+        for future in as_completed(futures):
+            row = future.result()
+            if contact_store is not None and not row.get("error"):
+                row["contact_id"], _ = contact_store.save(row)
+            finish(row)
+            # 같은 명함의 나머지 이미지는 요청 없이 결과만 복사 (연락처는 이미 저장됨)
+            for image_name, _, distance in futures[future][1:]:
+                finish(dict(row, image=image_name, duplicate_of=row["image"], duplicate_distance=distance, inference_time=0.0))
+    return rows
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from google import genai
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="명함 이미지 폴더를 한 장씩 별도 요청으로 동시에 추출해 연락처로 등록")
+    parser.add_argument('--images', default=os.path.join("data", "images"), help="명함 이미지 폴더")
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help="동시에 처리할 명함 수")
+    parser.add_argument('--model', default=MODEL_NAME)
+    parser.add_argument('--output', default=RESULTS_FILE, help="결과 파일 (.jsonl 또는 .csv, 같은 실행 ID로 재실행하면 완료된 명함은 건너뜀)")
+    parser.add_argument('--no-contacts', action='store_true', help="연락처 저장소에 저장하지 않음")
+    parser.add_argument('--no-cache', action='store_true', help="응답 캐시를 쓰지 않음")
+    parser.add_argument('--near-dup', action='store_true',
+                        help="다시 찍은 같은 명함(dHash 근접 중복)도 한 번만 추출 (같은 양식의 다른 명함이 묶일 수 있으므로 duplicate_of 결과를 검토)")
+    parser.add_argument('--local', default=None,
+                        help="먼저 추출할 로컬 백엔드:모델 (예: qwen-server:Qwen/Qwen2.5-VL-3B-Instruct), 검증에 실패한 명함만 Gemini로 보냄")
+    args = parser.parse_args()
+
+    api_key = os.getenv('GOOGLE_API_KEY')
+    if not api_key:
+        raise ValueError("GOOGLE_API_KEY가 .env 파일에 정의되어 있지 않습니다.")
+
+    writer = ResultWriter(args.output, RESULT_FIELDS, key_fields=["image"])
+    image_files = [name for name in list_image_files(args.images) if not writer.is_done(image=name)]
+    cards = [(name, encode_image_to_binary(os.path.join(args.images, name))) for name in image_files]
+    contact_store = None if args.no_contacts else ContactStore()
+    cache = None if args.no_cache else ResponseCache()
+    dedup = PerceptualIndex(max_distance=NEAR_DISTANCE) if args.near_dup else None
+    local = None
+    if args.local:
+        from backends import create_backend
+
+        local = create_backend(args.local)
+        local.setup()
+
+    def print_progress(done, total, row):
+        status = f"오류: {row['error']}" if row.get("error") else f"{row.get('name', '')} / {row.get('company', '')}"
+        print(f"[{done}/{total}] {row['image']} - {status}")
+
+    start_time = time.perf_counter()
+    rows = ingest(genai.Client(api_key=api_key), cards, args.workers, args.model,
+                  writer=writer, contact_store=contact_store, on_result=print_progress, cache=cache, dedup=dedup, local=local)
+    elapsed = time.perf_counter() - start_time
+    writer.close()
+    if cache is not None:
+        cache.report()
+        cache.close()
+    if dedup is not None:
+        dedup.report()
+        dedup.close()
+
+    failed = sum(1 for row in rows if row.get("error"))
+    duplicates = sum(1 for row in rows if row.get("duplicate_of"))
+    if local is not None:
+        extracted = [row for row in rows if not row.get("duplicate_of")]
+        escalated = sum(1 for row in extracted if row.get("escalation"))
+        print(f"로컬 처리 {len(extracted) - escalated}장 / Gemini로 보냄 {escalated}장 / 에스컬레이션율 {escalated / len(extracted) if extracted else 0.0:.1%}")
+    print(f"명함 {len(rows)}장 / 실패 {failed}장 / 중복 {duplicates}장 / 소요 시간: {elapsed:.2f}초 / 처리량: {len(rows) / elapsed if elapsed > 0 else 0.0:.2f}장/sec")
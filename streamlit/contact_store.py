@@ -0,0 +1,218 @@
+import re
+import json
+import time
+import sqlite3
+import threading
+
+
+CONTACTS_PATH = "contacts.sqlite"
+CONTACT_FIELDS = ["name", "position", "company", "phone", "email", "address", "website"]
+
+def normalize_phone(phone):
+    """전화번호를 숫자만 남겨 비교용으로 정규화 (+82 10-... 은 010... 으로 변환)"""
+    digits = re.sub(r'\D', '', phone or '')
+    if digits.startswith('82') and len(digits) >= 11:
+        digits = '0' + digits[2:]
+    return digits
+
+def normalize_email(email):
+    """이메일을 소문자로 정규화"""
+    return (email or '').strip().lower()
+
+def normalize_name(name):
+    """이름/직책 등 일반 텍스트를 공백을 없애고 소문자로 정규화"""
+    return re.sub(r'\s+', '', name or '').lower()
+
+def normalize_field(field, value):
+    """필드별 비교용 정규화"""
+    if field == "phone":
+        return normalize_phone(value)
+    if field == "email":
+        return normalize_email(value)
+    return normalize_name(value)
+
+def parse_extracted_info(text):
+    """모델 응답의 <extracted_info> JSON을 딕셔너리로 반환 (없거나 JSON이 아니면 None)"""
+    match = re.search(r'<extracted_info>(.*?)</extracted_info>', text or '', re.DOTALL)
+    if not match:
+        return None
+    body = match.group(1)
+    # ```json ... ``` 코드 블록으로 감싼 경우도 처리
+    start, end = body.find('{'), body.rfind('}')
+    if start == -1 or end == -1:
+        return None
+    try:
+        info = json.loads(body[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    return info if isinstance(info, dict) else None
+
+class ContactStore:
+    """명함에서 추출한 연락처와 만남 맥락을 저장하는 SQLite 저장소
+
+    이름/회사/정규화된 전화번호/이메일에 인덱스를 두고, FTS5 전문 검색 인덱스(contacts_fts)를 트리거로 함께 갱신합니다.
+    이메일이 같거나 전화번호와 이름이 모두 같은 연락처는 새로 만들지 않고 기존 연락처에 합칩니다.
+    """
+    def __init__(self, path=CONTACTS_PATH):
+        self.path = path
+        # Streamlit 세션 스레드들이 같은 연결을 쓰므로 잠금으로 직렬화
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS contacts (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL DEFAULT '',
+                position TEXT NOT NULL DEFAULT '',
+                company TEXT NOT NULL DEFAULT '',
+                phone TEXT NOT NULL DEFAULT '',
+                email TEXT NOT NULL DEFAULT '',
+                address TEXT NOT NULL DEFAULT '',
+                website TEXT NOT NULL DEFAULT '',
+                other_details TEXT NOT NULL DEFAULT '[]',
+                context TEXT NOT NULL DEFAULT '',
+                phone_norm TEXT NOT NULL DEFAULT '',
+                email_norm TEXT NOT NULL DEFAULT '',
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_contacts_name ON contacts (name);
+            CREATE INDEX IF NOT EXISTS idx_contacts_company ON contacts (company);
+            CREATE INDEX IF NOT EXISTS idx_contacts_phone_norm ON contacts (phone_norm);
+            CREATE INDEX IF NOT EXISTS idx_contacts_email_norm ON contacts (email_norm);
+
+            CREATE VIRTUAL TABLE IF NOT EXISTS contacts_fts USING fts5(
+                name, position, company, phone, email, address, context,
+                content='contacts', content_rowid='id', tokenize='unicode61'
+            );
+            CREATE TRIGGER IF NOT EXISTS contacts_ai AFTER INSERT ON contacts BEGIN
+                INSERT INTO contacts_fts (rowid, name, position, company, phone, email, address, context)
+                VALUES (new.id, new.name, new.position, new.company, new.phone, new.email, new.address, new.context);
+            END;
+            CREATE TRIGGER IF NOT EXISTS contacts_ad AFTER DELETE ON contacts BEGIN
+                INSERT INTO contacts_fts (contacts_fts, rowid, name, position, company, phone, email, address, context)
+                VALUES ('delete', old.id, old.name, old.position, old.company, old.phone, old.email, old.address, old.context);
+            END;
+            CREATE TRIGGER IF NOT EXISTS contacts_au AFTER UPDATE ON contacts BEGIN
+                INSERT INTO contacts_fts (contacts_fts, rowid, name, position, company, phone, email, address, context)
+                VALUES ('delete', old.id, old.name, old.position, old.company, old.phone, old.email, old.address, old.context);
+                INSERT INTO contacts_fts (rowid, name, position, company, phone, email, address, context)
+                VALUES (new.id, new.name, new.position, new.company, new.phone, new.email, new.address, new.context);
+            END;
+        """)
+        self.conn.commit()
+
+    def find_duplicate(self, phone_norm, email_norm, name_norm):
+        """같은 사람으로 볼 연락처 행 반환 (없으면 None)
+
+        이메일이 같으면 같은 사람으로 봅니다. 전화번호는 회사 대표번호처럼 여러 명함이 함께 쓰므로 이름까지 같을 때만 같은 사람으로 봅니다.
+        """
+        if email_norm:
+            row = self.conn.execute("SELECT * FROM contacts WHERE email_norm = ?", (email_norm,)).fetchone()
+            if row is not None:
+                return row
+        if phone_norm and name_norm:
+            for row in self.conn.execute("SELECT * FROM contacts WHERE phone_norm = ?", (phone_norm,)):
+                if normalize_name(row["name"]) == name_norm:
+                    return row
+        return None
+
+    def conflicts(self, existing, values):
+        """기존 연락처와 새 값이 둘 다 비어 있지 않은데 서로 다른 필드 리스트"""
+        return [field for field in CONTACT_FIELDS
+                if values[field] and existing[field]
+                and normalize_field(field, values[field]) != normalize_field(field, existing[field])]
+
+    def save(self, info, context=''):
+        """추출한 연락처(<extracted_info> 딕셔너리)와 만남 맥락을 저장하고 (연락처 ID, 새로 만들었는지 여부) 반환
+
+        같은 사람의 연락처가 있으면 비어 있는 필드만 채우고 맥락은 뒤에 덧붙입니다.
+        같은 사람이어도 이름/회사 등 이미 값이 있는 필드가 다르면 기존 값을 덮어쓰지 않고 새 연락처로 따로 저장합니다.
+        """
+        values = {field: str(info.get(field) or '').strip() for field in CONTACT_FIELDS}
+        other_details = info.get("other_details") or []
+        phone_norm = normalize_phone(values["phone"])
+        email_norm = normalize_email(values["email"])
+        now = time.time()
+
+        with self.lock:
+            existing = self.find_duplicate(phone_norm, email_norm, normalize_name(values["name"]))
+            if existing is None or self.conflicts(existing, values):
+                cursor = self.conn.execute(
+                    f"INSERT INTO contacts ({', '.join(CONTACT_FIELDS)}, other_details, context, phone_norm, email_norm, created_at, updated_at) "
+                    f"VALUES ({', '.join('?' * (len(CONTACT_FIELDS) + 6))})",
+                    [values[field] for field in CONTACT_FIELDS]
+                    + [json.dumps(other_details, ensure_ascii=False), context.strip(), phone_norm, email_norm, now, now],
+                )
+                self.conn.commit()
+                return cursor.lastrowid, True
+
+            merged = {field: existing[field] or values[field] for field in CONTACT_FIELDS}
+            merged_details = json.loads(existing["other_details"])
+            merged_details += [detail for detail in other_details if detail not in merged_details]
+            merged_context = existing["context"]
+            if context.strip() and context.strip() not in merged_context:
+                merged_context = (merged_context + "\n" + context.strip()).strip()
+            self.conn.execute(
+                f"UPDATE contacts SET {', '.join(f'{field} = ?' for field in CONTACT_FIELDS)}, other_details = ?, context = ?, "
+                f"phone_norm = ?, email_norm = ?, updated_at = ? WHERE id = ?",
+                [merged[field] for field in CONTACT_FIELDS]
+                + [json.dumps(merged_details, ensure_ascii=False), merged_context,
+                   normalize_phone(merged["phone"]), normalize_email(merged["email"]), now, existing["id"]],
+            )
+            self.conn.commit()
+            return existing["id"], False
+
+    def search(self, query, limit=20):
+        """연락처 검색 (관련도 순)
+
+        전화번호(숫자 7자리 이상)나 이메일처럼 보이는 검색어는 정규화 컬럼 인덱스로 바로 찾고,
+        그 외에는 이름/직책/회사/전화번호/이메일/주소/맥락을 전문 검색합니다.
+        단어가 그대로 일치하는 연락처를 먼저, 접두어로만 일치하는 연락처를 그 뒤에 두며 각각은 bm25 점수 순(같으면 최근 저장 순)입니다.
+        """
+        query = (query or '').strip()
+        rows = []
+        with self.lock:
+            if '@' in query:
+                rows = self.conn.execute("SELECT * FROM contacts WHERE email_norm = ? LIMIT ?",
+                                         (normalize_email(query), limit)).fetchall()
+            elif len(normalize_phone(query)) >= 7 and not re.search(r'[^\d\s()+.-]', query):
+                rows = self.conn.execute("SELECT * FROM contacts WHERE phone_norm = ? LIMIT ?",
+                                         (normalize_phone(query), limit)).fetchall()
+            if rows:
+                return [self.to_dict(row) for row in rows]
+
+            terms = re.findall(r'\w+', query)
+            if not terms:
+                return []
+            # 각 단어를 따옴표로 감싸 FTS5 문법 문자와 섞이지 않게 하고, 정확히 일치 → 접두어 검색(*) 순으로 limit까지 채움
+            # (LIMIT 전에 bm25로 정렬해야 오래전에 저장한 정확한 일치가 최근의 부분 일치에 밀려 잘리지 않음)
+            ids = []
+            for match in (' '.join(f'"{term}"' for term in terms), ' '.join(f'"{term}"*' for term in terms)):
+                for (rowid,) in self.conn.execute(
+                        "SELECT rowid FROM contacts_fts WHERE contacts_fts MATCH ? ORDER BY bm25(contacts_fts), rowid DESC LIMIT ?",
+                        (match, limit)):
+                    if rowid not in ids:
+                        ids.append(rowid)
+                if len(ids) >= limit:
+                    break
+            ids = ids[:limit]
+            if not ids:
+                return []
+            by_id = {row["id"]: row for row in self.conn.execute(
+                f"SELECT * FROM contacts WHERE id IN ({', '.join('?' * len(ids))})", ids)}
+        return [self.to_dict(by_id[contact_id]) for contact_id in ids if contact_id in by_id]
+
+    def to_dict(self, row):
+        """연락처 행을 딕셔너리로 변환 (정규화 컬럼 제외)"""
+        contact = {key: row[key] for key in row.keys() if not key.endswith("_norm")}
+        contact["other_details"] = json.loads(contact["other_details"])
+        return contact
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM contacts").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,123 @@
+import os
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+
+UPLOAD_DIR = os.path.join("cache", "uploads")
+# 기본 제한: 디스크 200MB (넘으면 가장 오래 사용하지 않은 이미지부터 삭제)
+MAX_BYTES = 200 * 1024**2
+PREVIEW_SIZE = (400, 400)
+
+class UploadStore:
+    """업로드된 이미지를 내용 해시(SHA-256)로 한 번만 저장하는 디스크 LRU 저장소
+
+    같은 이미지를 여러 번 올리거나 rerun마다 다시 넘겨받아도 파일은 하나만 남고,
+    전체 크기가 max_bytes를 넘으면 가장 오래 사용하지 않은 이미지부터 삭제합니다.
+    화면 표시용 축소 미리보기(JPEG)는 메모리에 둡니다.
+    """
+    def __init__(self, directory=UPLOAD_DIR, max_bytes=MAX_BYTES, preview_size=PREVIEW_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.preview_size = preview_size
+        os.makedirs(directory, exist_ok=True)
+        # 해시 -> {"name", "path", "size", "preview"} (앞쪽이 가장 오래 사용하지 않은 항목)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+        # 앱을 다시 시작해도 이전에 저장한 파일을 재사용 (미리보기는 필요할 때 생성)
+        for filename in sorted(os.listdir(directory), key=lambda f: os.path.getmtime(os.path.join(directory, f))):
+            path = os.path.join(directory, filename)
+            digest = os.path.splitext(filename)[0]
+            size = os.path.getsize(path)
+            self.entries[digest] = {"name": filename, "path": path, "size": size, "preview": None}
+            self.total_bytes += size
+        self.evict()
+
+    def add(self, name, data):
+        """이미지 바이트를 저장하고 (해시, 새로 저장했는지 여부) 반환 (이미 있으면 파일을 다시 쓰지 않음)"""
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if digest in self.entries:
+                self.entries.move_to_end(digest)
+                self.entries[digest]["name"] = name
+                return digest, False
+
+            # 깨진 이미지면 여기서 예외가 나므로 색인에 없는 파일이 남지 않도록 미리보기를 먼저 만듦
+            preview = self.make_preview(data)
+            path = os.path.join(self.directory, digest + os.path.splitext(name)[1].lower())
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.entries[digest] = {"name": name, "path": path, "size": len(data), "preview": preview}
+            self.total_bytes += len(data)
+        self.evict(keep=digest)
+        return digest, True
+
+    def make_preview(self, data):
+        """화면 표시용 축소 JPEG 바이트 생성"""
+        image = Image.open(io.BytesIO(data))
+        image.thumbnail(self.preview_size)
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=80)
+        return buffer.getvalue()
+
+    def __contains__(self, digest):
+        return digest in self.entries
+
+    def name(self, digest):
+        """업로드할 때의 파일 이름"""
+        entry = self.entries.get(digest)
+        return entry["name"] if entry else digest[:12]
+
+    def path(self, digest):
+        """저장된 파일 경로 (삭제됐으면 None)"""
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                return None
+            self.entries.move_to_end(digest)
+            return entry["path"]
+
+    def read(self, digest):
+        """저장된 이미지 바이트 (삭제됐으면 None)"""
+        path = self.path(digest)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def open_image(self, digest):
+        """저장된 이미지를 PIL Image로 열기 (삭제됐으면 None)"""
+        data = self.read(digest)
+        return Image.open(io.BytesIO(data)) if data is not None else None
+
+    def preview(self, digest):
+        """축소 미리보기 JPEG 바이트 (삭제됐으면 None)"""
+        entry = self.entries.get(digest)
+        if entry is None:
+            return None
+        if entry["preview"] is None:
+            entry["preview"] = self.make_preview(self.read(digest))
+        return entry["preview"]
+
+    def evict(self, keep=None):
+        """전체 크기가 max_bytes 이하가 될 때까지 가장 오래 사용하지 않은 이미지 삭제 (keep은 제외)"""
+        with self.lock:
+            for digest in list(self.entries):
+                if self.total_bytes <= self.max_bytes:
+                    break
+                if digest == keep:
+                    continue
+                entry = self.entries.pop(digest)
+                self.total_bytes -= entry["size"]
+                try:
+                    os.remove(entry["path"])
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        """저장된 이미지 수와 디스크 사용량 반환"""
+        return {"entries": len(self.entries), "bytes": self.total_bytes}
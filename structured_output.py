@@ -0,0 +1,88 @@
+import re
+import json
+
+
+CONTACT_FIELDS = ["name", "position", "company", "phone", "email", "address", "website"]
+
+# 명함 추출 결과 스키마 (Gemini response_schema, Ollama format, Qwen 제한 디코딩에 공통으로 사용)
+CONTACT_SCHEMA = {
+    "type": "object",
+    "properties": dict(
+        {field: {"type": "string"} for field in CONTACT_FIELDS},
+        other_details={"type": "array", "items": {"type": "string"}},
+    ),
+    "required": CONTACT_FIELDS,
+}
+
+# 캐스케이드에서 로컬 모델 결과를 받아들이려면 비어 있으면 안 되는 필드
+REQUIRED_FIELDS = ["name", "company"]
+
+EMAIL_FORMAT = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+PHONE_FORMAT = re.compile(r'\+?[\d\s().-]+')
+WEBSITE_FORMAT = re.compile(r'(?:https?://)?(?:www\.)?[\w-]+(?:\.[\w-]+)*\.[a-z]{2,}(?:[/?#]\S*)?', re.IGNORECASE)
+
+# 구조화 출력 모드의 지시문 (형식은 스키마가 강제하므로 짧게 유지)
+JSON_EXTRACTION_PROMPT = "명함 이미지에서 연락처 정보를 추출하세요. 없는 항목은 빈 문자열로 두세요."
+
+# 기존 방식의 자유 형식 지시문 (시스템 지침의 이미지 처리 부분과 같은 형식, 대화체 응답 안에 JSON 블록 포함)
+FREEFORM_EXTRACTION_PROMPT = """당신은 스마트 명함 관리 서비스를 위한 AI 어시스턴트입니다. 응답은 친근하고 대화체여야 합니다.
+명함 이미지를 받으면 정보를 분석하고, 다음 세부 정보를 JSON 형식으로 추출하세요:
+<extracted_info>
+{
+  "name": "",
+  "position": "",
+  "company": "",
+  "phone": "",
+  "email": "",
+  "address": "",
+  "website": "",
+  "other_details": []
+}
+</extracted_info>
+그 후 이 사람을 어디서 만났는지 등 추가 맥락 정보를 친근하게 물어보세요.
+
+이 명함 정보 정리해줘!"""
+
+def validate_contact(info):
+    """스키마의 필수 필드가 모두 있는 딕셔너리면 그대로, 아니면 None 반환"""
+    if not isinstance(info, dict) or any(field not in info for field in CONTACT_FIELDS):
+        return None
+    return info
+
+def parse_json_contact(text):
+    """구조화 출력(JSON 전체가 응답)을 파싱 (실패하면 None)"""
+    try:
+        return validate_contact(json.loads(text))
+    except (TypeError, json.JSONDecodeError):
+        return None
+
+def parse_freeform_contact(text):
+    """자유 형식 응답의 <extracted_info> 블록에서 JSON을 꺼내 파싱 (실패하면 None)"""
+    match = re.search(r'<extracted_info>(.*?)</extracted_info>', text or '', re.DOTALL)
+    if not match:
+        return None
+    body = match.group(1)
+    # ```json ... ``` 코드 블록으로 감싼 경우도 처리
+    start, end = body.find('{'), body.rfind('}')
+    if start == -1 or end == -1:
+        return None
+    return parse_json_contact(body[start:end + 1])
+
+def contact_problems(info, required_fields=REQUIRED_FIELDS):
+    """추출한 연락처의 문제 목록 (없으면 빈 리스트)
+
+    필수 필드가 비어 있거나, 값이 있는 전화번호/이메일/웹사이트가 형식에 맞지 않으면 문제로 봅니다.
+    전화번호/이메일은 여러 개를 쉼표, 슬래시, 세미콜론으로 나눠 적은 경우 각각 확인합니다.
+    """
+    if validate_contact(info) is None:
+        return ["JSON 형식 아님"]
+    problems = [f"{field} 없음" for field in required_fields if not str(info.get(field) or '').strip()]
+    for field, pattern in (("phone", PHONE_FORMAT), ("email", EMAIL_FORMAT), ("website", WEBSITE_FORMAT)):
+        value = str(info.get(field) or '').strip()
+        parts = [value] if field == "website" else re.split(r'[,/;]', value)
+        for part in (part.strip() for part in parts):
+            if not part:
+                continue
+            if not pattern.fullmatch(part) or (field == "phone" and not 8 <= len(re.sub(r'\D', '', part)) <= 15):
+                problems.append(f"{field} 형식 오류: {part}")
+    return problems
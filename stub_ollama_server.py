@@ -0,0 +1,158 @@
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    """Ollama의 /api/chat, /api/generate 응답 형식을 흉내 내는 요청 핸들러"""
+
+    def log_message(self, format, *args):
+        # 요청마다 출력되는 기본 접근 로그는 생략
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, model, created_at, content, start_time):
+        """응답을 단어 단위 NDJSON 청크로 전송 (첫 청크는 delay 후, 이후 청크는 token_delay 간격)"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        words = content.split(' ')
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.server.token_delay)
+            piece = word if i == 0 else ' ' + word
+            chunk = {'model': model, 'created_at': created_at, 'done': False}
+            if self.path == '/api/chat':
+                chunk['message'] = {'role': 'assistant', 'content': piece}
+            else:
+                chunk['response'] = piece
+            self.wfile.write((json.dumps(chunk, ensure_ascii=False) + '\n').encode('utf-8'))
+            self.wfile.flush()
+        final = {
+            'model': model,
+            'created_at': created_at,
+            'done': True,
+            'done_reason': 'stop',
+            'total_duration': int((time.perf_counter() - start_time) * 1e9),
+            'load_duration': 0,
+            'prompt_eval_count': 1,
+            'eval_count': len(words),
+        }
+        if self.path == '/api/chat':
+            final['message'] = {'role': 'assistant', 'content': ''}
+        else:
+            final['response'] = ''
+        self.wfile.write((json.dumps(final) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def do_POST(self):
+        request = self.read_body()
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            server.keep_alive_values.append(request.get('keep_alive'))
+
+        if self.path not in ('/api/chat', '/api/generate'):
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+
+        # 장애 주입: 일부 요청은 429/503으로 실패시키고, 일부는 slow_delay만큼 더 늦게 응답 (사전 로드 요청은 제외)
+        is_warm_up = self.path == '/api/generate' and not request.get('prompt')
+        with server.lock:
+            fail = not is_warm_up and server.random.random() < server.fail_rate
+            status = server.random.choice((429, 503))
+            slow = not is_warm_up and server.random.random() < server.slow_rate
+            if fail:
+                server.failure_count += 1
+        if fail:
+            time.sleep(server.delay / 2)
+            self.send_json(status, {'error': 'rate limit exceeded' if status == 429 else 'service unavailable'})
+            return
+
+        start_time = time.perf_counter()
+        time.sleep(server.delay + (server.slow_delay if slow else 0.0))
+        model = request.get('model', '')
+        content = server.reply
+        created_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        # Ollama는 stream을 지정하지 않으면 스트리밍으로 응답 (클라이언트는 stream=False를 명시)
+        if request.get('stream', True) and (self.path == '/api/chat' or request.get('prompt')):
+            self.send_stream(model, created_at, content, start_time)
+            return
+        payload = {
+            'model': model,
+            'created_at': created_at,
+            'done': True,
+            'done_reason': 'stop',
+            'total_duration': int((time.perf_counter() - start_time) * 1e9),
+            'load_duration': 0,
+            'prompt_eval_count': 1,
+            'eval_count': len(content.split()),
+        }
+        if self.path == '/api/chat':
+            payload['message'] = {'role': 'assistant', 'content': content}
+        else:
+            payload['response'] = content if request.get('prompt') else ''
+        self.send_json(200, payload)
+
+
+def start_stub_server(host='127.0.0.1', port=0, delay=0.1, reply='stub response', token_delay=0.01,
+                      fail_rate=0.0, slow_rate=0.0, slow_delay=1.0, seed=None):
+    """백그라운드 스레드에서 스텁 서버를 띄우고 (서버, URL)을 반환하는 함수
+
+    port=0이면 빈 포트 사용, token_delay는 스트리밍 청크 간격.
+    fail_rate 비율의 요청은 429 또는 503으로 실패하고, slow_rate 비율의 요청은 slow_delay초 더 늦게 응답합니다.
+    """
+    server = ThreadingHTTPServer((host, port), StubOllamaHandler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.reply = reply
+    server.token_delay = token_delay
+    server.fail_rate = fail_rate
+    server.slow_rate = slow_rate
+    server.slow_delay = slow_delay
+    server.random = random.Random(seed)
+    server.failure_count = 0
+    server.lock = threading.Lock()
+    server.request_count = 0
+    server.keep_alive_values = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="inference_ollama_models.py 테스트용 Ollama 스텁 서버")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11434)
+    parser.add_argument('--delay', type=float, default=0.1, help="요청당 응답 지연 시간(초)")
+    parser.add_argument('--reply', default='stub response', help="모든 요청에 돌려줄 응답 텍스트")
+    parser.add_argument('--token-delay', type=float, default=0.01, help="스트리밍 응답의 청크(단어) 간격(초)")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="429/503으로 실패시킬 요청 비율")
+    parser.add_argument('--slow-rate', type=float, default=0.0, help="slow-delay만큼 늦게 응답할 요청 비율")
+    parser.add_argument('--slow-delay', type=float, default=1.0, help="느린 요청에 추가할 지연 시간(초)")
+    parser.add_argument('--seed', type=int, default=None, help="장애 주입 난수 시드")
+    args = parser.parse_args()
+
+    server, url = start_stub_server(args.host, args.port, args.delay, args.reply, args.token_delay,
+                                    args.fail_rate, args.slow_rate, args.slow_delay, args.seed)
+    print(f"스텁 Ollama 서버 실행 중: {url} (종료: Ctrl+C)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# 저장소 루트의 모듈(scheduler, result_writer 등)과 streamlit 폴더의 모듈(contact_store 등)을 import할 수 있도록 경로 추가
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT_DIR, os.path.join(ROOT_DIR, "streamlit")):
+    if path not in sys.path:
+        sys.path.append(path)
@@ -0,0 +1,40 @@
+from contact_store import ContactStore
+
+
+def card(**values):
+    return {"name": "", "position": "", "company": "Acme", "phone": "", "email": "", **values}
+
+def test_same_email_is_merged_and_fills_empty_fields(tmp_path):
+    store = ContactStore(str(tmp_path / "contacts.sqlite"))
+    first_id, created = store.save(card(name="김민수", email="MINSU@acme.com"), "전시회에서 만남")
+    assert created
+    second_id, created = store.save(card(name="김민수", email="minsu@acme.com", position="팀장"), "후속 미팅")
+    assert (second_id, created) == (first_id, False)
+    contact = store.to_dict(store.conn.execute("SELECT * FROM contacts WHERE id = ?", (first_id,)).fetchone())
+    assert contact["position"] == "팀장"
+    assert contact["context"] == "전시회에서 만남\n후속 미팅"
+    store.close()
+
+def test_shared_phone_with_different_name_is_kept_separate(tmp_path):
+    store = ContactStore(str(tmp_path / "contacts.sqlite"))
+    first_id, _ = store.save(card(name="김민수", phone="02-555-0100"))
+    second_id, created = store.save(card(name="이영희", phone="+82 2 555 0100"))
+    assert created and second_id != first_id
+    assert store.count() == 2
+    store.close()
+
+def test_same_phone_and_name_is_merged(tmp_path):
+    store = ContactStore(str(tmp_path / "contacts.sqlite"))
+    first_id, _ = store.save(card(name="김민수", phone="010-1234-5678"))
+    second_id, created = store.save(card(name="김 민수", phone="01012345678", email="minsu@acme.com"))
+    assert (second_id, created) == (first_id, False)
+    store.close()
+
+def test_conflicting_field_is_not_overwritten(tmp_path):
+    store = ContactStore(str(tmp_path / "contacts.sqlite"))
+    first_id, _ = store.save(card(name="김민수", email="info@acme.com"))
+    second_id, created = store.save(card(name="이영희", email="info@acme.com"))
+    assert created and second_id != first_id
+    names = [row["name"] for row in store.conn.execute("SELECT name FROM contacts ORDER BY id")]
+    assert names == ["김민수", "이영희"]
+    store.close()
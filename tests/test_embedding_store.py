@@ -0,0 +1,28 @@
+import numpy as np
+from embedding_store import EmbeddingStore
+
+
+def fake_encode(texts):
+    return np.array([[len(text), text.count("a"), 1.0] for text in texts], dtype=np.float32)
+
+def test_only_missing_texts_are_encoded(tmp_path):
+    store = EmbeddingStore("fake", directory=str(tmp_path))
+    calls = []
+    encode = lambda texts: calls.append(list(texts)) or fake_encode(texts)
+    first = store.get_or_encode(["abc", "banana"], encode)
+    second = store.get_or_encode(["banana", "kiwi", "abc"], encode)
+    assert calls == [["abc", "banana"], ["kiwi"]]
+    assert np.array_equal(second[[2, 0]], first)
+    assert (store.hits, store.misses) == (2, 3)
+
+def test_store_is_reloaded(tmp_path):
+    EmbeddingStore("fake", directory=str(tmp_path)).get_or_encode(["abc"], fake_encode)
+    reloaded = EmbeddingStore("fake", directory=str(tmp_path))
+    assert np.array_equal(reloaded.get_or_encode(["abc"], lambda texts: None), fake_encode(["abc"]))
+
+def test_empty_input_returns_empty_matrix(tmp_path):
+    store = EmbeddingStore("fake", directory=str(tmp_path))
+    assert store.get_or_encode([], fake_encode).shape == (0, 0)
+    store.get_or_encode(["abc"], fake_encode)
+    empty = store.get_or_encode([], fake_encode)
+    assert empty.shape == (0, 3) and empty.dtype == np.float32
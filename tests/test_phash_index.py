@@ -0,0 +1,53 @@
+import io
+import numpy as np
+from PIL import Image
+from phash_index import NEAR_DISTANCE, PerceptualIndex, dhash, hamming_distances
+
+
+def card_bytes(bars, format="PNG"):
+    """세로 막대 위치로 모양이 정해지는 명함 대용 이미지"""
+    image = Image.new("RGB", (360, 200), "white")
+    for x in bars:
+        image.paste((0, 0, 0), (x, 20, x + 12, 180))
+    buffer = io.BytesIO()
+    image.save(buffer, format, quality=85)
+    return buffer.getvalue()
+
+CARD = card_bytes(range(0, 360, 40))
+RECOMPRESSED = card_bytes(range(0, 360, 40), "JPEG")
+OTHER = card_bytes(range(20, 360, 90))
+
+def test_hamming_distances():
+    hashes = np.array([0, 0b1011, 2**64 - 1], dtype=np.uint64)
+    assert list(hamming_distances(hashes, 0)) == [0, 3, 64]
+
+def test_default_only_merges_identical_bytes(tmp_path):
+    index = PerceptualIndex(path=str(tmp_path / "index.tsv"))
+    key, _ = index.canonical(CARD)
+    assert index.canonical(CARD) == (key, 0)
+    assert index.canonical(RECOMPRESSED)[0] != key
+    assert (index.exact_hits, index.near_hits, index.misses) == (1, 0, 2)
+    index.close()
+
+def test_near_duplicates_are_opt_in(tmp_path):
+    assert bin(dhash(CARD) ^ dhash(RECOMPRESSED)).count("1") <= NEAR_DISTANCE
+    index = PerceptualIndex(path=None, max_distance=NEAR_DISTANCE)
+    key, _ = index.canonical(CARD)
+    assert index.canonical(RECOMPRESSED)[0] == key
+    assert index.canonical(OTHER)[0] != key
+
+def test_threshold_boundary():
+    index = PerceptualIndex(path=None, max_distance=2)
+    index.add(0, "card")
+    assert index.find(0b11) == ("card", 2)
+    assert index.find(0b111) is None
+
+def test_reload_keeps_keys(tmp_path):
+    path = str(tmp_path / "index.tsv")
+    index = PerceptualIndex(path=path)
+    key, _ = index.canonical(CARD, key="first")
+    index.close()
+    reloaded = PerceptualIndex(path=path)
+    assert len(reloaded) == 1
+    assert reloaded.canonical(CARD) == (key, 0)
+    reloaded.close()
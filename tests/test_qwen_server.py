@@ -0,0 +1,58 @@
+import threading
+import pytest
+from qwen_server import BatchQueue
+
+
+class FakeQwen:
+    """이미지/질문을 그대로 돌려주는 가짜 모델 (max_batch보다 큰 배치는 메모리 부족)"""
+    checkpoint = "fake"
+    processor = None
+
+    def __init__(self, max_batch=None, delay=0.05):
+        self.max_batch = max_batch
+        self.delay = delay
+        self.batches = []
+        self.release = threading.Event()
+
+    def json_prefix_allowed_tokens_fn(self):
+        return "json"
+
+    def generate(self, images, prompts, prefix_allowed_tokens_fn=None):
+        self.release.wait(self.delay)
+        self.batches.append((len(images), prefix_allowed_tokens_fn))
+        if self.max_batch is not None and len(images) > self.max_batch:
+            raise RuntimeError("CUDA out of memory")
+        return [f"{image}:{prompt}" for image, prompt in zip(images, prompts)]
+
+def test_requests_are_batched():
+    qwen = FakeQwen()
+    batch_queue = BatchQueue(qwen, max_batch_size=4, batch_window=0.2)
+    futures = [batch_queue.submit(f"img{i}", "q") for i in range(4)]
+    results = [future.result(timeout=5) for future in futures]
+    assert [result["text"] for result in results] == [f"img{i}:q" for i in range(4)]
+    assert qwen.batches == [(4, None)]
+    metrics = batch_queue.metrics()
+    assert (metrics["requests"], metrics["batches"], metrics["batch_sizes"]) == (4, 1, {"4": 1})
+
+def test_json_and_text_requests_are_not_mixed():
+    qwen = FakeQwen()
+    batch_queue = BatchQueue(qwen, max_batch_size=4, batch_window=0.2)
+    futures = [batch_queue.submit("a", "q", json_mode=True), batch_queue.submit("b", "q")]
+    for future in futures:
+        future.result(timeout=5)
+    assert sorted(qwen.batches, key=str) == sorted([(1, "json"), (1, None)], key=str)
+
+def test_oom_batch_is_retried_one_by_one():
+    qwen = FakeQwen(max_batch=1)
+    batch_queue = BatchQueue(qwen, max_batch_size=3, batch_window=0.2)
+    futures = [batch_queue.submit(f"img{i}", "q") for i in range(3)]
+    assert [future.result(timeout=5)["batch_size"] for future in futures] == [1, 1, 1]
+    assert qwen.batches[0] == (3, None)
+
+def test_other_errors_fail_the_batch():
+    qwen = FakeQwen()
+    qwen.generate = lambda *args, **kwargs: (_ for _ in ()).throw(ValueError("bad image"))
+    batch_queue = BatchQueue(qwen, max_batch_size=2, batch_window=0.05)
+    with pytest.raises(ValueError):
+        batch_queue.submit("img", "q").result(timeout=5)
+    assert batch_queue.metrics()["errors"] == 1
@@ -0,0 +1,48 @@
+import pytest
+from response_cache import ResponseCache, sha256_bytes
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "responses.sqlite"), bypass=False)
+    yield cache
+    cache.close()
+
+def test_key_accepts_bytes_or_digest():
+    data = b"image bytes"
+    key = ResponseCache.make_key("model", data, "prompt")
+    assert key == ResponseCache.make_key("model", sha256_bytes(data), "prompt")
+    assert key == ResponseCache.make_key("model", [data], "prompt")
+
+@pytest.mark.parametrize("change", [
+    dict(model_id="other"),
+    dict(image_data=b"other"),
+    dict(prompt="other"),
+    dict(system_instruction="other"),
+    dict(params={"temperature": 0.5}),
+])
+def test_key_changes_with_inputs(change):
+    base = dict(model_id="model", image_data=b"image", prompt="prompt", system_instruction="", params={"temperature": 0.0})
+    assert ResponseCache.make_key(**base) != ResponseCache.make_key(**dict(base, **change))
+
+def test_get_put_and_bypass(cache, tmp_path):
+    key = ResponseCache.make_key("model", b"image", "prompt")
+    assert cache.get(key) is None
+    cache.put(key, "model", "answer", 1.5)
+    assert cache.get(key) == ("answer", 1.5)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    bypass = ResponseCache(path=str(tmp_path / "responses.sqlite"), bypass=True)
+    assert bypass.get(key) is None
+    bypass.close()
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "responses.sqlite"), max_bytes=250, bypass=False)
+    for name in ("a", "b", "c"):
+        cache.put(name, "model", name * 100)
+    cache.get("a")  # a를 가장 최근에 사용
+    cache.evict()
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    cache.close()
@@ -0,0 +1,71 @@
+import pytest
+from result_writer import ResultWriter
+
+
+FIELDS = ["image", "response", "error"]
+
+@pytest.fixture(autouse=True)
+def no_env(monkeypatch):
+    monkeypatch.delenv("SCR_RUN_ID", raising=False)
+    monkeypatch.delenv("SCR_RESUME", raising=False)
+
+@pytest.mark.parametrize("name", ["results.csv", "results.jsonl"])
+def test_interrupted_run_resumes_and_skips_done_jobs(tmp_path, name):
+    path = str(tmp_path / name)
+    writer = ResultWriter(path, FIELDS, key_fields=["image"])
+    writer.write({"image": "a.png", "response": "ok"})
+    writer.write({"image": "b.png", "error": "503"})
+    writer.file.close()  # close() 없이 중단
+
+    resumed = ResultWriter(path, FIELDS, key_fields=["image"])
+    assert resumed.run_id == writer.run_id
+    assert resumed.is_done(image="a.png")
+    assert not resumed.is_done(image="b.png")  # 실패한 작업은 다시 시도
+    resumed.close()
+
+def test_run_with_failures_resumes_until_clean(tmp_path):
+    path = str(tmp_path / "results.csv")
+    writer = ResultWriter(path, FIELDS, key_fields=["image"])
+    writer.write({"image": "a.png", "error": "503"})
+    writer.close()
+
+    retry = ResultWriter(path, FIELDS, key_fields=["image"])
+    assert retry.run_id == writer.run_id
+    retry.write({"image": "a.png", "response": "ok"})
+    retry.close()
+
+    fresh = ResultWriter(path, FIELDS, key_fields=["image"])
+    assert fresh.run_id != writer.run_id
+    assert not fresh.is_done(image="a.png")
+    fresh.close()
+
+def test_finished_run_starts_new_run_unless_resumed(tmp_path, monkeypatch):
+    path = str(tmp_path / "results.csv")
+    writer = ResultWriter(path, FIELDS, key_fields=["image"])
+    writer.write({"image": "a.png", "response": "ok"})
+    writer.close()
+
+    assert ResultWriter(path, FIELDS, key_fields=["image"], resume=True).run_id == writer.run_id
+    monkeypatch.setenv("SCR_RUN_ID", writer.run_id)
+    assert ResultWriter(path, FIELDS, key_fields=["image"]).is_done(image="a.png")
+
+def test_csv_header_mismatch(tmp_path):
+    path = str(tmp_path / "results.csv")
+    ResultWriter(path, FIELDS, key_fields=["image"]).close()
+    with pytest.raises(ValueError):
+        ResultWriter(path, ["image", "other"], key_fields=["image"])
+
+@pytest.mark.parametrize("name", ["results.csv", "results.jsonl"])
+def test_truncated_last_line_is_dropped(tmp_path, name):
+    path = str(tmp_path / name)
+    writer = ResultWriter(path, FIELDS, key_fields=["image"])
+    writer.write({"image": "a.png", "response": "ok"})
+    writer.file.close()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"run_id": "x", "image": "b.p' if name.endswith('.jsonl') else f'{writer.run_id},b.png,par')
+
+    resumed = ResultWriter(path, FIELDS, key_fields=["image"])
+    assert resumed.is_done(image="a.png")
+    resumed.write({"image": "b.png", "response": "ok"})
+    resumed.close()
+    assert [row["image"] for row in resumed.read_rows()] == ["a.png", "b.png"]
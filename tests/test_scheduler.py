@@ -0,0 +1,85 @@
+import time
+import ollama
+import pytest
+from scheduler import Scheduler, TokenBucket, is_transient
+from stub_ollama_server import start_stub_server
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(**kwargs):
+        server, url = start_stub_server(port=0, delay=0.01, token_delay=0.0, seed=0, **kwargs)
+        servers.append(server)
+        return server, url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def chat(url):
+    client = ollama.Client(host=url)
+    return lambda: client.chat(model="stub", messages=[{"role": "user", "content": "hi"}], stream=False)
+
+def test_token_bucket_waits_after_capacity():
+    bucket = TokenBucket(60)  # 초당 1개, 용량 60
+    assert all(bucket.reserve() == 0.0 for _ in range(60))
+    assert bucket.reserve() == pytest.approx(1.0, abs=0.05)
+
+def test_token_bucket_adjust_returns_tokens():
+    bucket = TokenBucket(600)
+    assert bucket.reserve(600) == 0.0
+    bucket.adjust(-100)
+    assert bucket.reserve(100) == 0.0
+
+def test_transient_errors():
+    assert is_transient(ollama.ResponseError("busy", 503))
+    assert is_transient(TimeoutError())
+    assert not is_transient(ollama.ResponseError("bad request", 400))
+
+def test_retries_transient_failures_from_stub(stub):
+    server, url = stub(fail_rate=0.5)
+    scheduler = Scheduler(max_retries=20, base_delay=0.001, max_delay=0.01, seed=0)
+    retries = 0
+    for _ in range(10):
+        response, stats = scheduler.call("stub", chat(url), hedge=False)
+        assert response["message"]["content"] == "stub response"
+        retries += stats["retries"]
+    assert retries == server.failure_count > 0
+
+def test_gives_up_after_max_retries(stub):
+    _, url = stub(fail_rate=1.0)
+    scheduler = Scheduler(max_retries=2, base_delay=0.001, max_delay=0.01, seed=0)
+    with pytest.raises(ollama.ResponseError):
+        scheduler.call("stub", chat(url), hedge=False)
+
+def test_hedges_slow_request():
+    calls = []
+
+    def fn():
+        calls.append(time.perf_counter())
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return "slow"
+        return "fast"
+
+    scheduler = Scheduler(hedge_after=0.05)
+    result, stats = scheduler.call("model", fn)
+    scheduler.close()
+    assert result == "fast"
+    assert stats["hedged"] is True
+    assert len(calls) == 2
+
+def test_hedging_stub_returns_first_response(stub):
+    server, url = stub(slow_rate=0.5, slow_delay=0.5)
+    scheduler = Scheduler(hedge_after=0.1, seed=0)
+    hedged = 0
+    for _ in range(6):
+        response, stats = scheduler.call("stub", chat(url))
+        assert response["message"]["content"] == "stub response"
+        hedged += stats["hedged"]
+    scheduler.close()
+    assert hedged > 0
+    assert server.request_count == 6 + hedged
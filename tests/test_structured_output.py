@@ -0,0 +1,32 @@
+import pytest
+from structured_output import CONTACT_FIELDS, contact_problems, parse_json_contact
+
+
+def contact(**values):
+    return dict({field: "" for field in CONTACT_FIELDS}, **values)
+
+def test_valid_contact_has_no_problems():
+    info = contact(name="김민수", company="Acme", phone="010-1234-5678, +82 2 555 0100",
+                   email="kim@acme.co.kr", website="www.acme.co.kr")
+    assert contact_problems(info) == []
+
+def test_missing_required_fields():
+    assert contact_problems(contact(name="김민수")) == ["company 없음"]
+
+def test_not_json():
+    assert contact_problems(None) == ["JSON 형식 아님"]
+    assert contact_problems(parse_json_contact("이름: 김민수")) == ["JSON 형식 아님"]
+
+@pytest.mark.parametrize("field, value", [
+    ("phone", "1234"),
+    ("phone", "010-1234-5678 ext"),
+    ("email", "kim at acme.com"),
+    ("website", "acme"),
+])
+def test_format_errors(field, value):
+    info = contact(name="김민수", company="Acme", **{field: value})
+    assert contact_problems(info) == [f"{field} 형식 오류: {value}"]
+
+def test_each_listed_value_is_checked():
+    info = contact(name="김민수", company="Acme", email="kim@acme.com; broken")
+    assert contact_problems(info) == ["email 형식 오류: broken"]
@@ -0,0 +1,26 @@
+import io
+import os
+import pytest
+from PIL import Image
+from upload_store import UploadStore
+
+
+def png_bytes(color):
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 20), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+def test_same_image_is_stored_once(tmp_path):
+    store = UploadStore(directory=str(tmp_path))
+    digest, created = store.add("card.png", png_bytes("white"))
+    assert created
+    assert store.add("again.png", png_bytes("white")) == (digest, False)
+    assert len(os.listdir(tmp_path)) == 1
+    assert store.preview(digest)[:2] == b"\xff\xd8"
+
+def test_corrupt_upload_leaves_no_file(tmp_path):
+    store = UploadStore(directory=str(tmp_path))
+    with pytest.raises(OSError):
+        store.add("broken.png", b"not an image")
+    assert os.listdir(tmp_path) == []
+    assert store.stats() == {"entries": 0, "bytes": 0}